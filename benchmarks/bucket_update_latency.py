@@ -0,0 +1,102 @@
+"""
+Benchmark update latency against document size for the legacy and bucketed result layouts.
+
+Writes ``--frames`` frame results for one stream with the legacy layout (one
+growing document per stream) and with the bucketed layout, one ``update_one``
+per frame as the detectors used to do, and reports the latency percentiles and
+document size for every window of frames.
+
+Usage:
+    MONGO_URI=mongodb://localhost:27017/ python benchmarks/bucket_update_latency.py --frames 20000 --output bucket_latency.json
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+
+import bson
+import pymongo
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lambdas"))
+
+from shared.result_buckets import BUCKET_SIZE, bucket_update, ensure_bucket_index
+
+# A detection result of typical size, as returned by the vehicle detector
+SAMPLE_STATUS = [
+    {"bbox": [412, 188, 640, 322], "confidence": 0.91, "class": "car", "track_id": 17},
+    {"bbox": [36, 240, 210, 355], "confidence": 0.84, "class": "truck", "track_id": 18}
+]
+
+
+def legacy_update(stream_id, frame_id):
+    timestamp = datetime.datetime.utcnow().isoformat()
+    return {"stream_Id": stream_id}, {"$set": {"updated_at": timestamp, f"vehicle_status.{frame_id}": SAMPLE_STATUS}}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run_layout(collection, layout, frames, window, bucket_size):
+    stream_id = "bench"
+    latencies = []
+    windows = []
+    for frame_number in range(frames):
+        frame_id = f"frame_{frame_number:06d}"
+        if layout == "legacy":
+            query, update = legacy_update(stream_id, frame_id)
+        else:
+            query, update = bucket_update(stream_id, "vehicle_status", frame_id, SAMPLE_STATUS, bucket_size=bucket_size)
+
+        start = time.perf_counter()
+        collection.update_one(query, update, upsert=True)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        if (frame_number + 1) % window == 0:
+            document = collection.find_one(query)
+            windows.append({
+                "frames_written": frame_number + 1,
+                "document_bytes": len(bson.encode(document)),
+                "p50_ms": round(statistics.median(latencies), 3),
+                "p99_ms": round(percentile(latencies, 99), 3)
+            })
+            print(f"{layout:8} frames={frame_number + 1:7} doc={windows[-1]['document_bytes']:10} bytes "
+                  f"p50={windows[-1]['p50_ms']:.3f} ms p99={windows[-1]['p99_ms']:.3f} ms")
+            latencies = []
+    return windows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongo-uri', default=os.environ.get('MONGO_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--frames', type=int, default=20000)
+    parser.add_argument('--window', type=int, default=1000, help="Frames per reported window")
+    parser.add_argument('--bucket-size', type=int, default=BUCKET_SIZE)
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    db = pymongo.MongoClient(args.mongo_uri)["lambda_outputs_bench"]
+    results = {"frames": args.frames, "bucket_size": args.bucket_size, "layouts": {}}
+    for layout in ("legacy", "bucketed"):
+        collection = db[f"{layout}_{uuid.uuid4().hex[:8]}"]
+        if layout == "legacy":
+            collection.create_index("stream_Id", unique=True)
+        else:
+            ensure_bucket_index(collection)
+        try:
+            results["layouts"][layout] = run_layout(collection, layout, args.frames, args.window, args.bucket_size)
+        finally:
+            collection.drop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
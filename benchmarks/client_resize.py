@@ -0,0 +1,204 @@
+"""
+Benchmark sending frames resized to the model input against sending the originals.
+
+Sends every frame to a detector endpoint twice through ``DetectorClient``,
+once as the original JPEG and once resized to ``--input-size`` by
+shared/model_input.py, and reports the bytes sent, the round-trip latency
+percentiles and how well the detections of the resized frames agree with the
+detections of the originals (boxes matched at IoU >= ``--iou``, in original
+frame coordinates).
+
+Without ``--url`` a local stand-in model is started: like the real detectors
+it resizes every image to ``--input-size`` before detecting, here the coloured
+objects drawn into the synthetic frames, and it simulates an upload link of
+``--bandwidth-mbps``. Frames are synthetic 1920x1080 scenes unless
+``--images`` points at a directory of JPEGs, e.g. frames from the extractor.
+
+Usage:
+    python benchmarks/client_resize.py --frames 100 --input-size 640
+    python benchmarks/client_resize.py --url https://...modal.run/ --images ./frames --output resize.json
+"""
+import argparse
+import glob
+import http.server
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lambdas"))
+
+from shared.detector_client import DetectorClient
+
+COLOURS = [(0, 0, 230), (0, 200, 0), (230, 0, 0), (0, 220, 220)]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def synthetic_frames(count, width=1920, height=1080, quality=95, seed=7):
+    """Textured scenes with a few coloured objects, encoded like the extracted frames."""
+    rng = np.random.default_rng(seed)
+    background = cv2.GaussianBlur(rng.integers(60, 140, (height, width, 3), dtype=np.uint8), (0, 0), 3)
+    for _ in range(count):
+        frame = background.copy()
+        for colour in COLOURS[:rng.integers(1, len(COLOURS) + 1)]:
+            w, h = (int(value) for value in rng.integers(60, 360, 2))
+            x, y = int(rng.integers(0, width - w)), int(rng.integers(0, height - h))
+            cv2.rectangle(frame, (x, y), (x + w, y + h), colour, -1)
+        yield cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def image_files(directory, count):
+    for path in sorted(glob.glob(os.path.join(directory, '*.jpg')))[:count]:
+        with open(path, 'rb') as f:
+            yield f.read()
+
+
+def detect_objects(image_data, input_size):
+    """Detect the coloured objects after resizing to the model input, in pixels of the received image."""
+    image = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    height, width = image.shape[:2]
+    factor = min(1.0, input_size / max(height, width))
+    model_input = cv2.resize(image, (round(width * factor), round(height * factor)), interpolation=cv2.INTER_AREA)
+    detections = []
+    for index, colour in enumerate(COLOURS):
+        lower = tuple(max(0, channel - 40) for channel in colour)
+        upper = tuple(min(255, channel + 40) for channel in colour)
+        mask = cv2.inRange(model_input, lower, upper)
+        count, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+        for x, y, w, h, area in stats[1:count]:
+            if area >= 50:
+                bbox = [x / factor, y / factor, (x + w) / factor, (y + h) / factor]
+                detections.append({"bbox": [int(round(value)) for value in bbox], "confidence": 0.9, "class": f"object_{index}"})
+    return detections
+
+
+def start_model_stub(input_size, bandwidth_mbps):
+    """Serve detections of the coloured objects, sleeping for the upload time of each request."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            image_data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if bandwidth_mbps:
+                time.sleep(len(image_data) * 8 / (bandwidth_mbps * 1e6))
+            body = json.dumps(detect_objects(image_data, input_size)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def iou(a, b):
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    return intersection / ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection)
+
+
+def agreement(reference, results, threshold):
+    """Return the matched, missed and extra detections of ``results`` against ``reference``."""
+    reference = [d for d in reference if isinstance(d, dict) and 'bbox' in d] if isinstance(reference, list) else []
+    results = [d for d in results if isinstance(d, dict) and 'bbox' in d] if isinstance(results, list) else []
+    unmatched = list(results)
+    matched = 0
+    for detection in reference:
+        best = max(unmatched, key=lambda other: iou(detection['bbox'], other['bbox']), default=None)
+        if best is not None and best.get('class') == detection.get('class') and iou(detection['bbox'], best['bbox']) >= threshold:
+            unmatched.remove(best)
+            matched += 1
+    return matched, len(reference) - matched, len(unmatched)
+
+
+def run(client, frames):
+    latencies = []
+    results = []
+    for image_data in frames:
+        start = time.perf_counter()
+        results.append(client.detect(image_data))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies, results
+
+
+def summarise(name, client, latencies):
+    stats = client.stats()
+    summary = {
+        "bytes_sent": stats["bytes_sent"],
+        "bytes_per_frame": round(stats["bytes_sent"] / len(latencies)),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p99_ms": round(percentile(latencies, 99), 2)
+    }
+    print(f"{name:9} {summary['bytes_per_frame']:9} bytes/frame p50={summary['p50_ms']:.2f} ms p99={summary['p99_ms']:.2f} ms")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help="Detector endpoint (default: a local stand-in model)")
+    parser.add_argument('--images', help="Directory of JPEG frames (default: synthetic 1920x1080 frames)")
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--input-size', type=int, default=640, help="Longest side of the resized frames")
+    parser.add_argument('--quality', type=int, default=85, help="JPEG quality of the resized frames")
+    parser.add_argument('--bandwidth-mbps', type=float, default=50.0, help="Upload link simulated by the stand-in model")
+    parser.add_argument('--iou', type=float, default=0.5, help="IoU at which detections count as the same")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        server, url = start_model_stub(args.input_size, args.bandwidth_mbps)
+    frames = list(image_files(args.images, args.frames) if args.images else synthetic_frames(args.frames))
+    if not frames:
+        parser.error(f"no frames found in {args.images}")
+
+    try:
+        original = DetectorClient(url, latency_budget=30, hedging=False, input_size=0)
+        resized = DetectorClient(url, latency_budget=30, hedging=False, input_size=args.input_size, input_quality=args.quality)
+        original_latencies, original_results = run(original, frames)
+        resized_latencies, resized_results = run(resized, frames)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    matched = missed = extra = 0
+    for reference, results in zip(original_results, resized_results):
+        counts = agreement(reference, results, args.iou)
+        matched, missed, extra = matched + counts[0], missed + counts[1], extra + counts[2]
+
+    report = {
+        "frames": len(frames),
+        "input_size": args.input_size,
+        "quality": args.quality,
+        "original": summarise("original", original, original_latencies),
+        "resized": summarise("resized", resized, resized_latencies),
+        "agreement": {"matched": matched, "missed": missed, "extra": extra,
+                      "recall": round(matched / (matched + missed), 4) if matched + missed else None}
+    }
+    print(f"bytes sent: {report['resized']['bytes_sent'] / report['original']['bytes_sent']:.1%} of the originals, "
+          f"detections matched: {matched}, missed: {missed}, extra: {extra}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Measure the import time of every Lambda function and fail when one exceeds a startup budget.
+
+Each ``lambda_function.py`` is imported in a fresh interpreter with
+``python -X importtime``, the way the Lambda runtime imports the handler
+during a cold start, with the shared helpers on the path as in the
+deployment package. The cumulative import time of the handler module, the
+slowest imports below it and the heavy dependencies it pulled in are
+reported per function.
+
+Usage:
+    python benchmarks/import_time.py --budget-ms 150 --output import_time.json
+"""
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+
+LAMBDAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lambdas")
+
+# Dependencies that should only be imported by the invocations that use them
+HEAVY_MODULES = ["boto3", "botocore", "cv2", "numpy", "pymongo", "requests"]
+
+
+def find_functions(lambdas_dir=LAMBDAS_DIR):
+    """Return the directories of all Lambda functions below ``lambdas_dir``."""
+    paths = glob.glob(os.path.join(lambdas_dir, "*", "*", "lambda_function.py"))
+    return sorted(os.path.dirname(os.path.abspath(path)) for path in paths)
+
+
+def parse_importtime(output):
+    """Parse ``-X importtime`` output into (module, self_us, cumulative_us, depth) tuples."""
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        module = name.strip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((module, int(self_us), int(cumulative_us), depth))
+    return imports
+
+
+def profile_function(function_dir, lambdas_dir=LAMBDAS_DIR):
+    """Import the handler of a function in a fresh interpreter and return its import profile."""
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(lambdas_dir), PYTHONDONTWRITEBYTECODE="1")
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import lambda_function"],
+        cwd=function_dir, env=env, capture_output=True, text=True
+    )
+    if process.returncode != 0:
+        raise Exception(f"Importing {function_dir} failed:\n{process.stderr}")
+
+    # Children are listed before their parent, so the handler's imports are the nested lines above it
+    imports = parse_importtime(process.stderr)
+    index = max(i for i, entry in enumerate(imports) if entry[0] == "lambda_function" and entry[3] == 0)
+    start = index
+    while start > 0 and imports[start - 1][3] > 0:
+        start -= 1
+    below = imports[start:index]
+    imported = {entry[0] for entry in below}
+    return {
+        "cumulative_ms": imports[index][2] / 1000,
+        "imports": below,
+        "heavy_modules": [module for module in HEAVY_MODULES if module in imported]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the import time of every Lambda function.")
+    parser.add_argument('--budget-ms', type=float, help="Fail when a function takes longer than this to import")
+    parser.add_argument('--repeat', type=int, default=3, help="Imports per function, the fastest one is reported")
+    parser.add_argument('--top', type=int, default=5, help="Number of slowest imports listed per function")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    parser.add_argument('functions', nargs='*', help="Function directories (default: all functions)")
+    args = parser.parse_args()
+
+    results = {}
+    over_budget = []
+    for function_dir in args.functions or find_functions():
+        name = os.path.relpath(os.path.abspath(function_dir), os.path.abspath(LAMBDAS_DIR))
+        profile = min((profile_function(function_dir) for _ in range(args.repeat)), key=lambda p: p["cumulative_ms"])
+
+        # Slowest imports below the handler, by their own import time
+        slowest = sorted(profile["imports"], key=lambda entry: -entry[1])
+        results[name] = {
+            "cumulative_ms": round(profile["cumulative_ms"], 1),
+            "heavy_modules": profile["heavy_modules"],
+            "slowest_imports": [{"module": module, "self_ms": round(self_us / 1000, 1)} for module, self_us, _, _ in slowest[:args.top]]
+        }
+
+        status = ""
+        if args.budget_ms is not None and profile["cumulative_ms"] > args.budget_ms:
+            over_budget.append(name)
+            status = f"  OVER BUDGET ({args.budget_ms:.0f} ms)"
+        print(f"{name}: {profile['cumulative_ms']:.1f} ms{status}")
+        if profile["heavy_modules"]:
+            print(f"    heavy modules: {', '.join(profile['heavy_modules'])}")
+        for entry in results[name]["slowest_imports"]:
+            print(f"    {entry['self_ms']:8.1f} ms  {entry['module']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"budget_ms": args.budget_ms, "functions": results}, f, indent=2)
+
+    if over_budget:
+        print(f"Import time budget exceeded by: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
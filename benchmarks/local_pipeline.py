@@ -0,0 +1,514 @@
+"""
+Run the whole Lambda pipeline in one process and replay events into it.
+
+The ``lambda_handler`` of extract-frame, the dispatcher and the detectors are
+wired together through in-memory queues, like they are through S3
+notifications and SQS in production:
+
+    video event -> extract-frame -> frames-nht notification -+-> dispatcher
+                                                             +-> car-detection     (SQS batches)
+                                                             +-> person-detection  (SQS batches)
+                                                             +-> fall-detection    (SQS batches)
+                                                             +-> fire-detection    (SQS batches)
+
+Every stage runs ``--concurrency`` warm containers, each a separate copy of
+the function module with its own globals, so the write-behind buffers and
+per-stream state are not shared between concurrent invocations. Records a
+detector reports in ``batchItemFailures`` are redelivered until
+``--max-receives``. The Lambda invocations of the dispatcher are recorded,
+not executed. External services are the stand-ins of
+``pipeline_throughput.py`` (moto, stub inference server, in-memory MongoDB).
+
+Events are read from a JSONL file, one event per line, and replayed at
+``--rate`` events per second. A line can be an S3 notification, an SQS event
+carrying S3 notifications, or ``{"stage": "<stage>", "event": {...}}`` to
+target a stage directly. Video keys go to extract-frame, other keys are
+treated as frame notifications. Objects the events refer to that do not exist
+locally are filled with a synthetic video or frame. Without ``--events``,
+``--videos`` synthetic video uploads are replayed.
+
+Throughput, latency, queue wait and queue depth are reported per stage.
+
+Usage:
+    python benchmarks/local_pipeline.py --videos 4 --concurrency car-detection=4
+    python benchmarks/local_pipeline.py --events recorded.jsonl --rate 20 --output run.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import queue
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from pipeline_throughput import (
+    DETECTORS, FRAMES_BUCKET, OUTPUT_BUCKET, VIDEO_BUCKET, BenchContext, InMemoryMongo,
+    clients, load_function, make_video, peak_rss_mb, percentile, start_aws_stand_ins, start_inference_stub
+)
+
+STAGES = {
+    "extract-frame": "common/extract-frame-nht",
+    "dispatcher": "common/dispatcher-lambda-nht",
+    **DETECTORS
+}
+
+# Stages triggered by the SQS queues subscribed to the frames bucket
+SQS_STAGES = set(DETECTORS)
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+
+DEFAULT_CONCURRENCY = {"extract-frame": 1, "dispatcher": 1}
+DEFAULT_DETECTOR_CONCURRENCY = 2
+
+
+def s3_record(bucket, key):
+    return {"eventSource": "aws:s3", "s3": {"bucket": {"name": bucket}, "object": {"key": key}}}
+
+
+class Item:
+    """A record waiting in a stage queue."""
+
+    __slots__ = ('record', 'enqueued', 'receives')
+
+    def __init__(self, record, receives=0):
+        self.record = record
+        self.enqueued = time.perf_counter()
+        self.receives = receives
+
+
+class Stage:
+    """
+    Input queue and warm containers of one function.
+
+    Args:
+        name: Stage name, a key of STAGES
+        containers: Loaded function modules, one per concurrent invocation
+        batch_size: Maximum records per invocation
+        batch_window_ms: Time to wait for a full batch once the first record arrived
+        max_receives: Deliveries of a failing record before it is dropped as dead letter
+    """
+
+    def __init__(self, name, containers, batch_size=1, batch_window_ms=0, max_receives=1):
+        self.name = name
+        self.containers = containers
+        self.batch_size = batch_size
+        self.batch_window = batch_window_ms / 1000
+        self.max_receives = max_receives
+        self.sqs = name in SQS_STAGES
+        self.queue = queue.Queue()
+        self.pipeline = None
+
+        self.invocations = 0
+        self.records = 0
+        self.failures = 0
+        self.dead_letters = 0
+        self.latencies = []
+        self.waits = []
+        self.busy_seconds = 0.0
+        self.first_start = None
+        self.last_end = None
+        self.depths = []
+        self._lock = threading.Lock()
+
+    def put(self, s3_notification, receives=0):
+        """Queue an S3 notification record, wrapped in an SQS message for SQS-triggered stages."""
+        if self.sqs:
+            record = {
+                "messageId": str(uuid.uuid4()),
+                "receiptHandle": uuid.uuid4().hex,
+                "body": json.dumps({"Records": [s3_notification]}),
+                "attributes": {"ApproximateReceiveCount": str(receives + 1)},
+                "eventSource": "aws:sqs"
+            }
+        else:
+            record = s3_notification
+        self.pipeline.started()
+        self.queue.put(Item(record, receives))
+
+    def _requeue(self, item):
+        self.pipeline.started()
+        self.queue.put(Item(item.record, item.receives + 1))
+
+    def _next_batch(self):
+        items = [self.queue.get()]
+        if items[0] is None:
+            return None
+        deadline = time.perf_counter() + self.batch_window
+        while len(items) < self.batch_size:
+            try:
+                timeout = deadline - time.perf_counter()
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Leave the stop marker for this worker's next round
+                self.queue.put(None)
+                break
+            items.append(item)
+        return items
+
+    def _failed(self, items, response):
+        if self.sqs:
+            failed_ids = {failure['itemIdentifier'] for failure in (response or {}).get('batchItemFailures', [])}
+            return [item for item in items if item.record['messageId'] in failed_ids]
+        if response is None or response.get('statusCode') != 200:
+            return items
+        return []
+
+    def _invoke(self, container, items):
+        start = time.perf_counter()
+        try:
+            response = container.lambda_handler({"Records": [item.record for item in items]}, BenchContext())
+        except Exception:
+            response = None
+        end = time.perf_counter()
+
+        failed = self._failed(items, response)
+        with self._lock:
+            self.invocations += 1
+            self.records += len(items)
+            self.failures += len(failed)
+            self.latencies.append((end - start) * 1000)
+            self.waits.extend((start - item.enqueued) * 1000 for item in items)
+            self.busy_seconds += end - start
+            self.first_start = start if self.first_start is None else min(self.first_start, start)
+            self.last_end = end if self.last_end is None else max(self.last_end, end)
+        for item in failed:
+            if item.receives + 1 < self.max_receives:
+                self._requeue(item)
+            else:
+                with self._lock:
+                    self.dead_letters += 1
+
+    def _work(self, container):
+        while True:
+            items = self._next_batch()
+            if items is None:
+                return
+            try:
+                self._invoke(container, items)
+            finally:
+                self.pipeline.finished(len(items))
+
+    def start(self):
+        self.threads = [threading.Thread(target=self._work, args=(container,), name=f"{self.name}-{index}", daemon=True)
+                        for index, container in enumerate(self.containers)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def report(self, wall_seconds):
+        active = (self.last_end - self.first_start) if self.first_start is not None else 0.0
+        return {
+            "concurrency": len(self.containers),
+            "invocations": self.invocations,
+            "records": self.records,
+            "records_per_sec": round(self.records / active, 2) if active else 0.0,
+            "p50_ms": round(statistics.median(self.latencies), 2) if self.latencies else None,
+            "p99_ms": round(percentile(self.latencies, 99), 2) if self.latencies else None,
+            "queue_wait_p50_ms": round(statistics.median(self.waits), 2) if self.waits else None,
+            "queue_wait_p99_ms": round(percentile(self.waits, 99), 2) if self.waits else None,
+            "queue_depth_max": max(self.depths, default=0),
+            "queue_depth_mean": round(statistics.mean(self.depths), 2) if self.depths else 0.0,
+            "utilisation": round(self.busy_seconds / (len(self.containers) * wall_seconds), 3) if wall_seconds else 0.0,
+            "failures": self.failures,
+            "dead_letters": self.dead_letters
+        }
+
+
+class NotifyingS3:
+    """S3 client that notifies the pipeline of every object written to a subscribed bucket."""
+
+    def __init__(self, s3, pipeline, buckets):
+        self._s3 = s3
+        self._pipeline = pipeline
+        self._buckets = set(buckets)
+
+    def put_object(self, **kwargs):
+        response = self._s3.put_object(**kwargs)
+        self._notify(kwargs['Bucket'], kwargs['Key'])
+        return response
+
+    def upload_file(self, filename, bucket, key, *args, **kwargs):
+        self._s3.upload_file(filename, bucket, key, *args, **kwargs)
+        self._notify(bucket, key)
+
+    def upload_fileobj(self, fileobj, bucket, key, *args, **kwargs):
+        self._s3.upload_fileobj(fileobj, bucket, key, *args, **kwargs)
+        self._notify(bucket, key)
+
+    def _notify(self, bucket, key):
+        if bucket in self._buckets:
+            self._pipeline.frame_written(bucket, key)
+
+    def __getattr__(self, name):
+        return getattr(self._s3, name)
+
+
+class LocalPipeline:
+    """Stages connected like the deployed functions, with a counter of records still in flight."""
+
+    def __init__(self, stages):
+        self.stages = stages
+        for stage in stages.values():
+            stage.pipeline = self
+        self._in_flight = 0
+        self._idle = threading.Condition()
+
+    def started(self):
+        with self._idle:
+            self._in_flight += 1
+
+    def finished(self, count):
+        with self._idle:
+            self._in_flight -= count
+            if self._in_flight == 0:
+                self._idle.notify_all()
+
+    def frame_written(self, bucket, key):
+        """Fan a frames bucket notification out to every frame-triggered stage."""
+        for name, stage in self.stages.items():
+            if name != "extract-frame":
+                stage.put(s3_record(bucket, key))
+
+    def submit(self, stage_name, s3_notification):
+        """Route a replayed S3 notification to ``stage_name``, or by its key when None."""
+        if stage_name is None:
+            key = s3_notification['s3']['object']['key']
+            if key.lower().endswith(VIDEO_EXTENSIONS):
+                stage_name = "extract-frame"
+            else:
+                self.frame_written(s3_notification['s3']['bucket']['name'], key)
+                return
+        if stage_name in self.stages:
+            self.stages[stage_name].put(s3_notification)
+
+    def wait_idle(self, timeout=None):
+        with self._idle:
+            return self._idle.wait_for(lambda: self._in_flight == 0, timeout)
+
+    def sample_depths(self):
+        for stage in self.stages.values():
+            stage.depths.append(stage.queue.qsize())
+
+    def start(self):
+        for stage in self.stages.values():
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages.values():
+            stage.stop()
+
+
+def parse_event_line(line):
+    """
+    Return ``(stage, [S3 notification records])`` of a JSONL event line.
+
+    ``stage`` is None unless the line names it explicitly.
+    """
+    event = json.loads(line)
+    stage = None
+    if 'stage' in event and 'event' in event:
+        stage, event = event['stage'], event['event']
+
+    notifications = []
+    for record in event.get('Records', []):
+        if 's3' in record:
+            notifications.append(record)
+        elif 'body' in record:
+            notifications.extend(record_ for record_ in json.loads(record['body']).get('Records', []) if 's3' in record_)
+    return stage, notifications
+
+
+def read_events(path):
+    with open(path) as f:
+        return [parse_event_line(line) for line in f if line.strip()]
+
+
+class SyntheticObjects:
+    """Uploads a synthetic video or frame for replayed objects missing from the local S3."""
+
+    def __init__(self, directory, frames, width, height, fps, scene_every):
+        import cv2
+        import numpy as np
+
+        self.video_path = os.path.join(directory, "replay.mp4")
+        make_video(self.video_path, frames, width, height, fps, scene_every)
+        frame = np.random.default_rng(1).integers(0, 255, (height, width, 3), dtype=np.uint8)
+        self.frame = cv2.imencode('.jpg', frame)[1].tobytes()
+        self._buckets = set()
+
+    def ensure(self, s3, bucket, key):
+        if bucket not in self._buckets:
+            with contextlib.suppress(s3.exceptions.BucketAlreadyOwnedByYou):
+                s3.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': 'ap-south-1'})
+            self._buckets.add(bucket)
+        try:
+            s3.head_object(Bucket=bucket, Key=key)
+        except s3.exceptions.ClientError:
+            if key.lower().endswith(VIDEO_EXTENSIONS):
+                s3.upload_file(self.video_path, bucket, key)
+            else:
+                s3.put_object(Bucket=bucket, Key=key, Body=self.frame, ContentType='image/jpeg')
+
+
+def synthetic_events(videos):
+    return [(None, [s3_record(VIDEO_BUCKET, f"replay-{uuid.uuid4().hex[:8]}.mp4")]) for _ in range(videos)]
+
+
+def replay(pipeline, events, rate, repeat):
+    """Submit the events at ``rate`` events per second (as fast as possible when 0) and return the count."""
+    submitted = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for stage, notifications in events:
+            if rate:
+                delay = start + submitted / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            for notification in notifications:
+                pipeline.submit(stage, notification)
+            submitted += 1
+    return submitted
+
+
+def build_stages(names, concurrency, batch_size, batch_window_ms, max_receives, inference_url):
+    stages = {}
+    for name in names:
+        containers = []
+        for index in range(concurrency.get(name, DEFAULT_CONCURRENCY.get(name, DEFAULT_DETECTOR_CONCURRENCY))):
+            module = load_function(STAGES[name], f"{name}-{index}")
+            if hasattr(module, 'MODAL_URL'):
+                module.MODAL_URL = inference_url
+            containers.append(module)
+        if name in SQS_STAGES:
+            stages[name] = Stage(name, containers, batch_size, batch_window_ms, max_receives)
+        else:
+            # Asynchronous invocations are retried twice by Lambda
+            stages[name] = Stage(name, containers, max_receives=3)
+    return stages
+
+
+def parse_concurrency(values):
+    concurrency = {}
+    for value in values or []:
+        name, _, count = value.partition('=')
+        if name not in STAGES or not count.isdigit() or int(count) < 1:
+            raise argparse.ArgumentTypeError(f"expected <stage>=<containers>, got {value!r}")
+        concurrency[name] = int(count)
+    return concurrency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', help="JSONL file of S3/SQS events to replay (default: synthetic video uploads)")
+    parser.add_argument('--videos', type=int, default=2, help="Synthetic video uploads replayed without --events")
+    parser.add_argument('--rate', type=float, default=0.0, help="Replayed events per second (default: as fast as possible)")
+    parser.add_argument('--repeat', type=int, default=1, help="Replay the events this many times")
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), help="Stages to run (default: all)")
+    parser.add_argument('--concurrency', nargs='+', metavar='STAGE=N',
+                        help=f"Containers per stage (default: 1 for extract-frame and dispatcher, {DEFAULT_DETECTOR_CONCURRENCY} per detector)")
+    parser.add_argument('--batch-size', type=int, default=10, help="SQS batch size of the detectors")
+    parser.add_argument('--batch-window-ms', type=float, default=0.0, help="SQS batching window of the detectors")
+    parser.add_argument('--max-receives', type=int, default=3, help="Deliveries of a failing SQS record before it is dropped")
+    parser.add_argument('--frames', type=int, default=60, help="Frames of the synthetic video")
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=360)
+    parser.add_argument('--fps', type=int, default=15)
+    parser.add_argument('--scene-every', type=int, default=3, help="Frames between scene changes, which the extractor keeps")
+    parser.add_argument('--inference-latency-ms', type=float, default=20.0, help="Delay of the stub inference server")
+    parser.add_argument('--mongo-uri', default=os.environ.get('BENCH_MONGO_URI'), help="Local mongod (default: in-memory stand-in)")
+    parser.add_argument('--sample-interval-ms', type=float, default=100.0, help="Queue depth sampling interval")
+    parser.add_argument('--timeout', type=float, default=600.0, help="Give up waiting for the queues to drain after this many seconds")
+    parser.add_argument('--verbose', action='store_true', help="Show the output of the functions")
+    parser.add_argument('--output', help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    try:
+        concurrency = parse_concurrency(args.concurrency)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    events = read_events(args.events) if args.events else synthetic_events(args.videos)
+
+    os.environ['OUTPUT_BUCKET_NAME'] = OUTPUT_BUCKET
+    if args.mongo_uri:
+        os.environ['MONGO_URI'] = args.mongo_uri
+        os.environ.setdefault('MONGO_DB_NAME', 'lambda_outputs_bench')
+    else:
+        clients.set_client("mongo", InMemoryMongo())
+
+    moto_server = start_aws_stand_ins()
+    inference_server, inference_url = start_inference_stub(args.inference_latency_ms)
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    try:
+        stages = build_stages(args.stages or list(STAGES), concurrency, args.batch_size, args.batch_window_ms,
+                              args.max_receives, inference_url)
+        pipeline = LocalPipeline(stages)
+        s3 = clients.get_s3_client()
+        with tempfile.TemporaryDirectory() as directory:
+            objects = SyntheticObjects(directory, args.frames, args.width, args.height, args.fps, args.scene_every)
+            for _, notifications in events:
+                for notification in notifications:
+                    objects.ensure(s3, notification['s3']['bucket']['name'], notification['s3']['object']['key'])
+        clients.set_client("s3", NotifyingS3(s3, pipeline, [FRAMES_BUCKET]))
+
+        stop_sampling = threading.Event()
+
+        def sample():
+            while not stop_sampling.wait(args.sample_interval_ms / 1000):
+                pipeline.sample_depths()
+
+        sampler = threading.Thread(target=sample, name="queue-sampler", daemon=True)
+        with quiet:
+            pipeline.start()
+            sampler.start()
+            start = time.perf_counter()
+            submitted = replay(pipeline, events, args.rate, args.repeat)
+            replay_seconds = time.perf_counter() - start
+            drained = pipeline.wait_idle(args.timeout)
+            wall_seconds = time.perf_counter() - start
+            stop_sampling.set()
+            sampler.join()
+            pipeline.stop()
+    finally:
+        inference_server.shutdown()
+        moto_server.stop()
+
+    report = {
+        "config": {key: getattr(args, key) for key in ("events", "videos", "rate", "repeat", "batch_size",
+                                                       "batch_window_ms", "max_receives", "inference_latency_ms")},
+        "mongo": "mongod" if args.mongo_uri else "in-memory",
+        "events": submitted,
+        "replay_rate": round(submitted / replay_seconds, 2) if replay_seconds else None,
+        "seconds": round(wall_seconds, 3),
+        "drained": drained,
+        "dispatcher_invocations": len(clients.get_lambda_client().invocations),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "stages": {name: stage.report(wall_seconds) for name, stage in stages.items()}
+    }
+
+    print(f"{submitted} events in {report['seconds']} s (replayed at {report['replay_rate']} events/s), "
+          f"peak_rss={report['peak_rss_mb']} MB" + ("" if drained else ", queues NOT drained"))
+    for name, result in report["stages"].items():
+        print(f"{name:18} x{result['concurrency']:<3} records={result['records']:6} {result['records_per_sec']:8.2f} records/s "
+              f"p50={result['p50_ms']} ms p99={result['p99_ms']} ms wait_p99={result['queue_wait_p99_ms']} ms "
+              f"queue max={result['queue_depth_max']} mean={result['queue_depth_mean']} "
+              f"util={result['utilisation']} failures={result['failures']} dlq={result['dead_letters']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0 if drained else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,388 @@
+"""
+Offline end-to-end throughput benchmark of the Lambda pipeline.
+
+A synthetic video is generated and pushed through extract-frame, the
+dispatcher and every detector, with all external services replaced by local
+stand-ins:
+
+- S3 and SQS: a moto server on localhost (pip install "moto[server]")
+- Inference: a stub HTTP server answering like the Modal endpoints after a
+  configurable delay
+- MongoDB: a local mongod when --mongo-uri is given, otherwise an in-memory
+  collection that acknowledges the bulk writes
+- Lambda invocations of the dispatcher: recorded, not executed
+
+Frames/sec, p50/p99 latency per stage and the peak RSS of the process are
+printed and written as JSON, so two runs can be diffed with --baseline.
+
+Usage:
+    python benchmarks/pipeline_throughput.py --frames 300 --output pipeline.json
+    python benchmarks/pipeline_throughput.py --frames 300 --baseline pipeline.json
+"""
+import argparse
+import contextlib
+import http.server
+import importlib.util
+import json
+import logging
+import os
+import resource
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+LAMBDAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lambdas")
+sys.path.insert(0, LAMBDAS_DIR)
+
+from shared import clients
+
+VIDEO_BUCKET = "videos-bench"
+FRAMES_BUCKET = "frames-nht"  # output bucket hard-coded in extract-frame
+OUTPUT_BUCKET = "final-output-bench"
+
+DETECTORS = {
+    "car-detection": "stateful/car-detection-nht",
+    "person-detection": "stateful/person-detection-nht",
+    "fall-detection": "stateless/fall-detection-nht",
+    "fire-detection": "stateless/fire-detection-nht",
+}
+
+# Detection returned by the stub inference server
+STUB_DETECTION = [{"bbox": [120, 80, 260, 200], "confidence": 0.9, "class": "car", "track_id": 1}]
+
+
+class BenchContext:
+    """Lambda context with a fixed time budget per invocation."""
+
+    def __init__(self, remaining_ms=900000):
+        self.deadline = time.monotonic() + remaining_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+class InMemoryCollection:
+    def __init__(self, db_name, name):
+        self.name = name
+        self.full_name = f"{db_name}.{name}"
+        self.operations = 0
+
+    def bulk_write(self, requests, ordered=True):
+        self.operations += len(requests)
+
+        class Result:
+            acknowledged = True
+            matched_count = modified_count = 0
+            upserted_count = len(requests)
+
+        return Result()
+
+
+class InMemoryMongo:
+    """Acknowledges every bulk write; used when no mongod is available."""
+
+    def __init__(self):
+        self._collections = {}
+
+    def __getitem__(self, db_name):
+        mongo = self
+
+        class Database:
+            def __getitem__(self, name):
+                return mongo._collections.setdefault(name, InMemoryCollection(db_name, name))
+
+        return Database()
+
+
+class RecordingLambda:
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.invocations.append(FunctionName)
+        return {"StatusCode": 202}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_inference_stub(latency_ms):
+    """Serve Modal-style detection responses after ``latency_ms``."""
+    body = json.dumps(STUB_DETECTION).encode()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(latency_ms / 1000)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def start_aws_stand_ins():
+    """Start a moto server and point the shared S3, SQS and Lambda clients at it."""
+    import boto3
+    from moto.server import ThreadedMotoServer
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-south-1')
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    port = free_port()
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port)
+    server.start()
+    endpoint = f"http://127.0.0.1:{port}"
+    for service in ("s3", "sqs"):
+        clients.set_client(service, boto3.client(service, endpoint_url=endpoint, region_name='ap-south-1'))
+    clients.set_client("lambda", RecordingLambda())
+
+    s3 = clients.get_s3_client()
+    for bucket in (VIDEO_BUCKET, FRAMES_BUCKET, OUTPUT_BUCKET):
+        s3.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': 'ap-south-1'})
+    return server
+
+
+def make_video(path, frames, width, height, fps, scene_every):
+    """Write a synthetic video with a moving box over a background that changes every ``scene_every`` frames."""
+    import cv2
+    import numpy as np
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    rng = np.random.default_rng(0)
+    background = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+    for index in range(frames):
+        if index and index % scene_every == 0:
+            background = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+        frame = background.copy()
+        x = (index * 7) % max(1, width - 80)
+        cv2.rectangle(frame, (x, height // 3), (x + 80, height // 3 + 60), (0, 0, 255), -1)
+        writer.write(frame)
+    writer.release()
+
+
+def load_function(relative_path, name):
+    """Import a lambda_function.py under a unique module name."""
+    path = os.path.join(LAMBDAS_DIR, relative_path, "lambda_function.py")
+    spec = importlib.util.spec_from_file_location(f"bench_{name.replace('-', '_')}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarise(frames, seconds, latencies, failures=0):
+    return {
+        "frames": frames,
+        "seconds": round(seconds, 3),
+        "frames_per_sec": round(frames / seconds, 2) if seconds else 0.0,
+        "p50_ms": round(statistics.median(latencies), 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99), 2) if latencies else None,
+        "failures": failures,
+        "peak_rss_mb": round(peak_rss_mb(), 1)
+    }
+
+
+def s3_event(bucket, key):
+    return {"Records": [{"s3": {"bucket": {"name": bucket}, "object": {"key": key}}}]}
+
+
+def run_extract(video_path, quiet):
+    module = load_function("common/extract-frame-nht", "extract-frame")
+    key = f"bench-{uuid.uuid4().hex[:8]}.mp4"
+    clients.get_s3_client().upload_file(video_path, VIDEO_BUCKET, key)
+
+    # Time every frame upload, the per-frame unit of work of the extractor
+    latencies = []
+    upload = module.upload_frame_to_s3
+
+    def timed_upload(*args, **kwargs):
+        start = time.perf_counter()
+        key = upload(*args, **kwargs)
+        latencies.append((time.perf_counter() - start) * 1000)
+        return key
+
+    module.upload_frame_to_s3 = timed_upload
+    start = time.perf_counter()
+    with quiet():
+        response = module.lambda_handler(s3_event(VIDEO_BUCKET, key), BenchContext())
+    seconds = time.perf_counter() - start
+    if response['statusCode'] != 200:
+        raise Exception(f"extract-frame failed: {response['body']}")
+
+    frames_read = json.loads(response['body'])['frames_processed'] + 1
+    prefix = os.path.splitext(key)[0] + "/"
+    paginator = clients.get_s3_client().get_paginator('list_objects_v2')
+    frame_keys = [obj['Key'] for page in paginator.paginate(Bucket=FRAMES_BUCKET, Prefix=prefix) for obj in page.get('Contents', [])]
+
+    result = summarise(frames_read, seconds, latencies)
+    result["frames_uploaded"] = len(frame_keys)
+    return result, sorted(frame_keys)
+
+
+def run_dispatcher(frame_keys, quiet):
+    module = load_function("common/dispatcher-lambda-nht", "dispatcher")
+    latencies = []
+    start = time.perf_counter()
+    with quiet():
+        for key in frame_keys:
+            invoke_start = time.perf_counter()
+            module.lambda_handler(s3_event(FRAMES_BUCKET, key), BenchContext())
+            latencies.append((time.perf_counter() - invoke_start) * 1000)
+    return summarise(len(frame_keys), time.perf_counter() - start, latencies)
+
+
+def queue_frames(frame_keys):
+    """Send the S3 events of the frames through a fresh SQS queue and return them as Lambda batches."""
+    sqs = clients.get_sqs_client()
+    queue_url = sqs.create_queue(QueueName=f"bench-{uuid.uuid4().hex[:8]}")['QueueUrl']
+    for start in range(0, len(frame_keys), 10):
+        entries = [{"Id": str(index), "MessageBody": json.dumps(s3_event(FRAMES_BUCKET, key))}
+                   for index, key in enumerate(frame_keys[start:start + 10])]
+        sqs.send_message_batch(QueueUrl=queue_url, Entries=entries)
+
+    batches = []
+    received = 0
+    while received < len(frame_keys):
+        messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=1).get('Messages', [])
+        if not messages:
+            break
+        received += len(messages)
+        batches.append([{"messageId": message['MessageId'], "receiptHandle": message['ReceiptHandle'],
+                         "body": message['Body']} for message in messages])
+    sqs.delete_queue(QueueUrl=queue_url)
+    return batches
+
+
+def run_detector(name, relative_path, frame_keys, inference_url, quiet):
+    module = load_function(relative_path, name)
+    if hasattr(module, 'MODAL_URL'):
+        module.MODAL_URL = inference_url
+
+    # Time every record, the per-frame unit of work of the detectors
+    latencies = []
+    process_record = module.process_record
+
+    def timed_process_record(record):
+        start = time.perf_counter()
+        try:
+            return process_record(record)
+        finally:
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    module.process_record = timed_process_record
+    batches = queue_frames(frame_keys)
+    failures = 0
+    start = time.perf_counter()
+    with quiet():
+        for records in batches:
+            response = module.lambda_handler({"Records": records}, BenchContext())
+            failures += len(response.get('batchItemFailures', []))
+    return summarise(sum(len(records) for records in batches), time.perf_counter() - start, latencies, failures)
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nChange against {baseline_path}:")
+    for stage, result in results["stages"].items():
+        previous = baseline.get("stages", {}).get(stage)
+        if not previous:
+            continue
+        changes = []
+        for metric in ("frames_per_sec", "p50_ms", "p99_ms", "peak_rss_mb"):
+            if result.get(metric) is not None and previous.get(metric):
+                changes.append(f"{metric} {100 * (result[metric] - previous[metric]) / previous[metric]:+.1f}%")
+        print(f"  {stage:18} {', '.join(changes)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=150, help="Frames in the synthetic video")
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=360)
+    parser.add_argument('--fps', type=int, default=15)
+    parser.add_argument('--scene-every', type=int, default=3, help="Frames between scene changes, which the extractor keeps")
+    parser.add_argument('--inference-latency-ms', type=float, default=20.0, help="Delay of the stub inference server")
+    parser.add_argument('--mongo-uri', default=os.environ.get('BENCH_MONGO_URI'), help="Local mongod (default: in-memory stand-in)")
+    parser.add_argument('--stages', nargs='+', choices=["extract-frame", "dispatcher", *DETECTORS], help="Stages to run (default: all)")
+    parser.add_argument('--verbose', action='store_true', help="Show the output of the functions")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    parser.add_argument('--baseline', help="Earlier JSON output to compare against")
+    args = parser.parse_args()
+
+    stages = args.stages or ["extract-frame", "dispatcher", *DETECTORS]
+
+    def quiet():
+        if args.verbose:
+            return contextlib.nullcontext()
+        return contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+    os.environ['OUTPUT_BUCKET_NAME'] = OUTPUT_BUCKET
+    if args.mongo_uri:
+        os.environ['MONGO_URI'] = args.mongo_uri
+        os.environ.setdefault('MONGO_DB_NAME', 'lambda_outputs_bench')
+    else:
+        clients.set_client("mongo", InMemoryMongo())
+
+    moto_server = start_aws_stand_ins()
+    inference_server, inference_url = start_inference_stub(args.inference_latency_ms)
+    results = {
+        "config": {key: getattr(args, key) for key in ("frames", "width", "height", "fps", "scene_every", "inference_latency_ms")},
+        "mongo": "mongod" if args.mongo_uri else "in-memory",
+        "stages": {}
+    }
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            video_path = os.path.join(directory, "bench.mp4")
+            make_video(video_path, args.frames, args.width, args.height, args.fps, args.scene_every)
+            extract, frame_keys = run_extract(video_path, quiet)
+        if "extract-frame" in stages:
+            results["stages"]["extract-frame"] = extract
+        if "dispatcher" in stages:
+            results["stages"]["dispatcher"] = run_dispatcher(frame_keys, quiet)
+        for name, relative_path in DETECTORS.items():
+            if name in stages:
+                results["stages"][name] = run_detector(name, relative_path, frame_keys, inference_url, quiet)
+    finally:
+        inference_server.shutdown()
+        moto_server.stop()
+
+    for stage, result in results["stages"].items():
+        print(f"{stage:18} frames={result['frames']:6} {result['frames_per_sec']:8.2f} frames/s "
+              f"p50={result['p50_ms']} ms p99={result['p99_ms']} ms failures={result['failures']} "
+              f"peak_rss={result['peak_rss_mb']} MB")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,31 @@
-import boto3
 import json
 
-# Initialize the Lambda client
-lambda_client = boto3.client('lambda')
+from shared.clients import get_lambda_client
+from shared.frame_ladder import is_ladder_key
+from shared.instrumentation import Metrics, get_logger, start_invocation
+from shared.profiling import profiled
 
+logger = get_logger('dispatcher')
+metrics = Metrics()
+
+@profiled
 def lambda_handler(event, context):
     """
     Dispatcher function to invoke other Lambda functions when an S3 event occurs.
     """
-    # Log the incoming S3 event
-    print("Received S3 event:", json.dumps(event))
+    start_invocation()
+    logger.debug("Received S3 event with %d records", len(event.get('Records', [])))
+
+    # Resized copies of the frame ladder are not dispatched to the detectors
+    keys = [record.get('s3', {}).get('object', {}).get('key', '') for record in event.get('Records', [])]
+    if keys and all(is_ladder_key(key) for key in keys):
+        logger.debug("Skipping resized frames %s", keys)
+        return {
+            "statusCode": 200,
+            "body": "No frames to dispatch"
+        }
+
+    payload = json.dumps(event)
     
     # List of target Lambda functions to invoke
     target_functions = [
@@ -21,15 +37,18 @@ def lambda_handler(event, context):
     # Loop through and invoke each Lambda function asynchronously
     for function_arn in target_functions:
         try:
-            response = lambda_client.invoke(
-                FunctionName=function_arn,
-                InvocationType='Event',  # Async invocation
-                Payload=json.dumps(event)  # Pass the S3 event as payload
-            )
-            print(f"Successfully invoked {function_arn}: {response['StatusCode']}")
+            with metrics.stage('invoke'):
+                response = get_lambda_client().invoke(
+                    FunctionName=function_arn,
+                    InvocationType='Event',  # Async invocation
+                    Payload=payload  # Pass the S3 event as payload
+                )
+            logger.debug("Successfully invoked %s: %s", function_arn, response['StatusCode'])
         except Exception as e:
-            print(f"Failed to invoke {function_arn}: {str(e)}")
-    
+            metrics.count('invoke_failures')
+            logger.error("Failed to invoke %s: %s", function_arn, e)
+
+    metrics.flush()
     return {
         "statusCode": 200,
         "body": "Dispatcher executed successfully"
@@ -1,11 +1,27 @@
-import cv2
 import json
-import boto3
 import os
-import numpy as np
 
-# Initialize S3 client
-s3_client = boto3.client('s3')
+from shared.clients import get_lambda_client, get_s3_client, lazy_import
+from shared.frame_ladder import ladder_frames, ladder_key
+from shared.frame_manifest import DETECTOR_QUEUE_URLS, ManifestPublisher
+from shared.frame_selector import FRAME_BUDGET_PER_MINUTE, FrameSelector, motion_energy
+from shared.instrumentation import Metrics, get_logger, start_invocation
+from shared.motion_regions import MOTION_CROPS_ENABLED, changed_regions
+from shared.profiling import profiled
+from shared.roi import region_for
+from shared.sqs_batch import get_remaining_time_ms
+from shared.stream_state import (SEGMENT_INGEST, StreamStateError, decode_thumbnail, encode_thumbnail,
+                                 frame_thumbnail, is_stream_state_key, load_stream_state, save_stream_state,
+                                 segment_stream_id)
+from shared.video_checkpoints import (CHECKPOINT_EVERY_FRAMES, CHECKPOINT_MARGIN_MS, fingerprints_match,
+                                      frame_fingerprint, is_checkpoint_key, load_checkpoint, object_etag,
+                                      save_checkpoint)
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+logger = get_logger('extract_frame')
+metrics = Metrics()
 
 def calculate_mad(frame1, frame2):
     """Calculate Mean Absolute Difference (MAD) between two frames"""
@@ -23,11 +39,13 @@ def calculate_ssim(frame1, frame2):
     result = cv2.matchTemplate(gray_frame1, gray_frame2, cv2.TM_CCOEFF_NORMED)
     return result[0][0]  # This gives the similarity score
 
-def compare_frames(frame1, frame2):
+def compare_frames(frame1, frame2, roi=None):
     """
     Calculate and return metrics between two frames:
     - Mean Absolute Difference (MAD)
     - Structural Similarity Index (SSIM)
+
+    With a region of interest only the pixels inside its polygons are compared.
     """
     # Ensure both frames have 3 channels (RGB)
     if frame1.shape[-1] > 3:
@@ -38,7 +56,14 @@ def compare_frames(frame1, frame2):
     if frame1.shape != frame2.shape:
         frame2 = cv2.resize(frame2, (frame1.shape[1], frame1.shape[0]))
 
-    mad = calculate_mad(frame1, frame2)
+    area_ratio = 1.0
+    if roi is not None:
+        _, _, area_ratio = roi.mask(frame1.shape)
+        frame1 = roi.apply(frame1)
+        frame2 = roi.apply(frame2)
+
+    # Pixels blanked outside the polygons do not differ, so scale the mean to the masked area
+    mad = calculate_mad(frame1, frame2) * area_ratio
     ssim_value = calculate_ssim(frame1, frame2)
 
     return {
@@ -46,106 +71,346 @@ def compare_frames(frame1, frame2):
         "ssim": float(ssim_value)
     }
 
-def upload_frame_to_s3(frame, bucket, frame_count, video_file_name):
+def put_jpeg(frame_bgr, bucket, key, extra_args):
+    """Encode a BGR frame as JPEG and upload it; returns the ETag of the object."""
+    with metrics.stage('encode'):
+        _, buffer = cv2.imencode('.jpg', frame_bgr)
+
+    with metrics.stage('upload'):
+        response = get_s3_client().put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=buffer.tobytes(),
+            ContentType='image/jpeg',
+            **extra_args
+        )
+    return (response or {}).get('ETag')
+
+def frame_key(folder_name, frame_count):
+    """Key of a frame in the folder of its video or stream."""
+    return f"{folder_name}/frame_{frame_count:04d}.jpg"
+
+def upload_frame_to_s3(frame, bucket, frame_count, video_file_name, roi=None, key=None):
     """
     Convert and upload a frame directly to S3. 
-    Creates a folder based on the video file name.
+    Creates a folder based on the video file name, unless the key is given.
+    Frames of streams whose region of interest asks for it are cropped to it.
+    With a frame ladder the resized copies are uploaded first.
+    Returns the key and the ETag of the frame.
     """
-    # Extract base name (without extension) from the video file name
-    folder_name = os.path.splitext(video_file_name)[0]
+    if key is None:
+        # Extract base name (without extension) from the video file name
+        key = frame_key(os.path.splitext(video_file_name)[0], frame_count)
+
+    extra_args = {}
+    if roi is not None and roi.crop:
+        frame, (x, y) = roi.crop_frame(frame)
+        extra_args['Metadata'] = {'roi-x': str(x), 'roi-y': str(y)}
 
-    # Convert frame to BGR and encode as JPEG
-    frame_bgr = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-    _, buffer = cv2.imencode('.jpg', frame_bgr)
+    # Convert frame to BGR once for every size
+    with metrics.stage('encode'):
+        frame_bgr = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+
+    # Smaller sizes first, so they exist when the detectors hear of the full frame
+    with metrics.stage('resize'):
+        rungs = list(ladder_frames(frame_bgr))
+    for rung, resized in rungs:
+        put_jpeg(resized, bucket, ladder_key(key, rung), extra_args)
 
     # Upload the frame to S3 using the folder name
-    s3_client.put_object(
-        Bucket=bucket,
-        Key=f"{folder_name}/frame_{frame_count:04d}.jpg",
-        Body=buffer.tobytes(),
-        ContentType='image/jpeg'
-    )
+    frame_etag = put_jpeg(frame_bgr, bucket, key, extra_args)
+    metrics.count('frames_uploaded')
+    return key, frame_etag
+
 
 
+def read_frame(cap):
+    """Decode the next frame as RGB, or return None at the end of the video."""
+    with metrics.stage('decode'):
+        ret, frame = cap.read()
+        if ret:
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    return None
+
+def resume_capture(video_path, frame_index, fingerprint):
+    """Open the video positioned after ``frame_index`` and return the capture and that frame."""
+    cap = cv2.VideoCapture(video_path)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+    frame = read_frame(cap)
+    if frame is not None and fingerprints_match(frame_fingerprint(frame), fingerprint):
+        return cap, frame
+
+    # Seeking is not frame-accurate for every codec, so walk up to the frame instead
+    logger.info("Seek to frame %d did not match the checkpoint, decoding from the start", frame_index)
+    cap.release()
+    cap = cv2.VideoCapture(video_path)
+    for _ in range(frame_index):
+        if not cap.grab():
+            break
+    frame = read_frame(cap)
+    if frame is None:
+        raise Exception(f"The video has no frame {frame_index} to resume from")
+    if not fingerprints_match(frame_fingerprint(frame), fingerprint):
+        logger.warning("Frame %d does not match the checkpoint; resuming anyway", frame_index)
+    return cap, frame
+
+def continue_in_new_invocation(context, input_bucket, input_key):
+    """Invoke this function again for the video, which resumes from its checkpoint."""
+    function_name = getattr(context, 'invoked_function_arn', None) or getattr(context, 'function_name', None)
+    if not function_name:
+        return False
+    try:
+        get_lambda_client().invoke(
+            FunctionName=function_name,
+            InvocationType='Event',
+            Payload=json.dumps({"Records": [{"s3": {"bucket": {"name": input_bucket}, "object": {"key": input_key}}}]})
+        )
+        return True
+    except Exception as e:
+        logger.error("Failed to hand %s over to a new invocation - %s", input_key, e)
+        return False
 
-def process_video(input_bucket, input_key, output_bucket):
+def process_video(input_bucket, input_key, output_bucket, context=None):
     """
     Process video frame by frame and calculate metrics between consecutive frames.
 
+    Progress is checkpointed (see shared/video_checkpoints.py), so a retry
+    resumes where the last invocation stopped. Shortly before the invocation
+    times out the rest of the video is handed over to a new invocation.
+
+    With ``SEGMENT_INGEST`` the video is the next segment of a live stream
+    (see shared/stream_state.py): its frames are numbered on from the last
+    segment, and its first frame is compared with the last one of that segment.
+
     Args:
         input_bucket: S3 bucket containing input video
         input_key: S3 key of input video
         output_bucket: S3 bucket for output frames and metrics
+        context: Lambda context, used for the remaining invocation time
+
+    Returns:
+        The metrics of the frames compared in this invocation, and whether the video is complete.
     """
     # Extract filename from the input_key
     file_name = input_key.split('/')[-1]
     video_path = f'/tmp/{file_name}'
+
+    etag = get_s3_client().head_object(Bucket=input_bucket, Key=input_key)['ETag']
+    checkpoint = load_checkpoint(input_bucket, input_key, etag) or {}
+    if checkpoint.get('done'):
+        logger.info("%s was already processed", input_key)
+        return [], True
+
+    # Segments continue the frame numbers and the comparison of their stream
+    stream_id = os.path.splitext(file_name)[0]
+    stream_state = {}
+    if SEGMENT_INGEST:
+        stream_id = segment_stream_id(input_key)
+        stream_state = load_stream_state(input_bucket, stream_id) or {}
+        if stream_state.get('last_segment') == input_key:
+            # The stream moved past this segment before its checkpoint was written
+            logger.info("%s was already processed", input_key)
+            save_checkpoint(input_bucket, input_key, {"etag": etag, "clean": True, "done": True})
+            return [], True
+    frame_offset = checkpoint.get('frame_offset', stream_state.get('next_frame', 0))
+    last_thumbnail = None
+    if stream_state.get('thumbnail') and not checkpoint.get('next_frame'):
+        last_thumbnail = decode_thumbnail(stream_state['thumbnail'])
     
     # Download video from S3
-    s3_client.download_file(input_bucket, input_key, video_path)
+    with metrics.stage('download'):
+        get_s3_client().download_file(input_bucket, input_key, video_path)
 
-    cap = cv2.VideoCapture(video_path)
     metrics_list = []
-    frame_count = 0
+    frame_count = checkpoint.get('next_frame', 0)
     previous_frame = None
+    if frame_count:
+        cap, previous_frame = resume_capture(video_path, frame_count - 1, checkpoint.get('previous_fingerprint'))
+        logger.info("Resuming %s at frame %d", input_key, frame_count)
+    else:
+        cap = cv2.VideoCapture(video_path)
+
+    # Region of interest of the stream, if one is configured
+    roi = region_for(input_key)
+
+    # With a frame budget the adaptive selector replaces the fixed upload rule
+    selector = None
+    if FRAME_BUDGET_PER_MINUTE > 0:
+        selector = FrameSelector(fps=cap.get(cv2.CAP_PROP_FPS))
+        if checkpoint.get('selector') or stream_state.get('selector'):
+            selector.restore(checkpoint.get('selector') or stream_state['selector'])
+
+    # Announce the uploaded frames to the detector queues in batched manifests
+    publisher = None
+    if DETECTOR_QUEUE_URLS:
+        publisher = ManifestPublisher(output_bucket, input_key, stream_id)
+
+    # Frames after a periodic checkpoint may have been uploaded before the invocation died
+    dedupe_until = -1
+    if checkpoint and not checkpoint.get('clean'):
+        dedupe_until = frame_count + CHECKPOINT_EVERY_FRAMES
 
+    # Last frame uploaded in this invocation, which the detectors inferred the frame after against
+    last_uploaded = None
+
+    def upload(frame, number, frame_metrics=None):
+        nonlocal last_uploaded
+        key = frame_key(stream_id, number)
+        frame_etag = None
+        if number - frame_offset < dedupe_until:
+            frame_etag = object_etag(output_bucket, key)
+        if frame_etag is not None:
+            metrics.count('frames_deduplicated')
+        else:
+            _, frame_etag = upload_frame_to_s3(frame, output_bucket, number, file_name, roi, key=key)
+        if MOTION_CROPS_ENABLED and frame_metrics is not None and last_uploaded is not None:
+            # The detectors send crops of the regions changed since the last uploaded frame instead of
+            # the whole frame, and take the detections elsewhere from that frame
+            with metrics.stage('compare'):
+                regions = changed_regions(last_uploaded[1], frame, roi)
+            frame_metrics = dict(frame_metrics, regions=regions, reference_frame=last_uploaded[0])
+        last_uploaded = (number, frame)
+        if publisher:
+            # A frame uploaded again under the same key (re-uploaded video, restarted stream) is a new frame
+            publisher.add(key, number, frame_metrics, etag=frame_etag or f"{etag}-{number}")
+
+    def write_checkpoint(clean, done=False):
+        # Frames announced after the checkpoint would be lost with their manifest
+        if publisher:
+            publisher.flush()
+        return save_checkpoint(input_bucket, input_key, {
+            "etag": etag,
+            "next_frame": frame_count,
+            "frame_offset": frame_offset,
+            "previous_fingerprint": frame_fingerprint(previous_frame) if previous_frame is not None else None,
+            "frames_processed": checkpoint.get('frames_processed', 0) + len(metrics_list),
+            "selector": selector.state() if selector else None,
+            "clean": clean,
+            "done": done
+        })
+
+    complete = True
+    handover_attempted = False
+    last_checkpoint = frame_count
     while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
+        if previous_frame is not None:
+            remaining_ms = get_remaining_time_ms(context)
+            if not handover_attempted and remaining_ms is not None and remaining_ms < CHECKPOINT_MARGIN_MS:
+                handover_attempted = True
+                if write_checkpoint(clean=True) and continue_in_new_invocation(context, input_bucket, input_key):
+                    complete = False
+                    break
+            elif CHECKPOINT_EVERY_FRAMES and frame_count - last_checkpoint >= CHECKPOINT_EVERY_FRAMES:
+                with metrics.stage('checkpoint'):
+                    write_checkpoint(clean=False)
+                last_checkpoint = frame_count
 
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        frame = read_frame(cap)
+        if frame is None:
+            break
+        metrics.count('frames_read')
+        number = frame_offset + frame_count
 
-        if previous_frame is None:
+        if previous_frame is None and last_thumbnail is None:
             previous_frame = frame
-            upload_frame_to_s3(frame, output_bucket, frame_count, file_name)
+            upload(frame, number)
+            if selector:
+                selector.take()
             frame_count += 1
             continue
 
-        metrics = compare_frames(previous_frame, frame)
-        metrics['frame_number'] = frame_count
+        with metrics.stage('compare'):
+            if previous_frame is None:
+                # The first frame of a segment is compared with the last frame of the segment before
+                reference, current = last_thumbnail, frame_thumbnail(frame)
+            else:
+                reference, current = previous_frame, frame
+            frame_metrics = compare_frames(reference, current, roi)
+        frame_metrics['frame_number'] = number
 
-        if metrics['abs_diff'] >= 50 or metrics['ssim'] <= 0.95:
-            upload_frame_to_s3(frame, output_bucket, frame_count, file_name)
+        if selector:
+            # The selector decides about the previous frame once it knows the change that follows it
+            selected = selector.push(number, motion_energy(frame_metrics))
+            if selected is not None:
+                upload(previous_frame, selected, metrics_list[-1] if metrics_list else None)
+        elif frame_metrics['abs_diff'] >= 50 or frame_metrics['ssim'] <= 0.95:
+            upload(frame, number, frame_metrics)
 
-        metrics_list.append(metrics)
+        metrics_list.append(frame_metrics)
         previous_frame = frame
         frame_count += 1
 
+    if complete:
+        if selector:
+            selected = selector.finish()
+            if selected is not None:
+                upload(previous_frame, selected, metrics_list[-1] if metrics_list else None)
+            metrics.count('frames_over_budget', selector.over_budget)
+        if SEGMENT_INGEST:
+            save_stream_state(input_bucket, stream_id, {
+                "next_frame": frame_offset + frame_count,
+                "thumbnail": encode_thumbnail(frame_thumbnail(previous_frame)) if previous_frame is not None else stream_state.get('thumbnail'),
+                "selector": selector.state() if selector else None,
+                "last_segment": input_key
+            })
+        write_checkpoint(clean=True, done=True)
+
+    if publisher:
+        metrics.count('manifests_sent', publisher.messages_sent)
+
     cap.release()
     os.remove(video_path)
 
-    return metrics_list
+    return metrics_list, complete
 
 
+@profiled
 def lambda_handler(event, context):
     """
     AWS Lambda handler function.
     """
     try:
+        start_invocation()
         # Extract the source bucket and object key from the event
         record = event['Records'][0]
         input_bucket = record['s3']['bucket']['name']
         input_key = record['s3']['object']['key']
+
+        # Checkpoints and stream state are written next to the videos unless CHECKPOINT_BUCKET is set
+        if is_checkpoint_key(input_key) or is_stream_state_key(input_key):
+            logger.debug("Skipping checkpoint %s", input_key)
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'message': 'Not a video'})
+            }
         
         # Define a fixed output bucket
         output_bucket = "frames-nht"
         
         # Process the video
-        metrics = process_video(input_bucket, input_key, output_bucket)
+        metrics_list, complete = process_video(input_bucket, input_key, output_bucket, context)
         
         return {
             'statusCode': 200,
             'body': json.dumps({
-                'message': 'Video processing complete',
-                'frames_processed': len(metrics)
+                'message': 'Video processing complete' if complete else 'Video processing continues in a new invocation',
+                'frames_processed': len(metrics_list),
+                'complete': complete
             })
         }
         
+    except StreamStateError as e:
+        # Raised so the invocation is retried, instead of numbering the segment's frames afresh
+        logger.error("Error processing video - %s", e)
+        raise
     except Exception as e:
+        logger.error("Error processing video - %s", e)
         return {
             'statusCode': 500,
             'body': json.dumps({
                 'error': str(e)
             })
         }
+    finally:
+        # Emit the stage timings of this invocation as one EMF metric line
+        metrics.flush()
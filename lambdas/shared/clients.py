@@ -0,0 +1,99 @@
+"""
+Lazily created, memoised clients and modules shared by the Lambda functions.
+
+Nothing here connects or imports a heavy dependency until it is first used,
+so a cold start only pays for what the invocation actually needs. Clients are
+created once per container and reused by every invocation and thread.
+
+Configuration comes from environment variables:
+    MONGO_URI       MongoDB connection string (required for result storage)
+    MONGO_DB_NAME   Database holding the result collections (default: lambda_outputs)
+"""
+import importlib
+import os
+import threading
+import types
+
+DB_NAME = os.environ.get('MONGO_DB_NAME', 'lambda_outputs')
+
+_clients = {}
+_lock = threading.Lock()
+
+
+class LazyModule(types.ModuleType):
+    """Module placeholder that imports the real module on first attribute access."""
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+
+def lazy_import(name):
+    """Return a placeholder for the module ``name`` that is imported when first used."""
+    return LazyModule(name)
+
+
+def _get_or_create(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+    return client
+
+
+def set_client(name, client):
+    """Replace a memoised client, e.g. with a local stand-in ("s3", "sqs", "lambda" or "mongo")."""
+    with _lock:
+        _clients[name] = client
+
+
+def get_boto3_client(service):
+    """Return the boto3 client for ``service``, created once per container."""
+    def create():
+        import boto3
+        return boto3.client(service)
+    return _get_or_create(service, create)
+
+
+def get_s3_client():
+    return get_boto3_client('s3')
+
+
+def get_sqs_client():
+    return get_boto3_client('sqs')
+
+
+def get_lambda_client():
+    return get_boto3_client('lambda')
+
+
+def get_mongo_client():
+    """Return the MongoDB client; the connection (and SRV lookup) happens on first use."""
+    def create():
+        import pymongo
+        mongo_uri = os.environ.get('MONGO_URI')
+        if not mongo_uri:
+            raise Exception("MONGO_URI environment variable is not set")
+        return pymongo.MongoClient(mongo_uri, connect=False)
+    return _get_or_create('mongo', create)
+
+
+def get_mongo_db():
+    return get_mongo_client()[DB_NAME]
+
+
+def get_collection(name):
+    return get_mongo_db()[name]
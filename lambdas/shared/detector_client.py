@@ -0,0 +1,256 @@
+"""
+Latency-aware client for the remote detection endpoints.
+
+Every call gets a latency budget. When the endpoint has not answered after its
+usual latency a hedged second request is sent, and when the budget runs out
+the call falls back to a local detector, when one is configured, or fails fast
+instead of blocking until the Lambda times out. Detections of the fallback are
+marked with ``"fallback": True``. Sustained errors open a circuit breaker so that a
+struggling endpoint is not hit by every queued frame and its retries.
+
+Images are scaled down to the model input size before they are sent, and the
+returned boxes scaled back (see shared/model_input.py).
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from shared.clients import lazy_import
+from shared.instrumentation import get_logger
+from shared.model_input import DETECTOR_INPUT_QUALITY, DETECTOR_INPUT_SIZE, prepare_image, rescale_results
+
+requests = lazy_import('requests')
+logger = get_logger(__name__)
+
+# Maximum time a detection call may take before falling back, in milliseconds
+LATENCY_BUDGET_MS = int(os.environ.get('DETECTOR_LATENCY_BUDGET_MS', '10000'))
+
+# Send a second request when the first is slower than the observed p95 latency
+HEDGING_ENABLED = os.environ.get('DETECTOR_HEDGING', 'true').lower() == 'true'
+
+# Consecutive failures that open the circuit, and how long it stays open in seconds
+FAILURE_THRESHOLD = int(os.environ.get('DETECTOR_FAILURE_THRESHOLD', '5'))
+RESET_TIMEOUT_S = float(os.environ.get('DETECTOR_RESET_TIMEOUT_S', '30'))
+
+CONNECT_TIMEOUT_S = 3.05
+
+
+class DetectorUnavailable(Exception):
+    """Raised when the remote detector cannot answer and no fallback is configured."""
+
+
+class LatencyTracker:
+    """Tracks an exponentially weighted moving average and percentiles of latencies."""
+
+    def __init__(self, alpha=0.2, window=256):
+        self.alpha = alpha
+        self.ewma = None
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        with self._lock:
+            self.ewma = latency if self.ewma is None else self.alpha * latency + (1 - self.alpha) * self.ewma
+            self._samples.append(latency)
+
+    def percentile(self, p):
+        """Return the p-th percentile of the recent latencies, or None without samples."""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def count(self):
+        with self._lock:
+            return len(self._samples)
+
+
+class CircuitBreaker:
+    """
+    Opens after ``failure_threshold`` consecutive failures.
+
+    While open every request is rejected. After ``reset_timeout`` seconds one
+    trial request is let through (half-open); its success closes the circuit
+    and its failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT_S, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.clock() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning("Opening detector circuit after %d consecutive failures", self.consecutive_failures)
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+                self._trial_in_flight = False
+
+
+class DetectorClient:
+    """
+    Sends encoded images to a detection endpoint within a latency budget.
+
+    Args:
+        url: Detection endpoint accepting the raw image bytes
+        latency_budget: Maximum seconds a call may take before falling back
+        hedging: Whether to send a second request when the first one is slow
+        fallback: Optional callable taking the image bytes, used past the budget
+            or while the circuit is open
+        min_hedge_delay: Lower bound for the delay before the hedged request
+        circuit_breaker: Breaker guarding the endpoint
+        max_workers: Maximum number of requests in flight from this client
+        input_size: Longest side of the images sent, 0 to send the originals
+        input_quality: JPEG quality of the resized images
+    """
+
+    def __init__(self, url, latency_budget=LATENCY_BUDGET_MS / 1000, hedging=HEDGING_ENABLED, fallback=None,
+                 min_hedge_delay=0.05, circuit_breaker=None, max_workers=32, input_size=DETECTOR_INPUT_SIZE,
+                 input_quality=DETECTOR_INPUT_QUALITY):
+        self.url = url
+        self.latency_budget = latency_budget
+        self.hedging = hedging
+        self.fallback = fallback
+        self.min_hedge_delay = min_hedge_delay
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.latency = LatencyTracker()
+        self.input_size = input_size
+        self.input_quality = input_quality
+        self.bytes_original = 0
+        self.bytes_sent = 0
+        self._bytes_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='detector-client')
+
+    def _post(self, image_data):
+        start = time.monotonic()
+        response = self.session.post(
+            self.url,
+            data=image_data,
+            headers={'Content-Type': 'application/octet-stream'},
+            timeout=(CONNECT_TIMEOUT_S, self.latency_budget)
+        )
+        if response.status_code != 200:
+            logger.warning("Detector response text: %s", response.text[:500])
+            raise Exception(f"Modal API request failed with status code {response.status_code}")
+        results = response.json()
+        self.latency.record(time.monotonic() - start)
+        return results
+
+    def hedge_delay(self):
+        """Delay before a hedged request: the p95 latency, or half the budget until enough samples exist."""
+        p95 = self.latency.percentile(95) if self.latency.count() >= 20 else None
+        if p95 is None:
+            return self.latency_budget / 2
+        return min(max(p95, self.min_hedge_delay), self.latency_budget)
+
+    def _use_fallback(self, image_data, reason):
+        if self.fallback is None:
+            raise DetectorUnavailable(f"Detector {self.url} unavailable: {reason}")
+        logger.info("Using fallback detector (%s)", reason)
+        results = self.fallback(image_data)
+        if not isinstance(results, list):
+            return results
+        # Stored with the results of the remote model, so they must stay recognisable
+        return [dict(detection, fallback=True) if isinstance(detection, dict) else detection for detection in results]
+
+    def detect(self, image_data):
+        """Return the detection results for the image, hedging, falling back or failing fast as needed."""
+        if not self.circuit_breaker.allow_request():
+            return self._use_fallback(image_data, "circuit open")
+
+        # The fallback gets the original image; only the remote call is sent the resized one
+        payload, scale = prepare_image(image_data, self.input_size, self.input_quality)
+        with self._bytes_lock:
+            self.bytes_original += len(image_data)
+            self.bytes_sent += len(payload)
+
+        deadline = time.monotonic() + self.latency_budget
+        pending = {self.executor.submit(self._post, payload)}
+        hedged = not self.hedging
+        last_error = None
+
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            timeout = remaining if hedged else min(remaining, self.hedge_delay())
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    self.circuit_breaker.record_success()
+                    return rescale_results(future.result(), scale)
+                last_error = future.exception()
+
+            if not hedged and (not done or not pending):
+                # Either the first request is slow or it failed; try once more within the budget
+                pending.add(self.executor.submit(self._post, payload))
+                hedged = True
+
+        # Abandoned requests finish in the background and are bounded by the read timeout
+        for future in pending:
+            future.cancel()
+        self.circuit_breaker.record_failure()
+        reason = f"error: {last_error}" if last_error is not None and not pending else f"exceeded {self.latency_budget:.2f}s latency budget"
+        return self._use_fallback(image_data, reason)
+
+    def stats(self):
+        """Return the latency statistics and circuit state for logging."""
+        return {
+            "ewma_ms": None if self.latency.ewma is None else round(self.latency.ewma * 1000, 1),
+            "p50_ms": None if self.latency.count() == 0 else round(self.latency.percentile(50) * 1000, 1),
+            "p95_ms": None if self.latency.count() == 0 else round(self.latency.percentile(95) * 1000, 1),
+            "circuit": self.circuit_breaker.state,
+            "bytes_original": self.bytes_original,
+            "bytes_sent": self.bytes_sent
+        }
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_detector_client(url, **kwargs):
+    """Return the client for the endpoint, creating it once per container."""
+    with _clients_lock:
+        if url not in _clients:
+            _clients[url] = DetectorClient(url, **kwargs)
+        return _clients[url]
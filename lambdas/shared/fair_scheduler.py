@@ -0,0 +1,148 @@
+"""
+Per-stream fair scheduling of the frames of an SQS batch.
+
+Records used to be processed in arrival order, so a busy camera whose frames
+fill a batch (or the frame manifests of a batch) delayed every other stream
+behind it. ``process_sqs_records`` now orders the frames of a batch by stream,
+round-robin or weighted, before they are handed to the worker threads. Every
+stream gets its turn among the first records started, and when an invocation
+runs out of time the records that were not started are spread over the
+streams rather than all belonging to the quiet ones.
+
+A stream with more than ``STREAM_BACKLOG_LIMIT`` frames in a batch is shed
+down to the limit, oldest frames first. ``drop`` keeps the newest frames,
+``downsample`` keeps frames spread evenly over the backlog, always including
+the newest. Shed frames are not analysed and not retried; they are logged
+and counted as ``frames_shed``.
+
+The limit applies to the frames of a stream within one batch (at most
+``BatchSize`` messages, more with manifests), not to the stream's backlog in
+the queue: a stream flooding the queue still has up to the limit of its frames
+analysed in every batch. It thins out bursts that arrive together, and keeps a
+busy stream from taking a whole batch; the queue backlog itself is bounded by
+the batch size, the concurrency of the function and the retention of the
+queue.
+
+The stream of a frame is the ``stream_id`` of its manifest entry, or else the
+folder of its key (``<stream>/frame_NNNN.jpg``). Frames are ordered within a
+stream by frame number.
+
+Configuration comes from environment variables:
+    STREAM_WEIGHTS          Frames per round by stream, e.g. "cam-12=3,lobby=2" (default: 1 each)
+    STREAM_BACKLOG_LIMIT    Frames of one stream kept per batch (default: 0, no limit)
+    STREAM_BACKLOG_POLICY   drop or downsample (default: drop)
+"""
+import os
+import re
+
+from shared.instrumentation import get_logger
+
+logger = get_logger(__name__)
+
+BACKLOG_POLICIES = ('drop', 'downsample')
+
+
+def parse_weights(spec):
+    """Parse ``"cam-12=3,lobby=2"`` into a dict of stream weights; raises ValueError."""
+    weights = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        stream_id, separator, weight = entry.rpartition('=')
+        if not separator or not stream_id or not weight.isdigit() or int(weight) < 1:
+            raise ValueError(f"Invalid stream weight {entry!r}, expected <stream>=<positive integer>")
+        weights[stream_id] = int(weight)
+    return weights
+
+
+STREAM_WEIGHTS = parse_weights(os.environ.get('STREAM_WEIGHTS', ''))
+STREAM_BACKLOG_LIMIT = int(os.environ.get('STREAM_BACKLOG_LIMIT', '0'))
+STREAM_BACKLOG_POLICY = os.environ.get('STREAM_BACKLOG_POLICY', 'drop')
+
+
+def record_frame(record):
+    """Return the stream and frame number of an SQS record; either is None when unknown."""
+    # Imported here, as shared.sqs_batch schedules its records with this module
+    from shared.sqs_batch import parse_s3_event
+
+    try:
+        s3_event = parse_s3_event(record)
+    except Exception:
+        # Unparseable records keep their place and fail when they are processed
+        return None, None
+    frame = s3_event.get('frame') or {}
+    key = s3_event.get('object', {}).get('key', '')
+    stream_id = frame.get('stream_id') or os.path.dirname(key) or None
+    frame_number = frame.get('frame_number')
+    if frame_number is None:
+        match = re.search(r"frame_(\d+)", os.path.basename(key))
+        frame_number = int(match.group(1)) if match else None
+    return stream_id, frame_number
+
+
+def shed_backlog(frames, limit, policy='drop'):
+    """
+    Reduce the frames of one stream, oldest first, to at most ``limit``.
+
+    Returns:
+        The frames kept and the frames shed, both in the order given.
+    """
+    if policy not in BACKLOG_POLICIES:
+        raise ValueError(f"Unknown backlog policy {policy!r}, expected one of {BACKLOG_POLICIES}")
+    if not limit or len(frames) <= limit:
+        return list(frames), []
+    if policy == 'drop':
+        keep = set(range(len(frames) - limit, len(frames)))
+    else:
+        # Evenly spaced over the backlog, ending with the newest frame
+        step = (len(frames) - 1) / (limit - 1) if limit > 1 else 0
+        keep = {len(frames) - 1 - round(index * step) for index in range(limit)}
+    kept = [frame for index, frame in enumerate(frames) if index in keep]
+    shed = [frame for index, frame in enumerate(frames) if index not in keep]
+    return kept, shed
+
+
+def schedule_records(records, weights=None, backlog_limit=None, policy=None):
+    """
+    Order the records of a batch fairly across streams and shed backlogs over the limit.
+
+    Args:
+        records: SQS records, with frame manifests already expanded
+        weights: Records per round by stream; streams not listed get 1
+        backlog_limit: Records of one stream kept, 0 for no limit
+        policy: drop or downsample
+
+    Returns:
+        The records in processing order, and the records shed.
+    """
+    weights = STREAM_WEIGHTS if weights is None else weights
+    backlog_limit = STREAM_BACKLOG_LIMIT if backlog_limit is None else backlog_limit
+    policy = policy or STREAM_BACKLOG_POLICY
+
+    streams = {}
+    for position, record in enumerate(records):
+        stream_id, frame_number = record_frame(record)
+        # Records without a stream are each a stream of their own, so they are not held back
+        streams.setdefault(stream_id if stream_id is not None else ('record', position), []).append(
+            (frame_number if frame_number is not None else -1, position, record))
+
+    queues = []
+    shed = []
+    shed_streams = 0
+    for stream_id, frames in streams.items():
+        frames.sort(key=lambda frame: frame[:2])
+        kept, dropped = shed_backlog([record for _, _, record in frames], backlog_limit, policy)
+        if dropped:
+            shed.extend(dropped)
+            shed_streams += 1
+        queues.append((weights.get(stream_id, 1), kept))
+
+    ordered = []
+    turn = 0
+    while len(ordered) < len(records) - len(shed):
+        for weight, kept in queues:
+            ordered.extend(kept[turn * weight:(turn + 1) * weight])
+        turn += 1
+
+    if shed:
+        logger.warning("Shed %d frames of %d streams over the backlog limit of %d per batch",
+                       len(shed), shed_streams, backlog_limit)
+    return ordered, shed
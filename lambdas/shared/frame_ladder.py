@@ -0,0 +1,98 @@
+"""
+Resolution ladder of the extracted frames.
+
+With ``FRAME_LADDER`` set, the extractor uploads every selected frame in the
+configured sizes as well, resized once from the decoded frame:
+
+    <folder>/frame_0001.jpg                  full resolution, as before
+    resized/<rung>/<folder>/frame_0001.jpg   one object per rung
+
+Smaller rungs are uploaded before the full frame, so they exist when the
+notification of the full frame reaches a detector. A detector declares the
+rung it consumes and downloads that object instead of the full frame, falling
+back to the full frame when the rung is not in the ladder or the object is
+missing (frames uploaded before the ladder was enabled, or smaller than the
+rung). Notifications of ``resized/`` objects are ignored.
+
+``FRAME_LADDER`` lists ``name=WIDTHxHEIGHT`` or ``name=WIDTH`` (height
+following the aspect ratio), e.g. ``thumb=320x180,medium=640x360``. The same
+value is configured on the extractor and the detectors.
+"""
+import os
+
+from shared.clients import get_s3_client, lazy_import
+from shared.instrumentation import get_logger
+
+cv2 = lazy_import('cv2')
+logger = get_logger(__name__)
+
+FRAME_LADDER = os.environ.get('FRAME_LADDER', '')
+
+LADDER_PREFIX = 'resized/'
+FULL = 'full'
+
+
+def parse_ladder(spec):
+    """Return ``{rung: (width, height or None)}`` of a ladder specification, smallest rung first."""
+    rungs = []
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, size = entry.partition('=')
+        width, _, height = size.lower().partition('x')
+        if not name or name == FULL or '/' in name or not width.isdigit() or (height and not height.isdigit()):
+            raise ValueError(f"Invalid frame ladder rung {entry!r}, expected name=WIDTHxHEIGHT or name=WIDTH")
+        rungs.append((name, (int(width), int(height) if height else None)))
+    return dict(sorted(rungs, key=lambda rung: rung[1][0]))
+
+
+LADDER = parse_ladder(FRAME_LADDER)
+
+
+def ladder_key(key, rung):
+    """Return the key of ``rung`` of the frame stored at ``key``."""
+    return key if rung == FULL else f"{LADDER_PREFIX}{rung}/{key}"
+
+
+def is_ladder_key(key):
+    return key.startswith(LADDER_PREFIX)
+
+
+def ladder_frames(frame, ladder=None):
+    """Yield ``(rung, resized frame)`` for every rung smaller than the frame, smallest first."""
+    ladder = LADDER if ladder is None else ladder
+    height, width = frame.shape[:2]
+    for rung, (rung_width, rung_height) in ladder.items():
+        if rung_width >= width:
+            continue
+        rung_height = rung_height or max(1, round(height * rung_width / width))
+        yield rung, cv2.resize(frame, (rung_width, rung_height), interpolation=cv2.INTER_AREA)
+
+
+def _error_code(error):
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code')
+
+
+def source_key(key, rung, ladder=None):
+    """Return the key a detector consuming ``rung`` reads first for the frame at ``key``."""
+    ladder = LADDER if ladder is None else ladder
+    return ladder_key(key, rung) if rung in ladder else key
+
+
+def download_frame(bucket, key, path, rung=FULL, ladder=None):
+    """
+    Download the ``rung`` of a frame to ``path``, or the full frame when the rung does not exist.
+
+    Returns:
+        The key that was downloaded.
+    """
+    candidate = source_key(key, rung, ladder)
+    if candidate != key:
+        try:
+            get_s3_client().download_file(bucket, candidate, path)
+            return candidate
+        except Exception as e:
+            if _error_code(e) not in ('404', 'NoSuchKey'):
+                raise
+            logger.debug("No %s rung of %s, using the full frame", rung, key)
+    get_s3_client().download_file(bucket, key, path)
+    return key
@@ -0,0 +1,162 @@
+"""
+Frame manifests published by the extractor straight to the detector queues.
+
+Instead of one S3 notification per uploaded frame, the extractor sends compact
+messages listing several frames of a stream::
+
+    {
+        "type": "frame_manifest",
+        "version": 1,
+        "bucket": "frames-nht",
+        "video_key": "uploads/12_cam_north.mp4",
+        "stream_id": "12_cam_north",
+        "frames": [
+            {"key": "12_cam_north/frame_0042.jpg", "frame_id": "frame_0042", "frame_number": 42,
+             "etag": "9b2cf535f27731c974343645a3985328", "abs_diff": 61.2, "ssim": 0.91,
+             "regions": [[0.41, 0.32, 0.58, 0.61]], "reference_frame": 37}
+        ]
+    }
+
+``etag`` is the ETag of the uploaded frame (or, when S3 returned none, the
+ETag of the video and the frame number), so a frame uploaded again under the
+same key is not taken for a duplicate by the detectors.
+
+``regions`` lists the parts of the frame that changed since the frame
+uploaded before it, ``reference_frame``, when the extractor runs with
+``MOTION_CROPS_ENABLED`` (see shared/motion_regions.py).
+
+Messages go out with ``send_message_batch``, up to ten per request, to every
+queue in ``DETECTOR_QUEUE_URLS``. The S3 notifications of the frames bucket
+should then no longer target those queues. ``shared.sqs_batch`` turns a
+manifest back into one record per frame, so detectors process manifests and
+S3 notifications alike.
+
+Configuration comes from environment variables:
+    DETECTOR_QUEUE_URLS       Comma-separated queue URLs (default: none, S3 notifications only)
+    MANIFEST_FRAMES           Frames per manifest message (default: 10)
+    MANIFEST_MAX_DELAY_MS     Send a partial manifest once its oldest frame waited this long (default: 1000)
+"""
+import json
+import os
+import time
+
+from shared.clients import get_sqs_client
+from shared.instrumentation import get_logger
+
+logger = get_logger(__name__)
+
+DETECTOR_QUEUE_URLS = [url.strip() for url in os.environ.get('DETECTOR_QUEUE_URLS', '').split(',') if url.strip()]
+MANIFEST_FRAMES = int(os.environ.get('MANIFEST_FRAMES', '10'))
+MANIFEST_MAX_DELAY_MS = float(os.environ.get('MANIFEST_MAX_DELAY_MS', '1000'))
+
+MANIFEST_TYPE = 'frame_manifest'
+MANIFEST_VERSION = 1
+
+# Entries accepted by one SendMessageBatch request
+MAX_BATCH_ENTRIES = 10
+
+
+def is_manifest(message):
+    return isinstance(message, dict) and message.get('type') == MANIFEST_TYPE
+
+
+def manifest_frames(message):
+    """
+    Yield the S3 event payload of every frame of a manifest.
+
+    The payloads have the shape of the ``s3`` part of an S3 notification, with
+    the ETag of the frame as ``eTag`` and its ids and change metrics under
+    ``"frame"``.
+    """
+    if message.get('version', MANIFEST_VERSION) > MANIFEST_VERSION:
+        raise ValueError(f"Unsupported frame manifest version {message.get('version')}")
+    for frame in message['frames']:
+        s3_object = {"key": frame['key']}
+        if frame.get('etag'):
+            s3_object['eTag'] = frame['etag']
+        yield {
+            "bucket": {"name": message['bucket']},
+            "object": s3_object,
+            "frame": dict(frame, stream_id=message['stream_id'])
+        }
+
+
+class ManifestPublisher:
+    """
+    Collects the uploaded frames of one video and sends them as manifests.
+
+    Args:
+        bucket: Bucket of the frames
+        video_key: Key of the source video
+        stream_id: Stream the frames belong to
+        queue_urls: Queues receiving every manifest
+        frames_per_message: Frames listed in one manifest
+        max_delay_ms: Age of the oldest pending frame that sends a partial manifest
+    """
+
+    def __init__(self, bucket, video_key, stream_id, queue_urls=None, frames_per_message=None, max_delay_ms=None,
+                 clock=time.monotonic):
+        self.bucket = bucket
+        self.video_key = video_key
+        self.stream_id = stream_id
+        self.queue_urls = DETECTOR_QUEUE_URLS if queue_urls is None else queue_urls
+        self.frames_per_message = frames_per_message or MANIFEST_FRAMES
+        self.max_delay = (MANIFEST_MAX_DELAY_MS if max_delay_ms is None else max_delay_ms) / 1000
+        self.clock = clock
+        self.messages_sent = 0
+        self._frames = []
+        self._messages = []
+        self._oldest = None
+
+    def add(self, key, frame_number, frame_metrics=None, etag=None):
+        """Add an uploaded frame; full or overdue manifests are sent right away."""
+        frame = {"key": key, "frame_id": os.path.splitext(os.path.basename(key))[0], "frame_number": frame_number}
+        if etag:
+            # As in S3 notifications, without the quotes of the API responses
+            frame["etag"] = etag.replace('"', '')
+        if frame_metrics:
+            names = ('abs_diff', 'ssim', 'regions', 'reference_frame')
+            frame.update({name: frame_metrics[name] for name in names if name in frame_metrics})
+        if not self._frames:
+            self._oldest = self.clock()
+        self._frames.append(frame)
+
+        if len(self._frames) >= self.frames_per_message:
+            self._close_manifest()
+        if len(self._messages) >= MAX_BATCH_ENTRIES or (self._oldest is not None and self.clock() - self._oldest >= self.max_delay):
+            self.flush()
+
+    def _close_manifest(self):
+        if not self._frames:
+            return
+        self._messages.append(json.dumps({
+            "type": MANIFEST_TYPE,
+            "version": MANIFEST_VERSION,
+            "bucket": self.bucket,
+            "video_key": self.video_key,
+            "stream_id": self.stream_id,
+            "frames": self._frames
+        }, separators=(',', ':')))
+        self._frames = []
+
+    def flush(self):
+        """Send every pending frame; raises when a queue rejects a manifest twice."""
+        self._close_manifest()
+        self._oldest = None
+        messages, self._messages = self._messages, []
+        for start in range(0, len(messages), MAX_BATCH_ENTRIES):
+            chunk = messages[start:start + MAX_BATCH_ENTRIES]
+            for queue_url in self.queue_urls:
+                self._send(queue_url, chunk)
+            self.messages_sent += len(chunk)
+
+    def _send(self, queue_url, messages):
+        entries = [{"Id": str(index), "MessageBody": body} for index, body in enumerate(messages)]
+        for attempt in range(2):
+            response = get_sqs_client().send_message_batch(QueueUrl=queue_url, Entries=entries)
+            failed = {failure['Id'] for failure in response.get('Failed', [])}
+            if not failed:
+                return
+            entries = [entry for entry in entries if entry['Id'] in failed]
+            logger.warning("%d frame manifests rejected by %s (attempt %d)", len(entries), queue_url, attempt + 1)
+        raise Exception(f"Failed to send {len(entries)} frame manifests to {queue_url}")
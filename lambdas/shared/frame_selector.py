@@ -0,0 +1,142 @@
+"""
+Adaptive frame selection for the frame extractor.
+
+The fixed upload rule (``abs_diff >= 50 or ssim <= 0.95``) uploads every
+changed frame of a busy scene and misses changes that build up slowly. The
+selector turns the change metrics of consecutive frames into a motion-energy
+signal, where 1.0 is the old threshold, and selects frames at the local maxima
+of that signal. A frame needs enough change accumulated since the last
+selected frame, and a token from a per-stream bucket that refills at
+``FRAME_BUDGET_PER_MINUTE`` of video time. Over a minute of video a stream
+therefore uploads at most the budget plus the burst, which caps the detector
+invocations and inference calls it causes.
+
+The accumulated-change threshold adapts to the scene: it rises while peaks are
+turned away for lack of tokens, so the budget goes to the strongest changes,
+and it falls while tokens go unused, so quiet scenes still get their slow
+changes uploaded.
+
+Configuration comes from environment variables:
+    FRAME_BUDGET_PER_MINUTE     Frames per minute of video and stream (default: 0, fixed rule)
+    FRAME_BUDGET_BURST          Tokens a stream can save up (default: a tenth of the budget, at least 1)
+    FRAME_SELECTOR_MIN_ENERGY   Lowest accumulated change that selects a frame (default: 0.1)
+"""
+import os
+
+FRAME_BUDGET_PER_MINUTE = float(os.environ.get('FRAME_BUDGET_PER_MINUTE', '0'))
+FRAME_BUDGET_BURST = float(os.environ.get('FRAME_BUDGET_BURST', '0'))
+MIN_ENERGY = float(os.environ.get('FRAME_SELECTOR_MIN_ENERGY', '0.1'))
+
+# Change metrics equal to the fixed upload rule give an energy of 1.0
+ABS_DIFF_SCALE = 50.0
+SSIM_SCALE = 0.05
+
+# Threshold changes when a peak finds no token, or a full bucket
+RAISE_FACTOR = 1.25
+LOWER_FACTOR = 0.9
+
+# Frame rate assumed when the container does not report one
+DEFAULT_FPS = 30.0
+
+
+def motion_energy(frame_metrics):
+    """Return the motion energy of the change metrics from ``compare_frames``."""
+    return max(frame_metrics['abs_diff'] / ABS_DIFF_SCALE, (1.0 - frame_metrics['ssim']) / SSIM_SCALE, 0.0)
+
+
+class FrameSelector:
+    """
+    Selects the frames of one stream within a frames-per-minute budget.
+
+    Frames are pushed in order with their motion energy. A frame is a peak
+    when its energy is at least that of the frame before and above that of
+    the frame after, so the decision about a frame is returned when the next
+    one is pushed, and about the last frame by :meth:`finish`.
+
+    Args:
+        budget_per_minute: Frames selected per minute of video
+        fps: Frame rate of the video, which converts frames to video time
+        burst: Tokens the stream can save up
+        min_energy: Floor of the accumulated-change threshold
+    """
+
+    # Attributes carried over to the next invocation by state() and restore()
+    STATE_FIELDS = ('tokens', 'threshold', 'accumulated', 'previous_energy', 'pending', 'selected', 'over_budget')
+
+    def __init__(self, budget_per_minute=None, fps=None, burst=None, min_energy=MIN_ENERGY):
+        self.budget_per_minute = FRAME_BUDGET_PER_MINUTE if budget_per_minute is None else budget_per_minute
+        if self.budget_per_minute <= 0:
+            raise ValueError("The frame budget must be positive.")
+        self.fps = fps if fps and fps > 0 else DEFAULT_FPS
+        burst = burst or FRAME_BUDGET_BURST
+        self.capacity = burst if burst > 0 else max(1.0, self.budget_per_minute / 10)
+        self.refill = self.budget_per_minute / 60 / self.fps
+        self.min_energy = min_energy
+
+        self.tokens = self.capacity
+        self.threshold = max(1.0, min_energy)
+        self.accumulated = 0.0
+        self.previous_energy = 0.0
+        self.pending = None
+        self.selected = 0
+        self.over_budget = 0
+
+    def state(self):
+        """Return the progress of the selector as a JSON-serialisable dict."""
+        return {name: getattr(self, name) for name in self.STATE_FIELDS}
+
+    def restore(self, state):
+        """Continue from a :meth:`state` of the same stream, e.g. in the next invocation."""
+        for name in self.STATE_FIELDS:
+            if name in state:
+                setattr(self, name, state[name])
+        if self.pending is not None:
+            self.pending = tuple(self.pending)
+
+    def take(self):
+        """Spend a token on a frame selected outside the rules, such as the first frame of a video."""
+        self.tokens = max(0.0, self.tokens - 1)
+        self.selected += 1
+
+    def _decide(self, next_energy):
+        frame_number, energy = self.pending
+        self.pending = None
+        if not (energy >= self.previous_energy and energy > next_energy):
+            return None
+
+        if self.tokens >= self.capacity:
+            self.threshold = max(self.min_energy, self.threshold * LOWER_FACTOR)
+        if self.accumulated < self.threshold:
+            return None
+        if self.tokens < 1:
+            self.over_budget += 1
+            self.threshold *= RAISE_FACTOR
+            return None
+
+        self.tokens -= 1
+        self.selected += 1
+        self.accumulated = 0.0
+        return frame_number
+
+    def push(self, frame_number, energy):
+        """
+        Add the next frame of the stream.
+
+        Returns:
+            The number of the frame pushed before, when it is selected, else None.
+        """
+        self.tokens = min(self.capacity, self.tokens + self.refill)
+        selected = None
+        if self.pending is not None:
+            previous_energy = self.pending[1]
+            selected = self._decide(energy)
+            self.previous_energy = previous_energy
+        self.accumulated += energy
+        self.pending = (frame_number, energy)
+        return selected
+
+    def finish(self):
+        """Decide about the last frame pushed; returns its number when it is selected."""
+        if self.pending is None:
+            return None
+        return self._decide(0.0)
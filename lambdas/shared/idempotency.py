@@ -0,0 +1,185 @@
+"""
+Idempotency of the detectors across duplicate deliveries.
+
+SQS and asynchronous Lambda invocations deliver at least once, so the same
+frame regularly reaches a detector twice: a redelivered SQS message, a
+retried async invoke from the dispatcher, or a manifest redelivered for one
+failed frame. Each duplicate costs a download, an inference call and the
+database writes. Detectors check every frame before downloading it::
+
+    if processed_frames.is_duplicate(s3_event):
+        return None
+    ... download, detect, buffer the results ...
+    processed_frames.record(s3_event, message_id)
+
+and after the batch commit the recorded frames once their results are written::
+
+    failed_message_ids = processed_frames.commit_after(mongo_writes.flush)
+
+A frame is identified by detector, bucket, key and object version (the
+``versionId``, ``eTag`` or ``sequencer`` of the S3 notification, or the
+ETag a manifest lists for the frame). Frames whose results
+failed to write are not committed, so their redelivery is processed again.
+
+Committed frames are kept in an LRU per container and, with
+``IDEMPOTENCY_STORE=mongo``, in the ``processed_frames`` collection, which a
+TTL index expires after ``IDEMPOTENCY_TTL_SECONDS``. The shared store catches
+duplicates that land in another container; it is best-effort, and a frame is
+processed when the store cannot be reached.
+
+Configuration comes from environment variables:
+    IDEMPOTENCY_ENABLED       Skip duplicate frames (default: true)
+    IDEMPOTENCY_CACHE_SIZE    Frames remembered per container (default: 10000)
+    IDEMPOTENCY_STORE         none or mongo (default: none)
+    IDEMPOTENCY_TTL_SECONDS   How long a frame counts as processed (default: 86400)
+"""
+import collections
+import datetime
+import os
+import threading
+import time
+import urllib.parse
+
+from shared.clients import get_collection, lazy_import
+from shared.instrumentation import get_logger
+
+pymongo = lazy_import('pymongo')
+logger = get_logger(__name__)
+
+IDEMPOTENCY_ENABLED = os.environ.get('IDEMPOTENCY_ENABLED', 'true').lower() == 'true'
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '10000'))
+IDEMPOTENCY_STORE = os.environ.get('IDEMPOTENCY_STORE', 'none')
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400'))
+
+STORE_COLLECTION_NAME = "processed_frames"
+
+
+def frame_identity(s3_event, detector):
+    """Return the idempotency key of a frame for one detector."""
+    s3_object = s3_event.get('object', {})
+    key = urllib.parse.unquote(s3_object.get('key', ''))
+    version = s3_object.get('versionId') or s3_object.get('eTag') or s3_object.get('sequencer') or ''
+    return f"{detector}:{s3_event.get('bucket', {}).get('name', '')}/{key}@{version}"
+
+
+class ProcessedFrames:
+    """
+    Remembers the frames a detector processed, to skip duplicate deliveries.
+
+    Args:
+        detector: Name of the detector, part of every key
+        capacity: Frames remembered in the container
+        store: ``"mongo"`` to share processed frames between containers, or ``"none"``
+        ttl_seconds: How long a processed frame is remembered
+        enabled: When False nothing is a duplicate
+    """
+
+    def __init__(self, detector, capacity=None, store=None, ttl_seconds=None, enabled=None, clock=time.time):
+        self.detector = detector
+        self.capacity = capacity or IDEMPOTENCY_CACHE_SIZE
+        self.store = store or IDEMPOTENCY_STORE
+        self.ttl_seconds = ttl_seconds or IDEMPOTENCY_TTL_SECONDS
+        self.enabled = IDEMPOTENCY_ENABLED if enabled is None else enabled
+        self.clock = clock
+        self.duplicates = 0
+        self._seen = collections.OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._store_ready = False
+
+    def _collection(self):
+        collection = get_collection(STORE_COLLECTION_NAME)
+        if not self._store_ready:
+            # Documents are removed by MongoDB once their expiry time has passed
+            collection.create_index('expires_at', expireAfterSeconds=0)
+            self._store_ready = True
+        return collection
+
+    def _seen_recently(self, identity):
+        with self._lock:
+            expires = self._seen.get(identity)
+            if expires is None:
+                return False
+            if expires <= self.clock():
+                del self._seen[identity]
+                return False
+            self._seen.move_to_end(identity)
+            return True
+
+    def _remember(self, identities, expires):
+        with self._lock:
+            for identity in identities:
+                self._seen[identity] = expires
+                self._seen.move_to_end(identity)
+            while len(self._seen) > self.capacity:
+                self._seen.popitem(last=False)
+
+    def is_duplicate(self, s3_event):
+        """Return True when the frame was already processed by this detector."""
+        if not self.enabled:
+            return False
+        identity = frame_identity(s3_event, self.detector)
+        duplicate = self._seen_recently(identity)
+        if not duplicate and self.store == 'mongo':
+            try:
+                document = self._collection().find_one({"_id": identity}, {"expires_at": 1})
+            except Exception as e:
+                logger.warning("Idempotency store unavailable, processing %s - %s", identity, e)
+                document = None
+            if document is not None:
+                expires_at = document['expires_at'].replace(tzinfo=datetime.timezone.utc).timestamp()
+                duplicate = expires_at > self.clock()
+                if duplicate:
+                    self._remember([identity], expires_at)
+        if duplicate:
+            with self._lock:
+                self.duplicates += 1
+            logger.debug("Skipping duplicate delivery of %s", identity)
+        return duplicate
+
+    def record(self, s3_event, tag=None):
+        """Note a processed frame; it is committed by :meth:`commit_after` unless writes tagged ``tag`` fail."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pending[frame_identity(s3_event, self.detector)] = tag
+
+    def commit_after(self, flush):
+        """
+        Run ``flush`` and commit the frames recorded before it, except those whose writes failed.
+
+        Args:
+            flush: Writes the buffered results and returns the tags of failed writes,
+                e.g. ``WriteBehindBuffer.flush``
+
+        Returns:
+            The result of ``flush``.
+        """
+        # Frames recorded from here on may have writes the flush does not include
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        failed_tags = flush()
+        failed = set(failed_tags or ())
+        identities = [identity for identity, tag in pending.items() if tag is None or tag not in failed]
+        if identities:
+            self._commit(identities)
+        return failed_tags
+
+    def commit(self):
+        """Commit every recorded frame, for detectors that write their results right away."""
+        self.commit_after(list)
+
+    def _commit(self, identities):
+        expires = self.clock() + self.ttl_seconds
+        self._remember(identities, expires)
+        if self.store != 'mongo':
+            return
+        expires_at = datetime.datetime.fromtimestamp(expires, datetime.timezone.utc)
+        try:
+            self._collection().bulk_write(
+                [pymongo.UpdateOne({"_id": identity}, {"$set": {"expires_at": expires_at}}, upsert=True) for identity in identities],
+                ordered=False
+            )
+        except Exception as e:
+            # Other containers may then process these frames again
+            logger.warning("Failed to write %d processed frames to the idempotency store - %s", len(identities), e)
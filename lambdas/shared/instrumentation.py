@@ -0,0 +1,192 @@
+"""
+Stage timing, metrics and levelled logging shared by the Lambda functions.
+
+Stages are timed with ``time.perf_counter_ns`` and collected per invocation.
+At the end of the invocation they are written to stdout as one CloudWatch
+Embedded Metric Format (EMF) line, which CloudWatch turns into metrics without
+any API calls::
+
+    metrics = Metrics()
+
+    with metrics.stage('download'):
+        data = fetch(...)
+    metrics.count('frames')
+    ...
+    metrics.flush()
+
+Logs go through :func:`get_logger`. DEBUG output is only written for a
+sampled fraction of invocations, so it can stay on under load.
+
+Configuration comes from environment variables:
+    LOG_LEVEL           Level of the function logs (default: INFO)
+    LOG_SAMPLE_RATE     Fraction of invocations logged at DEBUG (default: 0)
+    METRICS_ENABLED     Emit EMF metric lines (default: true)
+    METRICS_NAMESPACE   CloudWatch namespace of the metrics (default: LambdaCICD)
+"""
+import contextlib
+import functools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0'))
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'LambdaCICD')
+
+# EMF accepts at most 100 metrics per line and 100 values per metric
+MAX_EMF_METRICS = 100
+MAX_EMF_VALUES = 100
+
+_logger = logging.getLogger('pipeline')
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """Writes to the current ``sys.stdout``, where the Lambda runtime collects the logs."""
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+def _configure():
+    if not _logger.handlers:
+        handler = _StdoutHandler()
+        handler.setFormatter(logging.Formatter('%(levelname)s %(name)s: %(message)s'))
+        _logger.addHandler(handler)
+        # The Lambda runtime adds its own handler to the root logger
+        _logger.propagate = False
+    _logger.setLevel(LOG_LEVEL)
+
+
+_configure()
+
+
+def get_logger(name):
+    """Return the logger of a function or helper module."""
+    return _logger.getChild(name.rsplit('.', 1)[-1])
+
+
+def start_invocation(sample_rate=None):
+    """
+    Decide whether this invocation logs at DEBUG; call at the start of every handler.
+
+    Returns:
+        True when the invocation was sampled.
+    """
+    rate = LOG_SAMPLE_RATE if sample_rate is None else sample_rate
+    sampled = rate > 0 and random.random() < rate
+    _logger.setLevel(logging.DEBUG if sampled else LOG_LEVEL)
+    return sampled
+
+
+class Metrics:
+    """
+    Per-invocation stage timings and counters, emitted as an EMF line by :meth:`flush`.
+
+    Safe to use from the worker threads processing the records of a batch.
+
+    Args:
+        namespace: CloudWatch namespace
+        function_name: Value of the FunctionName dimension; taken from the Lambda environment by default
+        enabled: Emit metric lines on flush
+    """
+
+    def __init__(self, namespace=METRICS_NAMESPACE, function_name=None, enabled=METRICS_ENABLED,
+                 clock=time.perf_counter_ns):
+        self.namespace = namespace
+        self.function_name = function_name or os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+        self.enabled = enabled
+        self.clock = clock
+        self._values = {}
+        self._units = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, value, unit='Milliseconds'):
+        with self._lock:
+            self._values.setdefault(name, []).append(value)
+            self._units[name] = unit
+
+    def count(self, name, value=1):
+        """Add ``value`` to the counter ``name``."""
+        with self._lock:
+            values = self._values.setdefault(name, [0])
+            values[0] += value
+            self._units[name] = 'Count'
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the enclosed block as one sample of the stage ``name``, also when it raises."""
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, (self.clock() - start) / 1e6)
+
+    def timed(self, name):
+        """Decorator timing every call of the function as the stage ``name``."""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """Return the values collected so far, by metric name."""
+        with self._lock:
+            return {name: list(values) for name, values in self._values.items()}
+
+    def _documents(self, values, units):
+        names = sorted(values)
+        timestamp = int(time.time() * 1000)
+        for start in range(0, len(names), MAX_EMF_METRICS):
+            chunk = names[start:start + MAX_EMF_METRICS]
+            longest = max(len(values[name]) for name in chunk)
+            for offset in range(0, longest, MAX_EMF_VALUES):
+                document = {
+                    "_aws": {
+                        "Timestamp": timestamp,
+                        "CloudWatchMetrics": [{
+                            "Namespace": self.namespace,
+                            "Dimensions": [["FunctionName"]],
+                            "Metrics": []
+                        }]
+                    },
+                    "FunctionName": self.function_name
+                }
+                for name in chunk:
+                    part = values[name][offset:offset + MAX_EMF_VALUES]
+                    if not part:
+                        continue
+                    document["_aws"]["CloudWatchMetrics"][0]["Metrics"].append({"Name": name, "Unit": units[name]})
+                    document[name] = [round(value, 3) for value in part] if len(part) > 1 else round(part[0], 3)
+                yield document
+
+    def flush(self):
+        """
+        Write the collected metrics as EMF lines and start over.
+
+        Returns:
+            The EMF documents written (also when metrics are disabled).
+        """
+        with self._lock:
+            values, self._values = self._values, {}
+            units, self._units = self._units, {}
+        if not values:
+            return []
+
+        documents = list(self._documents(values, units))
+        if self.enabled:
+            for document in documents:
+                sys.stdout.write(json.dumps(document, separators=(',', ':')) + "\n")
+        return documents
@@ -0,0 +1,160 @@
+"""
+Local CPU object detection with the Haar cascades bundled next to the detectors.
+
+Results use the same shape as the remote Modal detectors: a list with one dict
+per detection, and an empty list when nothing was found::
+
+    [{"bbox": [x1, y1, x2, y2], "confidence": 0.93, "class": "car", "source": "local"}]
+
+Box coordinates are in pixels of the original image.
+"""
+import argparse
+import json
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from shared.clients import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+# Frames are downscaled so that their longest side is at most this many pixels before detection
+MAX_DETECTION_SIDE = int(os.environ.get('LOCAL_DETECTOR_MAX_SIDE', '960'))
+
+# Number of cascades run at the same time; defaults to the number of vCPUs available
+LOCAL_DETECTOR_WORKERS = int(os.environ.get('LOCAL_DETECTOR_WORKERS', '0')) or os.cpu_count() or 1
+
+# Multi-scale parameters tuned for the bundled cascades
+VEHICLE_PARAMS = {"scale_factor": 1.05, "min_neighbors": 3, "min_size": (40, 40)}
+PERSON_PARAMS = {"scale_factor": 1.1, "min_neighbors": 5, "min_size": (30, 30)}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the worker pool shared by all local detectors in this container."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=LOCAL_DETECTOR_WORKERS, thread_name_prefix='local-detector')
+        return _executor
+
+
+def parse_roi(value):
+    """Parse an "x,y,w,h" region of interest string, returning None when unset."""
+    if not value:
+        return None
+    x, y, w, h = (int(part) for part in value.split(','))
+    return x, y, w, h
+
+
+class LocalDetector:
+    """
+    Haar cascade detector producing Modal compatible results.
+
+    Cascades are not safe to share between threads, so every worker thread
+    loads its own classifier the first time it runs and keeps it for the
+    lifetime of the container.
+    """
+
+    def __init__(self, cascade_path, label, scale_factor=1.1, min_neighbors=4, min_size=(24, 24),
+                 max_side=MAX_DETECTION_SIDE, roi=None):
+        if not os.path.isabs(cascade_path):
+            raise ValueError(f"Cascade path must be absolute: {cascade_path}")
+        self.cascade_path = cascade_path
+        self.label = label
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = tuple(min_size)
+        self.max_side = max_side
+        self.roi = roi
+        self._local = threading.local()
+
+    def _get_classifier(self):
+        classifier = getattr(self._local, 'classifier', None)
+        if classifier is None:
+            classifier = cv2.CascadeClassifier(self.cascade_path)
+            if classifier.empty():
+                raise Exception(f"Failed to load Haar cascade from {self.cascade_path}")
+            self._local.classifier = classifier
+        return classifier
+
+    def _detect(self, image, roi):
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        # Restrict detection to the region of interest, clipped to the image
+        offset_x, offset_y = 0, 0
+        if roi is not None:
+            x, y, w, h = roi
+            x, y = max(0, x), max(0, y)
+            image = image[y:y + h, x:x + w]
+            offset_x, offset_y = x, y
+        if image.size == 0:
+            return []
+
+        # Detect on a downscaled copy; cascades scan every scale so full resolution only costs time
+        scale = 1.0
+        longest_side = max(image.shape[:2])
+        if self.max_side and longest_side > self.max_side:
+            scale = self.max_side / longest_side
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        image = cv2.equalizeHist(image)
+        min_size = (max(1, int(self.min_size[0] * scale)), max(1, int(self.min_size[1] * scale)))
+
+        boxes, _, weights = self._get_classifier().detectMultiScale3(
+            image,
+            scaleFactor=self.scale_factor,
+            minNeighbors=self.min_neighbors,
+            minSize=min_size,
+            outputRejectLevels=True
+        )
+
+        detections = []
+        for (x, y, w, h), weight in zip(boxes, np.ravel(weights)):
+            x1 = x / scale + offset_x
+            y1 = y / scale + offset_y
+            detections.append({
+                "bbox": [round(x1), round(y1), round(x1 + w / scale), round(y1 + h / scale)],
+                # Map the weight of the last cascade stage into a 0-1 score
+                "confidence": round(1 / (1 + math.exp(-float(weight))), 4),
+                "class": self.label,
+                "source": "local"
+            })
+        return detections
+
+    def submit(self, image, roi=None):
+        """Queue detection of a decoded image on the worker pool and return a future."""
+        return get_executor().submit(self._detect, image, roi if roi is not None else self.roi)
+
+    def detect(self, image, roi=None):
+        """Detect objects in a decoded BGR or grayscale image."""
+        return self.submit(image, roi).result()
+
+    def detect_bytes(self, image_data, roi=None):
+        """Decode encoded image bytes (e.g. a JPEG from S3) and detect objects in them."""
+        image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise Exception("Failed to decode image for local detection.")
+        return self.detect(image, roi)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a bundled Haar cascade on image files and print the detections as JSON.")
+    parser.add_argument('--cascade', required=True, help="Path to the cascade XML file")
+    parser.add_argument('--label', required=True, help="Class name reported for detections, e.g. car or person")
+    parser.add_argument('--roi', help="Optional region of interest as x,y,w,h")
+    parser.add_argument('images', nargs='+', help="Image files to run detection on")
+    args = parser.parse_args()
+
+    params = VEHICLE_PARAMS if args.label in ('car', 'vehicle') else PERSON_PARAMS
+    detector = LocalDetector(os.path.abspath(args.cascade), args.label, roi=parse_roi(args.roi), **params)
+    futures = {path: detector.submit(cv2.imread(path, cv2.IMREAD_GRAYSCALE)) for path in args.images}
+    print(json.dumps({path: future.result() for path, future in futures.items()}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Client-side preprocessing of the frames sent to the remote detectors.
+
+The Modal detectors resize every image to their own input resolution, so
+sending a full-resolution JPEG only pays for upload time and server-side
+decoding. With ``DETECTOR_INPUT_SIZE`` set, frames larger than that are
+decoded, scaled down so their longest side matches the model input,
+re-encoded at ``DETECTOR_INPUT_QUALITY`` and sent instead of the original.
+The boxes of the results are scaled back to the original frame, so callers
+see the same coordinates as before.
+
+JPEGs at least twice the input size are decoded at reduced resolution by
+libjpeg (``IMREAD_REDUCED_COLOR_2``), which decodes the large frames several
+times faster.
+
+Configuration comes from environment variables:
+    DETECTOR_INPUT_SIZE      Longest side of the images sent to the detectors (default: 0, send originals)
+    DETECTOR_INPUT_QUALITY   JPEG quality of the resized images (default: 85)
+"""
+import os
+
+from shared.clients import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+DETECTOR_INPUT_SIZE = int(os.environ.get('DETECTOR_INPUT_SIZE', '0'))
+DETECTOR_INPUT_QUALITY = int(os.environ.get('DETECTOR_INPUT_QUALITY', '85'))
+
+
+def _decode(image_data, max_side):
+    """Decode an image, at reduced resolution when that still covers ``max_side``; returns the image and its reduction."""
+    buffer = np.frombuffer(image_data, dtype=np.uint8)
+    image = cv2.imdecode(buffer, cv2.IMREAD_REDUCED_COLOR_2)
+    if image is not None and max(image.shape[:2]) >= max_side:
+        return image, 2
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR), 1
+
+
+def prepare_image(image_data, max_side=None, quality=None):
+    """
+    Scale an encoded image down to the model input size and re-encode it.
+
+    Args:
+        image_data: Encoded image
+        max_side: Longest side of the image sent, 0 to send the original
+        quality: JPEG quality of the re-encoded image
+
+    Returns:
+        The bytes to send, and the ``(x, y)`` factors from their pixels to the
+        original ones, or None when the original is sent.
+    """
+    max_side = DETECTOR_INPUT_SIZE if max_side is None else max_side
+    quality = quality or DETECTOR_INPUT_QUALITY
+    if not max_side:
+        return image_data, None
+
+    image, reduction = _decode(image_data, max_side)
+    if image is None:
+        # Left to the detector, which reports undecodable images itself
+        return image_data, None
+    height, width = image.shape[:2]
+    if reduction == 1 and max(height, width) <= max_side:
+        return image_data, None
+
+    factor = max_side / max(height, width)
+    size = (max(1, round(width * factor)), max(1, round(height * factor)))
+    resized = cv2.resize(image, size, interpolation=cv2.INTER_AREA) if factor < 1 else image
+    ok, buffer = cv2.imencode('.jpg', resized, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok or len(buffer) >= len(image_data):
+        return image_data, None
+    return buffer.tobytes(), (width * reduction / resized.shape[1], height * reduction / resized.shape[0])
+
+
+def rescale_results(results, scale):
+    """Map the boxes of detector results from the sent image back to the original frame."""
+    if scale is None or not isinstance(results, list):
+        return results
+    scale_x, scale_y = scale
+    rescaled = []
+    for detection in results:
+        bbox = detection.get('bbox') if isinstance(detection, dict) else None
+        if bbox is not None and len(bbox) == 4:
+            factors = (scale_x, scale_y, scale_x, scale_y)
+            detection = dict(detection, bbox=[
+                round(value * factor) if isinstance(value, int) else round(value * factor, 2)
+                for value, factor in zip(bbox, factors)
+            ])
+        rescaled.append(detection)
+    return rescaled
@@ -0,0 +1,182 @@
+"""
+Write-behind buffering of MongoDB result updates.
+
+Updates are collected during an invocation and written with one unordered
+``bulk_write`` per collection when the buffer is flushed, instead of one
+blocking ``update_one`` round trip per frame and collection. Updates to the
+same document are merged into a single operation. An update that cannot be
+merged with the one before it is written in a later pass, once the bulk write
+holding the earlier update completed, because an unordered bulk write may
+apply its operations in any order.
+
+Every update can carry a tag (the SQS message id). Tags of operations that
+could not be written are returned by :meth:`WriteBehindBuffer.flush` so the
+corresponding messages can be reported as failed and retried.
+"""
+import json
+import os
+import threading
+
+from shared.clients import lazy_import
+from shared.instrumentation import get_logger
+from shared.sqs_batch import check_record_cancelled
+
+pymongo = lazy_import('pymongo')
+logger = get_logger(__name__)
+
+# Pending operations that trigger an early flush
+FLUSH_THRESHOLD = int(os.environ.get('MONGO_FLUSH_THRESHOLD', '500'))
+
+# Operators whose values can be combined when two updates target the same field
+_MERGEABLE_OPERATORS = ('$set', '$setOnInsert', '$unset', '$inc', '$min', '$max')
+
+
+def _paths_conflict(path, other):
+    return path.startswith(other + '.') or other.startswith(path + '.')
+
+
+def _merge_updates(current, update):
+    """Merge ``update`` into ``current`` in place, returning False when they cannot be combined."""
+    for operator, fields in update.items():
+        for field in fields:
+            for other_operator, other_fields in current.items():
+                for other_field in other_fields:
+                    if _paths_conflict(field, other_field):
+                        return False
+                    if field == other_field and (operator != other_operator or operator not in _MERGEABLE_OPERATORS):
+                        return False
+
+    for operator, fields in update.items():
+        existing = current.setdefault(operator, {})
+        for field, value in fields.items():
+            if field in existing and operator == '$inc':
+                existing[field] += value
+            elif field in existing and operator == '$min':
+                existing[field] = min(existing[field], value)
+            elif field in existing and operator == '$max':
+                existing[field] = max(existing[field], value)
+            elif field in existing and operator == '$setOnInsert':
+                continue
+            else:
+                existing[field] = value
+    return True
+
+
+class PendingOperation:
+    def __init__(self, query, update, upsert, tag):
+        self.query = query
+        self.update = {operator: dict(fields) for operator, fields in update.items()}
+        self.upsert = upsert
+        self.tags = {tag} if tag is not None else set()
+
+
+class WriteBehindBuffer:
+    """
+    Buffers ``update_one`` style operations and writes them in bulk.
+
+    Args:
+        flush_threshold: Number of pending operations that triggers a flush
+    """
+
+    def __init__(self, flush_threshold=FLUSH_THRESHOLD):
+        self.flush_threshold = flush_threshold
+        self._collections = {}
+        self._pending = {}
+        self._pending_count = 0
+        self._failed_tags = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def update_one(self, collection, query, update, upsert=True, tag=None):
+        """
+        Queue an update for ``collection``, merging it with a pending update of the same document.
+
+        Raises DeadlineExceeded in a record abandoned at the invocation deadline,
+        whose message is redelivered and written then.
+        """
+        check_record_cancelled()
+        name = collection.full_name
+        document_key = json.dumps(query, sort_keys=True, default=str)
+
+        with self._lock:
+            self._collections[name] = collection
+            passes = self._pending.setdefault(name, [{}])
+            # The latest pending operation of the document is in the last pass that has one
+            latest = next((index for index in range(len(passes) - 1, -1, -1) if document_key in passes[index]), None)
+            operation = passes[latest][document_key] if latest is not None else None
+            if operation is not None and operation.upsert == upsert and _merge_updates(operation.update, update):
+                if tag is not None:
+                    operation.tags.add(tag)
+            else:
+                target = 0 if latest is None else latest + 1
+                if target == len(passes):
+                    passes.append({})
+                passes[target][document_key] = PendingOperation(query, update, upsert, tag)
+                self._pending_count += 1
+            flush_now = self._pending_count >= self.flush_threshold
+
+        if flush_now:
+            self._write(self._take_pending())
+
+    def _take_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._pending_count = 0
+            return pending
+
+    def _bulk_write(self, name, operations, summary):
+        """Write one pass of operations; returns the indexes of those that failed."""
+        requests = [pymongo.UpdateOne(op.query, op.update, upsert=op.upsert) for op in operations]
+        counts = summary.setdefault(name, {"operations": 0})
+        counts["operations"] += len(requests)
+        try:
+            result = self._collections[name].bulk_write(requests, ordered=False)
+            if not result.acknowledged:
+                raise Exception("bulk write was not acknowledged")
+            for key, value in (("matched", result.matched_count), ("modified", result.modified_count),
+                               ("upserted", result.upserted_count)):
+                counts[key] = counts.get(key, 0) + value
+            return set()
+        except pymongo.errors.BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            failed = {error['index'] for error in write_errors}
+            if e.details.get('writeConcernErrors'):
+                # The writes may not be durable, so retry all of them
+                failed = set(range(len(operations)))
+            logger.warning("%d of %d writes to %s failed: %s", len(write_errors), len(requests), name, write_errors[:3])
+        except Exception as e:
+            failed = set(range(len(operations)))
+            logger.error("Bulk write of %d operations to %s failed - %s", len(requests), name, e)
+        counts["failed"] = counts.get("failed", 0) + len(failed)
+        return failed
+
+    def _write(self, pending):
+        summary = {}
+        with self._flush_lock:
+            for name, passes in pending.items():
+                failed_documents = set()
+                for operations in passes:
+                    # A later update of a document whose earlier update failed waits for its retry
+                    skipped = [op for key, op in operations.items() if key in failed_documents]
+                    keys = [key for key in operations if key not in failed_documents]
+                    failed = self._bulk_write(name, [operations[key] for key in keys], summary) if keys else set()
+                    failed_documents.update(keys[index] for index in failed)
+                    with self._lock:
+                        for op in skipped + [operations[keys[index]] for index in failed]:
+                            self._failed_tags.update(op.tags)
+        return summary
+
+    def flush(self):
+        """
+        Write all pending operations.
+
+        Returns:
+            The tags of all operations that failed since the last flush,
+            including those of earlier threshold-triggered writes.
+        """
+        summary = self._write(self._take_pending())
+        if summary:
+            logger.debug("MongoDB bulk write summary: %s", summary)
+        with self._lock:
+            failed_tags, self._failed_tags = self._failed_tags, set()
+        return sorted(failed_tags)
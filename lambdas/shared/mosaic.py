@@ -0,0 +1,179 @@
+"""
+Mosaic tiling of small frames into one call to the remote detectors.
+
+The remote detectors resize every image to their input resolution, so a
+low-resolution frame fills only part of the model input but still costs a
+full invocation. The records of a batch are processed concurrently, and
+``MosaicBatcher`` collects the frames that arrive together: frames that fit a
+cell of the mosaic grid wait up to ``MOSAIC_MAX_WAIT_MS`` for others, are
+tiled into one canvas of ``MOSAIC_CANVAS_SIZE`` pixels and sent as one
+request. The detections are split back to the frame whose tile contains
+them, in that frame's pixel coordinates; detections that cross a tile border
+or lie in the gutters between tiles are dropped.
+
+A frame that waited alone is sent unchanged, and frames larger than a cell
+always are. Track ids returned for a mosaic are those of the canvas, so they
+are not stable per stream, and the fallback detector of ``DetectorClient``
+then runs on the canvas without ``LOCAL_DETECTOR_ROI``.
+
+Configuration comes from environment variables:
+    MOSAIC_ENABLED       Tile concurrent small frames into one request (default: false)
+    MOSAIC_CANVAS_SIZE   Side of the canvas (default: DETECTOR_INPUT_SIZE, or 640)
+    MOSAIC_MAX_TILES     Frames per canvas, laid out in a square grid (default: 4)
+    MOSAIC_MAX_WAIT_MS   How long a frame waits for others (default: 50)
+    MOSAIC_GUTTER        Pixels between tiles (default: 16)
+"""
+import math
+import os
+import threading
+from concurrent.futures import Future, wait
+
+from shared.clients import lazy_import
+from shared.instrumentation import get_logger
+from shared.model_input import DETECTOR_INPUT_SIZE
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+logger = get_logger(__name__)
+
+MOSAIC_ENABLED = os.environ.get('MOSAIC_ENABLED', 'false').lower() == 'true'
+MOSAIC_CANVAS_SIZE = int(os.environ.get('MOSAIC_CANVAS_SIZE', str(DETECTOR_INPUT_SIZE or 640)))
+MOSAIC_MAX_TILES = int(os.environ.get('MOSAIC_MAX_TILES', '4'))
+MOSAIC_MAX_WAIT_MS = int(os.environ.get('MOSAIC_MAX_WAIT_MS', '50'))
+MOSAIC_GUTTER = int(os.environ.get('MOSAIC_GUTTER', '16'))
+
+# Grey of the letterbox padding the detectors use, for the gutters and empty cells
+FILL_VALUE = 114
+CANVAS_QUALITY = 90
+
+
+class Tile:
+    """A frame waiting for a mosaic, and the future of its detections."""
+
+    def __init__(self, image_data, image):
+        self.image_data = image_data
+        self.image = image
+        self.future = Future()
+        self.origin = None
+
+
+def split_results(results, tiles, tolerance=0):
+    """
+    Assign the detections on a canvas to the tiles that contain them.
+
+    Args:
+        results: Detections in canvas pixels
+        tiles: The tiles of the canvas, with their ``origin``
+        tolerance: Pixels a box may extend past its tile before it is dropped
+
+    Returns:
+        One list of detections per tile, in pixels of the tile's frame.
+    """
+    split = [[] for _ in tiles]
+    for detection in results:
+        bbox = detection.get('bbox') if isinstance(detection, dict) else None
+        if bbox is None or len(bbox) != 4:
+            continue
+        for index, tile in enumerate(tiles):
+            x, y = tile.origin
+            height, width = tile.image.shape[:2]
+            x1, y1, x2, y2 = bbox[0] - x, bbox[1] - y, bbox[2] - x, bbox[3] - y
+            if x1 >= -tolerance and y1 >= -tolerance and x2 <= width + tolerance and y2 <= height + tolerance:
+                limits = (width, height, width, height)
+                split[index].append(dict(detection, bbox=[
+                    min(max(value, 0), limit) for value, limit in zip((x1, y1, x2, y2), limits)
+                ]))
+                break
+    return split
+
+
+class MosaicBatcher:
+    """
+    Tiles small frames detected at the same time into one call of ``detect_fn``.
+
+    Args:
+        detect_fn: Callable running the model on encoded image bytes
+        canvas_size: Side of the canvas
+        max_tiles: Frames per canvas
+        max_wait: Seconds a frame waits for others
+        gutter: Pixels between tiles
+        enabled: When False every frame is passed to ``detect_fn`` unchanged
+    """
+
+    def __init__(self, detect_fn, canvas_size=None, max_tiles=None, max_wait=None, gutter=None, enabled=None):
+        self.detect_fn = detect_fn
+        self.canvas_size = canvas_size or MOSAIC_CANVAS_SIZE
+        self.max_tiles = max_tiles or MOSAIC_MAX_TILES
+        self.max_wait = MOSAIC_MAX_WAIT_MS / 1000 if max_wait is None else max_wait
+        self.gutter = MOSAIC_GUTTER if gutter is None else gutter
+        self.enabled = MOSAIC_ENABLED if enabled is None else enabled
+        self.grid = math.ceil(math.sqrt(self.max_tiles))
+        self.cell_size = (self.canvas_size - self.gutter * (self.grid - 1)) // self.grid
+        self.requests = 0
+        self.frames = 0
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def _fits(self, image):
+        return image is not None and max(image.shape[:2]) <= self.cell_size
+
+    def detect(self, image_data):
+        """Return the detections for an encoded frame, sent in a mosaic when possible."""
+        if not self.enabled or self.grid < 2:
+            return self.detect_fn(image_data)
+        image = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if not self._fits(image):
+            return self.detect_fn(image_data)
+
+        tile = Tile(image_data, image)
+        batch = None
+        with self._lock:
+            self._pending.append(tile)
+            if len(self._pending) >= self.max_tiles:
+                batch, self._pending = self._pending, []
+        if batch is None and not wait([tile.future], timeout=self.max_wait).done:
+            with self._lock:
+                # Unless another frame filled the mosaic meanwhile, this one sends what is waiting
+                if tile in self._pending:
+                    batch, self._pending = self._pending, []
+        if batch is not None:
+            self._send(batch)
+        return tile.future.result()
+
+    def _send(self, tiles):
+        with self._lock:
+            self.requests += 1
+            self.frames += len(tiles)
+        try:
+            if len(tiles) == 1:
+                tiles[0].future.set_result(self.detect_fn(tiles[0].image_data))
+                return
+            results = self.detect_fn(self._canvas(tiles))
+        except Exception as e:
+            for tile in tiles:
+                tile.future.set_exception(e)
+            return
+
+        if not isinstance(results, list):
+            for tile in tiles:
+                tile.future.set_result(results)
+            return
+        split = split_results(results, tiles, tolerance=self.gutter // 2)
+        logger.debug("Mosaic of %d frames, %d of %d detections kept", len(tiles), sum(map(len, split)), len(results))
+        for tile, tile_results in zip(tiles, split):
+            tile.future.set_result(tile_results)
+
+    def _canvas(self, tiles):
+        """Encode the tiles on a canvas, setting their ``origin``; unused rows are left out."""
+        step = self.cell_size + self.gutter
+        rows = math.ceil(len(tiles) / self.grid)
+        canvas = np.full((rows * step - self.gutter, self.canvas_size, 3), FILL_VALUE, dtype=np.uint8)
+        for index, tile in enumerate(tiles):
+            row, column = divmod(index, self.grid)
+            tile.origin = (column * step, row * step)
+            height, width = tile.image.shape[:2]
+            canvas[row * step:row * step + height, column * step:column * step + width] = tile.image
+        ok, buffer = cv2.imencode('.jpg', canvas, [cv2.IMWRITE_JPEG_QUALITY, CANVAS_QUALITY])
+        if not ok:
+            raise Exception("Failed to encode mosaic.")
+        return buffer.tobytes()
@@ -0,0 +1,187 @@
+"""
+Motion gating for the remote person and vehicle detectors.
+
+The gate keeps, per stream, the last frame that went through the model and the
+detections it produced. A new frame is compared with that frame on a cheap,
+reduced-resolution grayscale decode. When enough of the scene changed the
+model is called; otherwise the previous detections are propagated, optionally
+shifted by sparse optical flow, and marked with ``"propagated": True``.
+
+Frames of one stream pass the gate one at a time, so a frame of a batch is
+compared with the frames inferred before it in the same batch. A frame older
+than the one the state was stored for does not replace that state.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from shared.clients import lazy_import
+from shared.instrumentation import get_logger
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+logger = get_logger(__name__)
+
+# Fraction of changed pixels above which a frame is sent to the model
+MOTION_THRESHOLD = float(os.environ.get('MOTION_GATE_THRESHOLD', '0.02'))
+
+# Force an inference after this many consecutive propagated frames of a stream
+MAX_PROPAGATIONS = int(os.environ.get('MOTION_GATE_MAX_PROPAGATIONS', '10'))
+
+# Shift propagated boxes with Lucas-Kanade optical flow
+USE_OPTICAL_FLOW = os.environ.get('MOTION_GATE_OPTICAL_FLOW', 'true').lower() == 'true'
+
+# Number of streams whose state is kept in the container
+MAX_STREAMS = int(os.environ.get('MOTION_GATE_MAX_STREAMS', '256'))
+
+# JPEGs are decoded at a quarter of their resolution, which libjpeg does without a full decode
+REDUCED_SCALE = 4
+
+# Per-pixel grayscale difference counted as a change
+PIXEL_DIFF_THRESHOLD = 25
+
+MOTION_WIDTH = 160
+
+
+class StreamState:
+    """Last inferred frame of a stream and the detections produced for it."""
+
+    def __init__(self, frame, results, frame_number=None):
+        self.frame = frame
+        self.frame_number = frame_number
+        self.motion_frame = to_motion_frame(frame)
+        self.results = results
+        self.propagations = 0
+        self.features = None
+        if USE_OPTICAL_FLOW:
+            self.features = cv2.goodFeaturesToTrack(frame, maxCorners=200, qualityLevel=0.01, minDistance=5)
+
+
+def decode_reduced(image_data):
+    """Decode encoded image bytes into a grayscale image at a quarter of the resolution."""
+    frame = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if frame is None:
+        raise Exception("Failed to decode image for motion gating.")
+    return frame
+
+
+def to_motion_frame(frame):
+    """Small, blurred copy of the frame used to measure motion."""
+    height = max(1, round(frame.shape[0] * MOTION_WIDTH / frame.shape[1]))
+    small = cv2.resize(frame, (MOTION_WIDTH, height), interpolation=cv2.INTER_AREA)
+    return cv2.GaussianBlur(small, (5, 5), 0)
+
+
+def measure_motion(reference, frame):
+    """Return the fraction of pixels that changed between two motion frames."""
+    if reference.shape != frame.shape:
+        return 1.0
+    changed = cv2.absdiff(reference, frame) > PIXEL_DIFF_THRESHOLD
+    return float(np.count_nonzero(changed)) / changed.size
+
+
+def shift_detections(results, state, frame):
+    """Copy the detections of the last inferred frame, shifted by the optical flow to this frame."""
+    if not isinstance(results, list):
+        return results
+
+    points, flow = None, None
+    if state.features is not None and state.frame.shape == frame.shape:
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(state.frame, frame, state.features, None)
+        tracked = status.ravel() == 1
+        points = state.features.reshape(-1, 2)[tracked]
+        flow = (moved.reshape(-1, 2) - state.features.reshape(-1, 2))[tracked]
+
+    propagated = []
+    for detection in results:
+        if not isinstance(detection, dict):
+            propagated.append(detection)
+            continue
+        detection = dict(detection, propagated=True)
+        bbox = detection.get('bbox')
+        if bbox is not None and points is not None and len(points):
+            x1, y1, x2, y2 = (value / REDUCED_SCALE for value in bbox)
+            inside = (points[:, 0] >= x1) & (points[:, 0] <= x2) & (points[:, 1] >= y1) & (points[:, 1] <= y2)
+            if inside.any():
+                dx, dy = np.median(flow[inside], axis=0) * REDUCED_SCALE
+                detection['bbox'] = [round(bbox[0] + dx), round(bbox[1] + dy), round(bbox[2] + dx), round(bbox[3] + dy)]
+        propagated.append(detection)
+    return propagated
+
+
+class MotionGate:
+    """
+    Decides per frame whether to call the model or reuse the previous detections of the stream.
+
+    Args:
+        motion_threshold: Fraction of changed pixels that triggers an inference
+        max_propagations: Consecutive propagated frames before an inference is forced
+        max_streams: Number of streams kept, least recently used streams are evicted
+    """
+
+    def __init__(self, motion_threshold=MOTION_THRESHOLD, max_propagations=MAX_PROPAGATIONS, max_streams=MAX_STREAMS):
+        self.motion_threshold = motion_threshold
+        self.max_propagations = max_propagations
+        self.max_streams = max_streams
+        self.inferred = 0
+        self.propagated = 0
+        self._streams = OrderedDict()
+        self._stream_locks = {}
+        self._lock = threading.Lock()
+
+    def _stream_lock(self, stream_id):
+        with self._lock:
+            return self._stream_locks.setdefault(stream_id, threading.Lock())
+
+    def _get_state(self, stream_id):
+        with self._lock:
+            state = self._streams.get(stream_id)
+            if state is not None:
+                self._streams.move_to_end(stream_id)
+            return state
+
+    def _set_state(self, stream_id, state):
+        with self._lock:
+            current = self._streams.get(stream_id)
+            if current is not None and None not in (current.frame_number, state.frame_number) \
+                    and state.frame_number < current.frame_number:
+                # A frame processed late must not replace the state of a newer frame
+                return
+            self._streams[stream_id] = state
+            self._streams.move_to_end(stream_id)
+            while len(self._streams) > self.max_streams:
+                evicted, _ = self._streams.popitem(last=False)
+                self._stream_locks.pop(evicted, None)
+
+    def detect(self, stream_id, image_data, detect_fn, frame_number=None):
+        """
+        Return the detections for a frame of the stream.
+
+        Args:
+            stream_id: Stream the frame belongs to
+            image_data: Encoded image bytes
+            detect_fn: Callable running the model on the encoded image bytes
+            frame_number: Number of the frame in its stream, when known
+
+        Returns:
+            A ``(results, propagated)`` tuple.
+        """
+        frame = decode_reduced(image_data)
+        # Frames of the stream wait for each other, so each is compared with the one inferred before it
+        with self._stream_lock(stream_id):
+            state = self._get_state(stream_id)
+
+            if state is not None and state.propagations < self.max_propagations:
+                motion = measure_motion(state.motion_frame, to_motion_frame(frame))
+                if motion < self.motion_threshold:
+                    state.propagations += 1
+                    with self._lock:
+                        self.propagated += 1
+                    logger.debug("Motion %.4f below threshold for stream %s, propagating detections", motion, stream_id)
+                    return shift_detections(state.results, state, frame), True
+
+            results = detect_fn(image_data)
+            self._set_state(stream_id, StreamState(frame, results, frame_number))
+        with self._lock:
+            self.inferred += 1
+        return results, False
@@ -0,0 +1,262 @@
+"""
+Motion crops: send the changed parts of a frame to the detectors instead of the whole frame.
+
+With ``MOTION_CROPS_ENABLED`` the extractor finds the regions that changed
+since the frame it uploaded before, on a small blurred grayscale copy of the
+two frames, and lists them with the frame in its manifest as boxes
+normalized to the uploaded frame, together with the number of that
+reference frame::
+
+    {"key": "12_cam_north/frame_0042.jpg", ..., "regions": [[0.41, 0.32, 0.58, 0.61]], "reference_frame": 37}
+
+The person and vehicle detectors then pad the regions, merge the ones that
+overlap and send each crop to the model on its own. The boxes of the results
+are translated back to the full frame. Objects that did not move are outside
+the crops, so the detections of the reference frame outside the crops are
+added to the results; ``CropReferences`` keeps the recent results of every
+stream for this, and ``shared.sqs_batch`` runs the frames of a stream one
+after another, so the reference frame is detected before the frames cropped
+against it. Frames whose reference frame was not detected in the
+container (the first frame of a video, frames announced by S3 notifications,
+frames processed out of order) and frames whose crops would cover more than
+``MOTION_CROPS_MAX_AREA`` of the frame are sent whole.
+
+Configuration comes from environment variables:
+    MOTION_CROPS_ENABLED       Publish changed regions and send crops (default: false)
+    MOTION_CROPS_PADDING       Padding around a region, as a fraction of its size (default: 0.25)
+    MOTION_CROPS_MIN_PADDING   Padding of at least this many pixels (default: 32)
+    MOTION_CROPS_MERGE         Merge overlapping crops into one (default: true)
+    MOTION_CROPS_MAX_AREA      Fraction of the frame above which it is sent whole (default: 0.6)
+    MOTION_CROPS_MAX_REGIONS   Regions listed per frame; more are joined into one (default: 8)
+    MOTION_CROPS_REFERENCES    Frames whose results are kept as references, over all streams (default: 1024)
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from shared.clients import lazy_import
+from shared.instrumentation import get_logger
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+logger = get_logger(__name__)
+
+MOTION_CROPS_ENABLED = os.environ.get('MOTION_CROPS_ENABLED', 'false').lower() == 'true'
+MOTION_CROPS_PADDING = float(os.environ.get('MOTION_CROPS_PADDING', '0.25'))
+MOTION_CROPS_MIN_PADDING = int(os.environ.get('MOTION_CROPS_MIN_PADDING', '32'))
+MOTION_CROPS_MERGE = os.environ.get('MOTION_CROPS_MERGE', 'true').lower() == 'true'
+MOTION_CROPS_MAX_AREA = float(os.environ.get('MOTION_CROPS_MAX_AREA', '0.6'))
+MOTION_CROPS_MAX_REGIONS = int(os.environ.get('MOTION_CROPS_MAX_REGIONS', '8'))
+MOTION_CROPS_REFERENCES = int(os.environ.get('MOTION_CROPS_REFERENCES', '1024'))
+
+# Width of the grayscale copies that are differenced, and the changes that count
+REGION_WIDTH = 160
+PIXEL_DIFF_THRESHOLD = 25
+
+# Changed areas smaller than this fraction of the frame are noise
+MIN_REGION_AREA = 0.0005
+
+CROP_QUALITY = 95
+
+
+def _motion_frame(frame, width):
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame[:, :, :3], cv2.COLOR_RGB2GRAY)
+    height = max(1, round(frame.shape[0] * width / frame.shape[1]))
+    small = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    return cv2.GaussianBlur(small, (5, 5), 0)
+
+
+def union(boxes):
+    """Return the bounding box of ``[x1, y1, x2, y2]`` boxes."""
+    return [min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes)]
+
+
+def changed_regions(frame1, frame2, roi=None, max_regions=None):
+    """
+    Return the regions that changed between two RGB frames.
+
+    Args:
+        frame1: The frame before
+        frame2: The frame whose regions are returned
+        roi: Region of interest of the stream; changes outside its polygons are ignored
+        max_regions: Regions returned at most; more are joined into their bounding box
+
+    Returns:
+        ``[x1, y1, x2, y2]`` boxes normalized to the frame as uploaded, i.e. to
+        the bounding box of the region of interest when the stream crops to it.
+    """
+    max_regions = max_regions or MOTION_CROPS_MAX_REGIONS
+    if frame1.shape[:2] != frame2.shape[:2]:
+        frame2 = cv2.resize(frame2, (frame1.shape[1], frame1.shape[0]))
+    full_height, full_width = frame1.shape[:2]
+    offset_x, offset_y = 0, 0
+    if roi is not None:
+        (offset_x, offset_y, _, _), _, _ = roi.mask(frame1.shape)
+        frame1, frame2 = roi.apply(frame1), roi.apply(frame2)
+
+    height, width = frame1.shape[:2]
+    small1 = _motion_frame(frame1, min(REGION_WIDTH, width))
+    small2 = _motion_frame(frame2, min(REGION_WIDTH, width))
+    changed = (cv2.absdiff(small1, small2) > PIXEL_DIFF_THRESHOLD).astype(np.uint8)
+    # Join the parts of one moving object
+    changed = cv2.dilate(changed, np.ones((3, 3), np.uint8), iterations=2)
+    count, _, stats, _ = cv2.connectedComponentsWithStats(changed)
+
+    scale_x, scale_y = width / small1.shape[1], height / small1.shape[0]
+    boxes = [
+        [x * scale_x, y * scale_y, (x + w) * scale_x, (y + h) * scale_y]
+        for x, y, w, h, area in stats[1:count]
+        if area >= MIN_REGION_AREA * changed.size
+    ]
+    if len(boxes) > max_regions:
+        boxes = [union(boxes)]
+
+    if roi is None or roi.crop:
+        frame_width, frame_height = width, height
+    else:
+        frame_width, frame_height = full_width, full_height
+        boxes = [[x1 + offset_x, y1 + offset_y, x2 + offset_x, y2 + offset_y] for x1, y1, x2, y2 in boxes]
+    return [[round(float(x1) / frame_width, 4), round(float(y1) / frame_height, 4),
+             round(float(x2) / frame_width, 4), round(float(y2) / frame_height, 4)] for x1, y1, x2, y2 in boxes]
+
+
+def merge_overlapping(boxes):
+    """Join boxes that overlap until none do."""
+    boxes = [list(box) for box in boxes]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = union([a, b])
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+def crop_boxes(regions, width, height, padding=None, min_padding=None, merge=None):
+    """Convert normalized regions to padded pixel boxes within a ``width`` x ``height`` frame."""
+    padding = MOTION_CROPS_PADDING if padding is None else padding
+    min_padding = MOTION_CROPS_MIN_PADDING if min_padding is None else min_padding
+    merge = MOTION_CROPS_MERGE if merge is None else merge
+    boxes = []
+    for x1, y1, x2, y2 in regions:
+        x1, y1, x2, y2 = x1 * width, y1 * height, x2 * width, y2 * height
+        pad_x = max((x2 - x1) * padding, min_padding)
+        pad_y = max((y2 - y1) * padding, min_padding)
+        box = [max(0, int(x1 - pad_x)), max(0, int(y1 - pad_y)), min(width, int(np.ceil(x2 + pad_x))), min(height, int(np.ceil(y2 + pad_y)))]
+        if box[2] > box[0] and box[3] > box[1]:
+            boxes.append(box)
+    return merge_overlapping(boxes) if merge else boxes
+
+
+def translate_results(results, x, y):
+    """Move the boxes of detections on a crop at ``(x, y)`` to the full frame."""
+    translated = []
+    for detection in results:
+        bbox = detection.get('bbox') if isinstance(detection, dict) else None
+        if bbox is not None and len(bbox) == 4:
+            detection = dict(detection, bbox=[bbox[0] + x, bbox[1] + y, bbox[2] + x, bbox[3] + y])
+        translated.append(detection)
+    return translated
+
+
+def outside_crops(results, boxes):
+    """Return the detections whose boxes do not overlap any of the crop ``boxes``."""
+    kept = []
+    for detection in results:
+        bbox = detection.get('bbox') if isinstance(detection, dict) else None
+        if bbox is None or len(bbox) != 4:
+            continue
+        if not any(bbox[0] < x2 and x1 < bbox[2] and bbox[1] < y2 and y1 < bbox[3] for x1, y1, x2, y2 in boxes):
+            kept.append(detection)
+    return kept
+
+
+def detect_regions(image_data, regions, detect_fn, reference=None, max_area=None, enabled=None, **crop_options):
+    """
+    Run ``detect_fn`` on padded crops of the changed regions of a frame.
+
+    Args:
+        image_data: Encoded frame
+        regions: Normalized changed regions of the frame, from the manifest
+        detect_fn: Callable running the model on encoded image bytes
+        reference: Detections of the frame the regions were measured against;
+            without them the whole frame is sent
+        max_area: Fraction of the frame above which it is sent whole
+        enabled: When False the whole frame is sent
+        crop_options: ``padding``, ``min_padding`` and ``merge`` of :func:`crop_boxes`
+
+    Returns:
+        The detections in the crops and the detections of ``reference``
+        outside them, in pixels of the full frame.
+    """
+    enabled = MOTION_CROPS_ENABLED if enabled is None else enabled
+    max_area = MOTION_CROPS_MAX_AREA if max_area is None else max_area
+    if not enabled or not regions or not isinstance(reference, list):
+        return detect_fn(image_data)
+    image = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return detect_fn(image_data)
+
+    height, width = image.shape[:2]
+    boxes = crop_boxes(regions, width, height, **crop_options)
+    if not boxes or sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in boxes) > max_area * width * height:
+        return detect_fn(image_data)
+
+    # Objects that did not move since the reference frame are where they were detected
+    results = outside_crops(reference, boxes)
+    carried = len(results)
+    for x1, y1, x2, y2 in boxes:
+        ok, buffer = cv2.imencode('.jpg', image[y1:y2, x1:x2], [cv2.IMWRITE_JPEG_QUALITY, CROP_QUALITY])
+        if not ok:
+            return detect_fn(image_data)
+        crop_results = detect_fn(buffer.tobytes())
+        if isinstance(crop_results, list):
+            results.extend(translate_results(crop_results, x1, y1))
+    logger.debug("Sent %d motion crops, %d detections and %d from the reference frame",
+                 len(boxes), len(results) - carried, carried)
+    return results
+
+
+class CropReferences:
+    """
+    Results of the recent frames of every stream, the reference of the cropped frames that follow them.
+
+    Args:
+        max_frames: Frames kept, least recently used frames are evicted
+        enabled: When False nothing is kept
+    """
+
+    def __init__(self, max_frames=None, enabled=None):
+        self.max_frames = max_frames or MOTION_CROPS_REFERENCES
+        self.enabled = MOTION_CROPS_ENABLED if enabled is None else enabled
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, stream_id, frame_number):
+        """Return the results of a frame of the stream, or None when they are not known."""
+        if frame_number is None:
+            return None
+        with self._lock:
+            results = self._frames.get((stream_id, frame_number))
+            if results is not None:
+                self._frames.move_to_end((stream_id, frame_number))
+            return results
+
+    def put(self, stream_id, frame_number, results):
+        """Keep the results of a frame; results that are not a list of detections are not a reference."""
+        if not self.enabled or frame_number is None or not isinstance(results, list):
+            return
+        with self._lock:
+            self._frames[(stream_id, frame_number)] = results
+            self._frames.move_to_end((stream_id, frame_number))
+            while len(self._frames) > self.max_frames:
+                self._frames.popitem(last=False)
@@ -0,0 +1,189 @@
+"""
+Opt-in CPU and memory profiling of Lambda invocations.
+
+Decorate a handler with :func:`profiled`. With ``PROFILE_MODE`` unset the
+handler is returned unchanged, so profiling costs nothing until it is
+switched on through the function configuration:
+
+    PROFILE_MODE          cprofile, tracemalloc or sample (default: off)
+    PROFILE_SAMPLE_RATE   Fraction of invocations profiled (default: 1)
+    PROFILE_OUTPUT        Local directory or s3://bucket/prefix (default: /tmp/profiles)
+    PROFILE_INTERVAL_MS   Stack sampling interval of the "sample" mode (default: 5)
+
+Every profiled invocation writes one file named after the function and the
+request id:
+
+- cprofile: ``.pstats``, for ``python -m pstats`` or snakeviz; covers the
+  handler thread only, use "sample" to see the SQS batch worker threads
+- tracemalloc: ``.tracemalloc``, load with ``tracemalloc.Snapshot.load``
+- sample: ``.collapsed`` stacks of all threads, for flamegraph.pl or speedscope
+"""
+import cProfile
+import collections
+import functools
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from shared.clients import get_s3_client
+from shared.instrumentation import get_logger
+
+logger = get_logger(__name__)
+
+PROFILE_MODE = os.environ.get('PROFILE_MODE', '').lower()
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '1'))
+PROFILE_OUTPUT = os.environ.get('PROFILE_OUTPUT', '/tmp/profiles')
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '5'))
+
+PROFILE_MODES = ('cprofile', 'tracemalloc', 'sample')
+
+# Frames kept per allocation traceback
+TRACEMALLOC_FRAMES = 25
+
+
+class StackSampler:
+    """Samples the stacks of all other threads at a fixed interval and counts collapsed stacks."""
+
+    def __init__(self, interval_ms=PROFILE_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        """Return the samples in the collapsed stack format ("frame;frame;frame count" per line)."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def _output_name(context, extension):
+    function_name = getattr(context, 'function_name', None) or os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+    request_id = getattr(context, 'aws_request_id', None) or f"{os.getpid()}-{time.monotonic_ns()}"
+    timestamp = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    return f"{function_name}/{timestamp}-{request_id}.{extension}"
+
+
+def write_profile(path, name, output=None):
+    """Store a profile file under ``output`` (a local directory or s3://bucket/prefix) and return its location."""
+    output = output or PROFILE_OUTPUT
+    if output.startswith('s3://'):
+        bucket, _, prefix = output[len('s3://'):].partition('/')
+        key = f"{prefix.rstrip('/')}/{name}" if prefix else name
+        get_s3_client().upload_file(path, bucket, key)
+        return f"s3://{bucket}/{key}"
+
+    destination = os.path.join(output, name)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    os.replace(path, destination)
+    return destination
+
+
+def _store(dump, path, context, extension, output, description):
+    """Dump a profile to ``path`` and store it; failures are logged and never fail the invocation."""
+    try:
+        dump(path)
+        location = write_profile(path, _output_name(context, extension), output)
+        logger.info("Wrote %s to %s", description, location)
+    except Exception as e:
+        logger.error("Failed to store %s - %s", description, e)
+
+
+def _write_text(text):
+    def dump(path):
+        with open(path, 'w') as f:
+            f.write(text)
+    return dump
+
+
+def _run_profiled(handler, mode, event, context, output):
+    fd, path = tempfile.mkstemp(prefix='profile-')
+    os.close(fd)
+    try:
+        if mode == 'cprofile':
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(handler, event, context)
+            finally:
+                _store(profiler.dump_stats, path, context, 'pstats', output, "cProfile stats")
+
+        elif mode == 'tracemalloc':
+            started = not tracemalloc.is_tracing()
+            if started:
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            tracemalloc.reset_peak()
+            try:
+                return handler(event, context)
+            finally:
+                current, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+                if started:
+                    tracemalloc.stop()
+                _store(snapshot.dump, path, context, 'tracemalloc', output,
+                       f"tracemalloc snapshot (current {current / 2**20:.1f} MB, peak {peak / 2**20:.1f} MB)")
+
+        else:
+            sampler = StackSampler()
+            sampler.start()
+            try:
+                return handler(event, context)
+            finally:
+                sampler.stop()
+                _store(_write_text(sampler.collapsed()), path, context, 'collapsed', output,
+                       f"{sum(sampler.stacks.values())} stack samples")
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def profiled(handler=None, mode=None, sample_rate=None, output=None):
+    """
+    Decorator profiling a fraction of the invocations of a Lambda handler.
+
+    Arguments default to the PROFILE_* environment variables. When no mode
+    is configured the handler itself is returned.
+    """
+    if handler is None:
+        return functools.partial(profiled, mode=mode, sample_rate=sample_rate, output=output)
+
+    mode = PROFILE_MODE if mode is None else mode
+    if not mode:
+        return handler
+    if mode not in PROFILE_MODES:
+        logger.error("Unknown PROFILE_MODE %r, expected one of %s; profiling is off", mode, ', '.join(PROFILE_MODES))
+        return handler
+    rate = PROFILE_SAMPLE_RATE if sample_rate is None else sample_rate
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if random.random() >= rate:
+            return handler(event, context)
+        return _run_profiled(handler, mode, event, context, output)
+
+    return wrapper
@@ -0,0 +1,77 @@
+"""
+Bucketed layout for the per-frame detection results.
+
+Instead of one document per stream that grows with every frame, results are
+written into bucket documents holding a fixed range of frames::
+
+    {
+        "stream_Id": "1234",
+        "bucket": 3,                 # frames 3000-3999
+        "frame_start": 3000,         # lowest and highest frame number stored so far
+        "frame_end": 3417,
+        "created_at": "...",
+        "updated_at": "...",
+        "vehicle_status": {"3000": [...], "3001": "No vehicles detected"},
+        "fire_status": {"3000": "fire not detected"}
+    }
+
+Frames whose id has no trailing number are bucketed by the hour they were
+stored in ("t2025-01-27T10"). A unique index on (stream_Id, bucket) keeps the
+cost of every update flat.
+"""
+import datetime
+import os
+import re
+
+# Number of frames stored in one bucket document
+BUCKET_SIZE = int(os.environ.get('RESULT_BUCKET_SIZE', '1000'))
+
+BUCKET_INDEX_NAME = "stream_bucket"
+
+_FRAME_NUMBER_PATTERN = re.compile(r'(\d+)$')
+
+
+def get_frame_number(frame_id):
+    """Return the trailing number of a frame id (e.g. 12 for "frame_0012"), or None."""
+    match = _FRAME_NUMBER_PATTERN.search(str(frame_id))
+    return int(match.group(1)) if match else None
+
+
+def get_bucket(frame_id, timestamp, bucket_size=BUCKET_SIZE):
+    """Return the bucket a frame belongs to: its frame range, or the hour of ``timestamp``."""
+    frame_number = get_frame_number(frame_id)
+    if frame_number is not None:
+        return frame_number // bucket_size
+    return "t" + timestamp[:13]
+
+
+def bucket_update(stream_id, detection_type, frame_id, detection_status, timestamp=None, bucket_size=BUCKET_SIZE):
+    """
+    Build the upsert storing one frame's detection status in its bucket document.
+
+    Returns:
+        A ``(query, update)`` tuple for ``update_one(..., upsert=True)``.
+    """
+    if timestamp is None:
+        timestamp = datetime.datetime.utcnow().isoformat()
+
+    bucket = get_bucket(frame_id, timestamp, bucket_size)
+    query = {"stream_Id": stream_id, "bucket": bucket}
+    update = {
+        "$set": {
+            "updated_at": timestamp,
+            f"{detection_type}.{frame_id}": detection_status
+        },
+        "$setOnInsert": {"created_at": timestamp}
+    }
+
+    frame_number = get_frame_number(frame_id)
+    if frame_number is not None:
+        update["$min"] = {"frame_start": frame_number}
+        update["$max"] = {"frame_end": frame_number}
+    return query, update
+
+
+def ensure_bucket_index(collection):
+    """Create the unique (stream_Id, bucket) index the bucketed updates rely on."""
+    collection.create_index([("stream_Id", 1), ("bucket", 1)], unique=True, name=BUCKET_INDEX_NAME)
@@ -0,0 +1,193 @@
+"""
+Query API for the bucketed detection results.
+
+Consumers of ``combined_output``, ``vehicle_detection_output`` and
+``human_detection_output`` read only the frames they need: bucket documents
+are selected through the (stream_Id, bucket) and (stream_Id, updated_at)
+indexes, and frames outside the requested range or detection types are
+trimmed on the server before anything is sent back.
+
+Indexes are created at deploy time with::
+
+    cd lambdas && python -m shared.results_query ensure-indexes
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from shared.result_buckets import BUCKET_SIZE, ensure_bucket_index, get_frame_number
+
+RESULT_COLLECTIONS = ["combined_output", "vehicle_detection_output", "human_detection_output"]
+
+DETECTION_TYPES = {
+    "combined_output": ["vehicle_status", "human_status", "fire_status", "fall_status"],
+    "vehicle_detection_output": ["vehicle_status"],
+    "human_detection_output": ["human_status"],
+}
+
+
+def ensure_indexes(db):
+    """Create the indexes the detectors and the queries below rely on."""
+    for name in RESULT_COLLECTIONS:
+        collection = db[name]
+        ensure_bucket_index(collection)
+        collection.create_index([("stream_Id", 1), ("updated_at", 1)], name="stream_updated_at")
+        collection.create_index([("updated_at", 1)], name="updated_at")
+
+
+def _frame_number_expression(key):
+    """Aggregation expression extracting the trailing frame number of a frame id."""
+    match = {"$regexFind": {"input": key, "regex": r"(\d+)$"}}
+    return {"$toInt": {"$arrayElemAt": [{"$let": {"vars": {"match": match}, "in": "$$match.captures"}}, 0]}}
+
+
+def _bucket_filter(stream_id, frame_start, frame_end, since, until, bucket_size):
+    query = {"stream_Id": stream_id}
+    if frame_start is not None or frame_end is not None:
+        query["bucket"] = {}
+        if frame_start is not None:
+            query["bucket"]["$gte"] = frame_start // bucket_size
+        if frame_end is not None:
+            query["bucket"]["$lte"] = frame_end // bucket_size
+        if frame_start is None:
+            # Numeric bounds only match numeric buckets, frame-less buckets are skipped
+            query["bucket"]["$gte"] = 0
+    if since is not None:
+        query["updated_at"] = {"$gte": since}
+    if until is not None:
+        query["created_at"] = {"$lte": until}
+    return query
+
+
+def find_frames(collection, stream_id, detection_types=None, frame_start=None, frame_end=None,
+                since=None, until=None, batch_size=100, bucket_size=BUCKET_SIZE):
+    """
+    Yield the stored detection results of a stream, in frame order.
+
+    Args:
+        collection: One of the result collections
+        stream_id: Stream to read
+        detection_types: Detection types to return, e.g. ["vehicle_status"]; all by default
+        frame_start: First frame number to return (inclusive)
+        frame_end: Last frame number to return (inclusive)
+        since: Only buckets updated at or after this ISO timestamp
+        until: Only buckets created at or before this ISO timestamp
+        batch_size: Number of bucket documents fetched per round trip
+
+    Yields:
+        Dicts with ``stream_Id``, ``frame_id``, ``detection_type`` and ``status``.
+    """
+    if detection_types is None:
+        detection_types = DETECTION_TYPES.get(collection.name, DETECTION_TYPES["combined_output"])
+
+    query = _bucket_filter(stream_id, frame_start, frame_end, since, until, bucket_size)
+    if frame_start is None and frame_end is None:
+        projection = {"_id": 0, "bucket": 1}
+        projection.update({detection_type: 1 for detection_type in detection_types})
+        cursor = collection.find(query, projection).sort("bucket", 1).batch_size(batch_size)
+    else:
+        # Trim the frames of each bucket to the requested range on the server
+        conditions = []
+        frame_number = _frame_number_expression("$$frame.k")
+        if frame_start is not None:
+            conditions.append({"$gte": [frame_number, frame_start]})
+        if frame_end is not None:
+            conditions.append({"$lte": [frame_number, frame_end]})
+        projection = {"_id": 0, "bucket": 1}
+        for detection_type in detection_types:
+            projection[detection_type] = {"$arrayToObject": {"$filter": {
+                "input": {"$objectToArray": {"$ifNull": [f"${detection_type}", {}]}},
+                "as": "frame",
+                "cond": {"$and": conditions}
+            }}}
+        pipeline = [{"$match": query}, {"$sort": {"bucket": 1}}, {"$project": projection}]
+        cursor = collection.aggregate(pipeline, batchSize=batch_size)
+
+    for document in cursor:
+        rows = []
+        for detection_type in detection_types:
+            for frame_id, status in (document.get(detection_type) or {}).items():
+                rows.append({"stream_Id": stream_id, "frame_id": frame_id, "detection_type": detection_type, "status": status})
+        rows.sort(key=lambda row: (get_frame_number(row["frame_id"]) or 0, row["frame_id"], row["detection_type"]))
+        yield from rows
+
+
+class ResultsCache:
+    """
+    Read-through cache in front of :func:`find_frames` for dashboards polling the same streams.
+
+    Args:
+        ttl: Seconds a cached result is served before it is read again
+        max_entries: Number of distinct queries kept
+    """
+
+    def __init__(self, ttl=5.0, max_entries=256, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def find_frames(self, collection, stream_id, **kwargs):
+        """Same arguments as :func:`find_frames`, returning a list."""
+        key = (collection.full_name, stream_id, json.dumps(kwargs, sort_keys=True, default=str))
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        rows = list(find_frames(collection, stream_id, **kwargs))
+        with self._lock:
+            self._entries[key] = (now, rows)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return rows
+
+
+def _parse_frame_range(value):
+    start, _, end = value.partition('-')
+    return (int(start) if start else None), (int(end) if end else None)
+
+
+def main():
+    import pymongo
+
+    parser = argparse.ArgumentParser(description="Manage and query the bucketed detection results.")
+    parser.add_argument('--mongo-uri', default=os.environ.get('MONGO_URI'), help="MongoDB connection string (default: $MONGO_URI)")
+    parser.add_argument('--db', default=os.environ.get('MONGO_DB_NAME', 'lambda_outputs'))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('ensure-indexes', help="Create the result indexes")
+    query_parser = subparsers.add_parser('query', help="Print the results of a stream as JSON lines")
+    query_parser.add_argument('--collection', default='combined_output', choices=RESULT_COLLECTIONS)
+    query_parser.add_argument('--stream', required=True)
+    query_parser.add_argument('--type', dest='detection_types', action='append', help="Detection type, may be repeated")
+    query_parser.add_argument('--frames', help="Frame range as start-end, either side may be omitted")
+    query_parser.add_argument('--since', help="ISO timestamp")
+    query_parser.add_argument('--until', help="ISO timestamp")
+    args = parser.parse_args()
+
+    if not args.mongo_uri:
+        parser.error("--mongo-uri or MONGO_URI is required")
+    db = pymongo.MongoClient(args.mongo_uri)[args.db]
+
+    if args.command == 'ensure-indexes':
+        ensure_indexes(db)
+        print(f"Ensured result indexes on {', '.join(RESULT_COLLECTIONS)}")
+    else:
+        frame_start, frame_end = _parse_frame_range(args.frames) if args.frames else (None, None)
+        for row in find_frames(db[args.collection], args.stream, args.detection_types, frame_start, frame_end, args.since, args.until):
+            print(json.dumps(row, default=str))
+
+
+if __name__ == '__main__':
+    main()
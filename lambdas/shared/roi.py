@@ -0,0 +1,159 @@
+"""
+Per-stream regions of interest for the frame extractor.
+
+Each stream can declare polygons in normalized coordinates (0..1 of the frame
+width and height). Frame differencing then only looks at the pixels inside
+the polygons, so burned-in timestamps, trees or a road outside the area of
+interest no longer trigger uploads. With ``crop`` the uploaded frame is also
+cropped to the bounding box of the polygons; the offset of the crop is stored
+in the object metadata (``roi-x``, ``roi-y``).
+
+``ROI_CONFIG`` holds the configuration as inline JSON, a path in the
+deployment package or an ``s3://bucket/key`` object, and is read once per
+container::
+
+    {
+        "cam-12": {"polygons": [[[0.1, 0.4], [0.9, 0.4], [0.9, 1.0], [0.1, 1.0]]], "crop": true},
+        "*": {"polygons": [[[0.0, 0.08], [1.0, 0.08], [1.0, 1.0], [0.0, 1.0]]]}
+    }
+
+A stream is looked up by the video name without extension, then by its
+numeric stream id prefix and then by the key's directory; ``"*"`` applies to
+every other stream.
+"""
+import json
+import os
+import re
+import threading
+
+from shared.clients import get_s3_client, lazy_import
+from shared.instrumentation import get_logger
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+logger = get_logger(__name__)
+
+ROI_CONFIG = os.environ.get('ROI_CONFIG', '')
+
+DEFAULT_STREAM = '*'
+
+_config = None
+_config_lock = threading.Lock()
+
+
+class RegionOfInterest:
+    """
+    Polygons of one stream, rasterised into masks per frame size.
+
+    Args:
+        polygons: Lists of ``[x, y]`` points in normalized coordinates
+        crop: Crop uploaded frames to the bounding box of the polygons
+    """
+
+    def __init__(self, polygons, crop=False):
+        if not polygons or any(len(polygon) < 3 for polygon in polygons):
+            raise ValueError("A region of interest needs polygons of at least three points.")
+        self.polygons = [np.clip(np.asarray(polygon, dtype=np.float64), 0.0, 1.0) for polygon in polygons]
+        self.crop = crop
+        self._masks = {}
+
+    def _rasterise(self, height, width):
+        mask = np.zeros((height, width), dtype=np.uint8)
+        scale = np.array([width - 1, height - 1])
+        cv2.fillPoly(mask, [np.round(polygon * scale).astype(np.int32) for polygon in self.polygons], 255)
+        ys, xs = np.nonzero(mask)
+        if not len(xs):
+            raise ValueError("The region of interest covers no pixel.")
+        x, y = int(xs.min()), int(ys.min())
+        box = (x, y, int(xs.max()) + 1 - x, int(ys.max()) + 1 - y)
+        box_mask = mask[y:y + box[3], x:x + box[2]]
+        return box, box_mask, float(box_mask.size) / np.count_nonzero(box_mask)
+
+    def mask(self, shape):
+        """
+        Return ``(box, box_mask, area_ratio)`` for frames of ``shape``.
+
+        ``box`` is the ``(x, y, width, height)`` bounding box of the polygons,
+        ``box_mask`` the mask within it and ``area_ratio`` the pixels of the box
+        per pixel of the mask.
+        """
+        key = shape[:2]
+        if key not in self._masks:
+            self._masks[key] = self._rasterise(*key)
+        return self._masks[key]
+
+    def apply(self, frame):
+        """Crop a frame to the bounding box and blank the pixels outside the polygons."""
+        (x, y, width, height), box_mask, _ = self.mask(frame.shape)
+        box = frame[y:y + height, x:x + width]
+        if box_mask.all():
+            return box
+        if box.ndim == 3:
+            return cv2.bitwise_and(box, box, mask=box_mask)
+        return np.where(box_mask, box, 0).astype(box.dtype)
+
+    def crop_frame(self, frame):
+        """Return the frame cropped to the bounding box and the ``(x, y)`` offset of the crop."""
+        (x, y, width, height), _, _ = self.mask(frame.shape)
+        return frame[y:y + height, x:x + width], (x, y)
+
+
+def _read_config(source):
+    if source.lstrip().startswith('{'):
+        return json.loads(source)
+    if source.startswith('s3://'):
+        bucket, _, key = source[len('s3://'):].partition('/')
+        return json.loads(get_s3_client().get_object(Bucket=bucket, Key=key)['Body'].read())
+    with open(source) as f:
+        return json.load(f)
+
+
+def parse_config(config):
+    """Build the regions of a configuration mapping stream ids to polygons or ``{"polygons", "crop"}``."""
+    regions = {}
+    for stream_id, entry in config.items():
+        if isinstance(entry, list):
+            entry = {"polygons": entry}
+        regions[str(stream_id)] = RegionOfInterest(entry["polygons"], crop=bool(entry.get("crop", False)))
+    return regions
+
+
+def load_regions(source=None):
+    """Return the regions of ``ROI_CONFIG``, read on first use and kept for the life of the container."""
+    global _config
+    source = ROI_CONFIG if source is None else source
+    with _config_lock:
+        if _config is None or _config[0] != source:
+            regions = {}
+            if source:
+                try:
+                    regions = parse_config(_read_config(source))
+                    logger.info("Loaded regions of interest for %d streams", len(regions))
+                except Exception as e:
+                    # Without its regions a stream is compared over the whole frame, as before
+                    logger.error("Failed to load ROI_CONFIG - %s", e)
+            _config = (source, regions)
+        return _config[1]
+
+
+def stream_candidates(video_key):
+    """Return the stream ids a video key can be configured under, most specific first."""
+    name = os.path.splitext(os.path.basename(video_key))[0]
+    candidates = [name]
+    match = re.match(r"^(\d+)_", name)
+    if match:
+        candidates.append(match.group(1))
+    directory = os.path.dirname(video_key)
+    if directory:
+        candidates.append(directory)
+    candidates.append(DEFAULT_STREAM)
+    return candidates
+
+
+def region_for(video_key, source=None):
+    """Return the region of interest of the stream of ``video_key``, or None."""
+    regions = load_regions(source)
+    for stream_id in stream_candidates(video_key):
+        if stream_id in regions:
+            return regions[stream_id]
+    return None
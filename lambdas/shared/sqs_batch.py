@@ -0,0 +1,202 @@
+import json
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from shared.fair_scheduler import record_frame, schedule_records
+from shared.frame_manifest import is_manifest, manifest_frames
+from shared.instrumentation import get_logger
+from shared.motion_regions import MOTION_CROPS_ENABLED
+
+logger = get_logger(__name__)
+
+# Maximum number of SQS records processed at the same time by one invocation
+MAX_WORKERS = int(os.environ.get('SQS_BATCH_MAX_WORKERS', '10'))
+
+# Records are no longer started once less than this many milliseconds remain
+DEADLINE_MARGIN_MS = int(os.environ.get('SQS_BATCH_DEADLINE_MARGIN_MS', '5000'))
+
+# Time kept back at the end of the invocation to build and return the response
+RESPONSE_RESERVE_MS = 500
+
+
+# Cancellation flag of the record processed by the current thread
+_current_record = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    """Raised for records that were not started, or were abandoned, because the invocation is about to time out."""
+
+
+def check_record_cancelled():
+    """
+    Raise DeadlineExceeded when the record processed by this thread was abandoned at the invocation deadline.
+
+    Abandoned records are reported in ``batchItemFailures`` and redelivered, but
+    their threads keep running and may run again after the next thaw. Writers
+    call this before buffering results, so an abandoned record writes nothing
+    that its redelivery writes again.
+    """
+    cancelled = getattr(_current_record, 'cancelled', None)
+    if cancelled is not None and cancelled.is_set():
+        raise DeadlineExceeded("record abandoned at the invocation deadline")
+
+
+def get_remaining_time_ms(context):
+    """Return the milliseconds left in the invocation, or None outside of Lambda."""
+    get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining_time is None:
+        return None
+    return get_remaining_time()
+
+
+def parse_s3_event(record):
+    """Extract the S3 event payload from the body of an SQS record."""
+    if 's3' in record:
+        # Records expanded from a frame manifest carry their payload
+        return record['s3']
+    sqs_message = json.loads(record['body'])
+    if is_manifest(sqs_message):
+        raise ValueError("Invalid frame manifest")
+    return sqs_message.get('Records', [])[0]['s3']
+
+
+def expand_records(records):
+    """
+    Return the records with every frame manifest replaced by one record per frame.
+
+    The records of a manifest share its ``messageId``, so a failed frame makes
+    SQS redeliver the whole manifest.
+    """
+    expanded = []
+    for record in records:
+        try:
+            sqs_message = json.loads(record['body'])
+            if is_manifest(sqs_message):
+                expanded.extend(dict(record, s3=s3_event) for s3_event in manifest_frames(sqs_message))
+                continue
+        except Exception as e:
+            # Left as it is; parse_s3_event fails the record
+            logger.debug("Could not expand SQS message %s - %s", record.get('messageId'), e)
+        expanded.append(record)
+    return expanded
+
+
+def stream_chains(records):
+    """
+    Return the indexes of the records grouped by stream, in the order of the records.
+
+    Records without a known stream are a chain of their own.
+    """
+    chains = {}
+    for index, record in enumerate(records):
+        stream_id, _ = record_frame(record)
+        chains.setdefault(('stream', stream_id) if stream_id is not None else ('record', index), []).append(index)
+    return list(chains.values())
+
+
+def process_sqs_records(records, process_record, context=None, max_workers=None, deadline_margin_ms=None,
+                        metrics=None, in_stream_order=None):
+    """
+    Process SQS records concurrently and return the records that failed.
+
+    Frame manifests are expanded first, so each of their frames is a record.
+    The records are then ordered fairly across streams, and streams over the
+    backlog limit are shed (see shared/fair_scheduler.py); shed records count
+    as processed and are counted as ``frames_shed``. Records run on a bounded thread pool. Once the invocation is within
+    ``deadline_margin_ms`` of its timeout no new record is started, and records
+    still running when the deadline arrives are reported as failed so SQS
+    redelivers them. Those records are cancelled: their threads cannot be
+    stopped, but they fail at their next write (see :func:`check_record_cancelled`).
+
+    With ``in_stream_order`` the records of a stream run one after another, in
+    frame order, while the streams still run in parallel. Motion crops need
+    this: a frame is cropped against the results of the frame before it, which
+    must have been detected first (see shared/motion_regions.py).
+
+    Args:
+        records: SQS records from the Lambda event
+        process_record: Callable processing one record, raising on failure
+        context: Lambda context, used for the remaining invocation time
+        max_workers: Maximum number of records processed at the same time
+        deadline_margin_ms: Stop starting new records below this remaining time
+        metrics: Metrics of the invocation, counting the shed records
+        in_stream_order: Run the records of a stream one after another; defaults to MOTION_CROPS_ENABLED
+
+    Returns:
+        A list of ``{"itemIdentifier": messageId}`` entries in the format
+        expected for ``batchItemFailures``.
+    """
+    records, shed = schedule_records(expand_records(records))
+    if metrics is not None and shed:
+        metrics.count('frames_shed', len(shed))
+    if not records:
+        return []
+
+    max_workers = max_workers or MAX_WORKERS
+    if deadline_margin_ms is None:
+        deadline_margin_ms = DEADLINE_MARGIN_MS
+    if in_stream_order is None:
+        in_stream_order = MOTION_CROPS_ENABLED
+
+    def run(record, cancelled):
+        remaining_ms = get_remaining_time_ms(context)
+        if remaining_ms is not None and remaining_ms < deadline_margin_ms:
+            raise DeadlineExceeded(f"only {remaining_ms} ms left in the invocation")
+        _current_record.cancelled = cancelled
+        try:
+            process_record(record)
+        finally:
+            _current_record.cancelled = None
+
+    cancellations = [threading.Event() for _ in records]
+    futures = [Future() for _ in records]
+
+    def run_chain(indexes):
+        for index in indexes:
+            future = futures[index]
+            # Records cancelled at the deadline before they started are skipped
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                run(records[index], cancellations[index])
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(None)
+
+    # Every record is a chain of its own unless the records of a stream run in order
+    chains = stream_chains(records) if in_stream_order else [[index] for index in range(len(records))]
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(chains)))
+    for chain in chains:
+        executor.submit(run_chain, chain)
+
+    remaining_ms = get_remaining_time_ms(context)
+    timeout = None if remaining_ms is None else max(0, remaining_ms - RESPONSE_RESERVE_MS) / 1000
+    wait(futures, timeout=timeout)
+
+    batch_item_failures = []
+    reported = set()
+    for record, future, cancelled in zip(records, futures, cancellations):
+        message_id = record.get('messageId')
+        if not future.done():
+            cancelled.set()
+            future.cancel()
+            logger.error("Error processing SQS message %s: still running at the invocation deadline", message_id)
+        elif future.exception() is not None:
+            logger.error("Error processing SQS message %s: %s", message_id, future.exception())
+        else:
+            continue
+        if message_id not in reported:
+            reported.add(message_id)
+            batch_item_failures.append({"itemIdentifier": message_id})
+
+    # Do not block on records that overran the deadline; they are reported as failed and write nothing more
+    executor.shutdown(wait=False)
+    return batch_item_failures
+
+
+def add_batch_item_failures(batch_item_failures, message_ids):
+    """Add failed message ids to ``batchItemFailures``, skipping ids already reported."""
+    reported = {failure['itemIdentifier'] for failure in batch_item_failures}
+    return batch_item_failures + [{"itemIdentifier": message_id} for message_id in message_ids if message_id not in reported]
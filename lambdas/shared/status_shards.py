@@ -0,0 +1,163 @@
+"""
+Append-only detection status files on S3.
+
+Instead of downloading, extending and re-uploading ``<dir>/<detector>.json``
+for every frame, each invocation writes one small shard object::
+
+    <dir>/<detector>.shards/<frame_id>-<unique id>.json   {"frame_id": ..., "status": ...}
+
+Shard keys are never reused, so concurrent writers cannot overwrite each
+other and the cost per frame does not depend on how many frames the stream
+already has. A compaction step periodically merges the shards of a directory
+into the ``<dir>/<detector>.json`` summary (a frame id -> status map in frame
+order, the same layout as before) with a conditional put, and then deletes the
+shards it merged. Shards written while a compaction runs are left for the
+next one.
+"""
+import datetime
+import json
+import os
+import uuid
+
+from shared.clients import get_s3_client
+from shared.instrumentation import get_logger
+from shared.result_buckets import get_frame_number
+from shared.sqs_batch import check_record_cancelled
+
+logger = get_logger(__name__)
+
+SHARD_SUFFIX = ".shards"
+
+# Attempts at replacing the summary when another compaction changed it in the meantime
+MAX_COMPACTION_ATTEMPTS = 5
+
+# Objects deleted per DeleteObjects request, the S3 maximum
+DELETE_BATCH_SIZE = 1000
+
+
+def shard_prefix(directory_path, detector_name):
+    return f"{directory_path}/{detector_name}{SHARD_SUFFIX}/" if directory_path else f"{detector_name}{SHARD_SUFFIX}/"
+
+
+def summary_key(directory_path, detector_name):
+    return os.path.join(directory_path, detector_name + '.json')
+
+
+def write_status_shard(bucket_name, image_key, detection_status, detector_name):
+    """
+    Record the detection status of one frame as a new shard object.
+
+    Nothing is written for a record abandoned at the invocation deadline.
+
+    Returns:
+        The key of the shard written.
+    """
+    check_record_cancelled()
+    directory_path = os.path.dirname(image_key)
+    frame_id = os.path.basename(image_key).rsplit('.', 1)[0]
+    key = f"{shard_prefix(directory_path, detector_name)}{frame_id}-{uuid.uuid4().hex}.json"
+    body = {
+        "frame_id": frame_id,
+        "status": detection_status,
+        "written_at": datetime.datetime.utcnow().isoformat()
+    }
+    get_s3_client().put_object(Bucket=bucket_name, Key=key, Body=json.dumps(body).encode('utf-8'),
+                               ContentType='application/json')
+    return key
+
+
+def _error_code(error):
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code')
+
+
+def _list_shards(s3_client, bucket_name, prefix):
+    shards = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+        shards.extend(page.get('Contents', []))
+    return shards
+
+
+def _read_summary(s3_client, bucket_name, key):
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    except Exception as e:
+        if _error_code(e) in ('NoSuchKey', '404'):
+            return {}, None
+        raise
+    return json.loads(response['Body'].read()), response['ETag']
+
+
+def _sort_frames(statuses):
+    return dict(sorted(statuses.items(), key=lambda item: (get_frame_number(item[0]) is None, get_frame_number(item[0]) or 0, item[0])))
+
+
+def compact_status_shards(bucket_name, directory_path, detector_name):
+    """
+    Merge the shards of a directory into its summary file and delete them.
+
+    The summary is replaced with a conditional put against the ETag it was
+    read with, so two compactions of the same directory never lose each
+    other's frames; the losing one reads the summary again and retries.
+
+    Returns:
+        The number of shards merged.
+    """
+    s3_client = get_s3_client()
+    shards = _list_shards(s3_client, bucket_name, shard_prefix(directory_path, detector_name))
+    if not shards:
+        return 0
+
+    # Later shards of the same frame (e.g. a redelivered message) win
+    shards.sort(key=lambda shard: (shard['LastModified'], shard['Key']))
+    updates = {}
+    for shard in shards:
+        try:
+            body = json.loads(s3_client.get_object(Bucket=bucket_name, Key=shard['Key'])['Body'].read())
+        except Exception as e:
+            # Merged and deleted by a concurrent compaction
+            if _error_code(e) in ('NoSuchKey', '404'):
+                continue
+            raise
+        updates[body['frame_id']] = body['status']
+
+    key = summary_key(directory_path, detector_name)
+    for attempt in range(MAX_COMPACTION_ATTEMPTS):
+        statuses, etag = _read_summary(s3_client, bucket_name, key)
+        statuses.update(updates)
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            s3_client.put_object(Bucket=bucket_name, Key=key, Body=json.dumps(_sort_frames(statuses)).encode('utf-8'),
+                                 ContentType='application/json', **condition)
+            break
+        except Exception as e:
+            if _error_code(e) not in ('PreconditionFailed', 'ConditionalRequestConflict') or attempt == MAX_COMPACTION_ATTEMPTS - 1:
+                raise
+            logger.debug("%s changed during compaction, retrying", key)
+
+    # Only the shards merged above are deleted; newer ones wait for the next compaction
+    for start in range(0, len(shards), DELETE_BATCH_SIZE):
+        batch = shards[start:start + DELETE_BATCH_SIZE]
+        s3_client.delete_objects(Bucket=bucket_name, Delete={'Objects': [{'Key': shard['Key']} for shard in batch], 'Quiet': True})
+
+    logger.info("Compacted %d shards into %s", len(shards), key)
+    return len(shards)
+
+
+def find_shard_directories(bucket_name, detector_name, prefix=''):
+    """Return the directories below ``prefix`` that have shards waiting for compaction."""
+    marker = f"{detector_name}{SHARD_SUFFIX}/"
+    directories = set()
+    for shard in _list_shards(get_s3_client(), bucket_name, prefix):
+        key = shard['Key']
+        if key.startswith(marker):
+            directories.add('')
+        elif f"/{marker}" in key:
+            directories.add(key.split(f"/{marker}", 1)[0])
+    return sorted(directories)
+
+
+def compact_all(bucket_name, detector_name, prefix=''):
+    """Compact every directory below ``prefix``; returns the number of shards merged per directory."""
+    return {directory: compact_status_shards(bucket_name, directory, detector_name)
+            for directory in find_shard_directories(bucket_name, detector_name, prefix)}
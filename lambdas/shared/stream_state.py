@@ -0,0 +1,121 @@
+"""
+Per-stream state for ingesting live streams as a series of segments.
+
+Cameras deliver HLS or fragmented-MP4 segments rather than whole videos. With
+``SEGMENT_INGEST`` enabled the extractor treats every object as the next
+segment of its stream instead of an independent video. Between segments it
+keeps a small JSON object per stream::
+
+    stream-state/<stream id>.json
+    {"stream_id": "cam-12", "next_frame": 5400, "thumbnail": "iVBORw0K...",
+     "selector": {...}, "last_segment": "live/cam-12/000179.ts"}
+
+``next_frame`` keeps the frame numbers continuous across segments, and
+``thumbnail`` is a small PNG of the last frame. The first frame of the next
+segment is compared with that thumbnail, so it is only uploaded when it
+actually changed.
+
+The stream of a segment is the directory of its key (``live/cam-12/000180.ts``)
+or, for keys without one, the name without its trailing segment number
+(``cam-12_000180.ts``). Segments of one stream must be processed in order and
+one at a time, e.g. with a FIFO queue grouped by stream or a reserved
+concurrency of one; concurrent segments would number their frames from the
+same state.
+
+Configuration comes from environment variables:
+    SEGMENT_INGEST   Treat videos as consecutive segments of a stream (default: false)
+
+The state objects are kept in the checkpoint bucket (see shared/video_checkpoints.py).
+"""
+import base64
+import json
+import os
+import re
+
+from shared.clients import get_s3_client, lazy_import
+from shared.instrumentation import get_logger
+from shared.video_checkpoints import checkpoint_bucket
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+logger = get_logger(__name__)
+
+SEGMENT_INGEST = os.environ.get('SEGMENT_INGEST', 'false').lower() in ('1', 'true', 'yes')
+
+STREAM_STATE_PREFIX = 'stream-state/'
+
+# Width of the thumbnail kept of the last frame of a segment
+THUMBNAIL_WIDTH = 64
+
+
+def segment_stream_id(segment_key):
+    """Return the stream a segment belongs to."""
+    directory = os.path.dirname(segment_key)
+    if directory:
+        return os.path.basename(directory)
+    name = os.path.splitext(os.path.basename(segment_key))[0]
+    return re.sub(r"[_\-.]?\d+$", '', name) or name
+
+
+def stream_state_key(stream_id):
+    return f"{STREAM_STATE_PREFIX}{stream_id}.json"
+
+
+def is_stream_state_key(key):
+    return key.startswith(STREAM_STATE_PREFIX)
+
+
+def frame_thumbnail(frame):
+    """Return the frame scaled down to ``THUMBNAIL_WIDTH`` pixels wide."""
+    height, width = frame.shape[:2]
+    size = (THUMBNAIL_WIDTH, max(1, round(height * THUMBNAIL_WIDTH / width)))
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+
+def encode_thumbnail(thumbnail):
+    # PNG is lossless, so the thumbnail compares like the one of the next segment
+    _, buffer = cv2.imencode('.png', thumbnail)
+    return base64.b64encode(buffer.tobytes()).decode('ascii')
+
+
+def decode_thumbnail(encoded):
+    buffer = np.frombuffer(base64.b64decode(encoded), dtype=np.uint8)
+    return cv2.imdecode(buffer, cv2.IMREAD_UNCHANGED)
+
+
+class StreamStateError(Exception):
+    """
+    Raised when the state of a stream cannot be read or written.
+
+    Numbering the frames of a segment from 0 instead would overwrite the
+    frames and results of the stream, so the segment fails and is retried.
+    """
+
+
+def load_stream_state(bucket, stream_id):
+    """Return the state a stream's last segment left, or None for a new stream."""
+    try:
+        body = get_s3_client().get_object(Bucket=checkpoint_bucket(bucket), Key=stream_state_key(stream_id))['Body'].read()
+    except Exception as e:
+        code = (getattr(e, 'response', None) or {}).get('Error', {}).get('Code')
+        if code in ('NoSuchKey', '404'):
+            return None
+        raise StreamStateError(f"Failed to read the state of stream {stream_id} - {e}") from e
+    try:
+        return json.loads(body)
+    except ValueError as e:
+        raise StreamStateError(f"Unreadable state of stream {stream_id} - {e}") from e
+
+
+def save_stream_state(bucket, stream_id, state):
+    """Write the state of a stream for its next segment; raises StreamStateError when it could not be written."""
+    try:
+        get_s3_client().put_object(
+            Bucket=checkpoint_bucket(bucket),
+            Key=stream_state_key(stream_id),
+            Body=json.dumps(dict(state, stream_id=stream_id)).encode('utf-8'),
+            ContentType='application/json'
+        )
+    except Exception as e:
+        # Without it the next segment would start the stream afresh; the segment is retried instead
+        raise StreamStateError(f"Failed to write the state of stream {stream_id} - {e}") from e
@@ -0,0 +1,127 @@
+"""
+Checkpoints of the frame extractor, so long videos span several invocations.
+
+While a video is processed its progress is written to a small JSON object
+next to the video, or in ``CHECKPOINT_BUCKET`` when one is set::
+
+    checkpoints/<video key>.json
+    {"etag": "...", "next_frame": 1800, "previous_fingerprint": "f0e1...", "frames_processed": 1799,
+     "selector": {...}, "clean": false, "done": false}
+
+Checkpoints are written every ``CHECKPOINT_EVERY_FRAMES`` frames and when the
+invocation gets within ``CHECKPOINT_MARGIN_MS`` of its timeout; in that case
+the extractor invokes itself to carry on from the checkpoint. A retried
+invocation after a crash resumes from the last periodic checkpoint instead of
+frame 0. Checkpoints of finished videos are kept with ``"done": true`` so a
+redelivered event for the same object (same ETag) is skipped.
+
+Checkpoints written next to the videos fire the notification of the video
+bucket, and the extractor returns right away for checkpoint and stream-state
+keys. Filtering the notification on the video suffix (e.g. ``.mp4``) avoids
+these invocations, as those keys end in ``.json``. A separate checkpoint
+bucket avoids them too; it must exist and the extractor's role needs
+``s3:GetObject`` and ``s3:PutObject`` on it, or every checkpoint fails.
+
+Configuration comes from environment variables:
+    CHECKPOINT_BUCKET         Bucket of the checkpoints (default: empty, the bucket of the video)
+    CHECKPOINT_EVERY_FRAMES   Frames between periodic checkpoints (default: 300, 0 disables them)
+    CHECKPOINT_MARGIN_MS      Hand over to a new invocation below this remaining time (default: 30000)
+"""
+import json
+import os
+
+from shared.clients import get_s3_client, lazy_import
+from shared.instrumentation import get_logger
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+logger = get_logger(__name__)
+
+CHECKPOINT_BUCKET = os.environ.get('CHECKPOINT_BUCKET', '')
+CHECKPOINT_EVERY_FRAMES = int(os.environ.get('CHECKPOINT_EVERY_FRAMES', '300'))
+CHECKPOINT_MARGIN_MS = int(os.environ.get('CHECKPOINT_MARGIN_MS', '30000'))
+
+CHECKPOINT_PREFIX = 'checkpoints/'
+
+# Side of the grayscale thumbnail hashed into a fingerprint
+FINGERPRINT_SIZE = 8
+
+# Differing fingerprint bits still accepted as the same frame, as a decode after a seek can differ slightly
+FINGERPRINT_TOLERANCE = 4
+
+
+def checkpoint_key(video_key):
+    return f"{CHECKPOINT_PREFIX}{video_key}.json"
+
+
+def is_checkpoint_key(key):
+    return key.startswith(CHECKPOINT_PREFIX)
+
+
+def checkpoint_bucket(video_bucket):
+    return CHECKPOINT_BUCKET or video_bucket
+
+
+def frame_fingerprint(frame):
+    """Return a 64-bit average hash of a frame as hex, used to check that a resumed decode found the right frame."""
+    gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(gray, (FINGERPRINT_SIZE, FINGERPRINT_SIZE), interpolation=cv2.INTER_AREA)
+    bits = np.packbits((small > small.mean()).ravel())
+    return bits.tobytes().hex()
+
+
+def fingerprints_match(first, second, tolerance=FINGERPRINT_TOLERANCE):
+    if not first or not second:
+        return False
+    return bin(int(first, 16) ^ int(second, 16)).count('1') <= tolerance
+
+
+def _error_code(error):
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code')
+
+
+def load_checkpoint(video_bucket, video_key, etag):
+    """
+    Return the checkpoint of a video, or None.
+
+    Checkpoints of another version of the object (different ETag) and
+    unreadable checkpoints are ignored, so the video starts from frame 0.
+    """
+    try:
+        body = get_s3_client().get_object(Bucket=checkpoint_bucket(video_bucket), Key=checkpoint_key(video_key))['Body'].read()
+        checkpoint = json.loads(body)
+    except Exception as e:
+        if _error_code(e) not in ('NoSuchKey', '404'):
+            logger.error("Failed to read the checkpoint of %s - %s", video_key, e)
+        return None
+    if checkpoint.get('etag') != etag:
+        logger.info("Ignoring the checkpoint of an earlier version of %s", video_key)
+        return None
+    return checkpoint
+
+
+def save_checkpoint(video_bucket, video_key, checkpoint):
+    """Write the checkpoint of a video; returns False when it could not be written."""
+    try:
+        get_s3_client().put_object(
+            Bucket=checkpoint_bucket(video_bucket),
+            Key=checkpoint_key(video_key),
+            Body=json.dumps(checkpoint).encode('utf-8'),
+            ContentType='application/json'
+        )
+        return True
+    except Exception as e:
+        # Processing goes on; a retry then starts from an older checkpoint
+        logger.error("Failed to write the checkpoint of %s - %s", video_key, e)
+        return False
+
+
+def object_etag(bucket, key):
+    """Return the ETag of an object, or None when it does not exist."""
+    try:
+        return get_s3_client().head_object(Bucket=bucket, Key=key).get('ETag') or ''
+    except Exception as e:
+        if _error_code(e) in ('NoSuchKey', '404', 'NotFound'):
+            return None
+        raise
@@ -0,0 +1,236 @@
+"""
+Long-running worker that runs a detector function outside of Lambda.
+
+Under sustained load a persistent process is cheaper than one invocation per
+SQS batch: the function module is imported once, so its models, boto3 clients
+and MongoDB connection pool stay warm for every message. The worker loads the
+``lambda_function.py`` of a detector and runs its ``process_record`` on
+messages it long-polls from the detector's queue::
+
+    cd lambdas
+    python -m shared.worker stateless/fire-detection-nht --queue-url https://sqs.../fire-detection --concurrency 4
+
+Each of the ``--concurrency`` pollers receives batches of up to ten messages,
+processes the records of a batch concurrently with ``process_sqs_records``
+(fairly across streams, see shared/fair_scheduler.py),
+writes the buffered MongoDB results and deletes the messages that succeeded.
+Failed messages stay on the queue and are received again after their
+visibility timeout, like with the Lambda event source mapping, so the redrive
+policy of the queue still applies.
+
+On SIGTERM or SIGINT the pollers stop receiving, finish the batches they
+hold, and the buffered results and metrics are flushed before the process exits.
+
+A local SQS-compatible endpoint (moto server, ElasticMQ, LocalStack) is used
+with ``--endpoint-url`` or boto3's ``AWS_ENDPOINT_URL_SQS``.
+
+Configuration comes from environment variables, overridden by the options:
+    WORKER_QUEUE_URL        Queue to poll
+    WORKER_CONCURRENCY      Pollers, each processing one batch at a time (default: 2)
+    WORKER_BATCH_SIZE       Messages received per poll, at most 10 (default: 10)
+    WORKER_WAIT_SECONDS     Long-polling wait of a receive (default: 20)
+    WORKER_RECORD_WORKERS   Records of a batch processed at the same time (default: SQS_BATCH_MAX_WORKERS)
+"""
+import argparse
+import importlib.util
+import os
+import signal
+import sys
+import threading
+
+from shared import clients
+from shared.clients import get_sqs_client
+from shared.instrumentation import get_logger, start_invocation
+from shared.sqs_batch import MAX_WORKERS, process_sqs_records
+
+logger = get_logger(__name__)
+
+WORKER_QUEUE_URL = os.environ.get('WORKER_QUEUE_URL', '')
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', '2'))
+WORKER_BATCH_SIZE = int(os.environ.get('WORKER_BATCH_SIZE', '10'))
+WORKER_WAIT_SECONDS = int(os.environ.get('WORKER_WAIT_SECONDS', '20'))
+WORKER_RECORD_WORKERS = int(os.environ.get('WORKER_RECORD_WORKERS', str(MAX_WORKERS)))
+
+# Messages accepted by one ReceiveMessage or DeleteMessageBatch request
+MAX_BATCH_SIZE = 10
+
+LAMBDAS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_function(function_dir):
+    """Import the ``lambda_function.py`` of a function directory, relative to ``lambdas/`` or absolute."""
+    path = os.path.join(LAMBDAS_DIR, function_dir, 'lambda_function.py')
+    name = 'worker_' + os.path.basename(os.path.normpath(function_dir)).replace('-', '_')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def as_records(messages):
+    """Convert received SQS messages to the records of a Lambda SQS event."""
+    return [{
+        "messageId": message['MessageId'],
+        "receiptHandle": message['ReceiptHandle'],
+        "body": message['Body'],
+        "attributes": message.get('Attributes', {}),
+        "eventSource": "aws:sqs"
+    } for message in messages]
+
+
+class Worker:
+    """
+    Polls an SQS queue and runs a detector function's ``process_record`` on its messages.
+
+    Args:
+        module: The imported function, providing ``process_record`` and
+            optionally ``mongo_writes``, ``processed_frames`` and ``metrics``
+        queue_url: Queue to poll
+        concurrency: Pollers, each processing one batch at a time
+        batch_size: Messages received per poll
+        wait_seconds: Long-polling wait of a receive
+        record_workers: Records of a batch processed at the same time
+    """
+
+    def __init__(self, module, queue_url, concurrency=None, batch_size=None, wait_seconds=None, record_workers=None):
+        self.module = module
+        self.queue_url = queue_url
+        self.concurrency = concurrency or WORKER_CONCURRENCY
+        self.batch_size = min(MAX_BATCH_SIZE, batch_size or WORKER_BATCH_SIZE)
+        self.wait_seconds = WORKER_WAIT_SECONDS if wait_seconds is None else wait_seconds
+        self.record_workers = record_workers or WORKER_RECORD_WORKERS
+        self.processed = 0
+        self.failed = 0
+        self._stopping = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # Messages whose results failed to write in a flush made by another poller
+        self._write_failures = set()
+
+    def stop(self):
+        """Stop receiving; batches already received are still finished."""
+        self._stopping.set()
+
+    @property
+    def stopping(self):
+        return self._stopping.is_set()
+
+    def poll_once(self):
+        """Receive and process one batch; returns the number of messages received."""
+        response = get_sqs_client().receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=self.batch_size,
+            WaitTimeSeconds=self.wait_seconds,
+            AttributeNames=['ApproximateReceiveCount']
+        )
+        messages = response.get('Messages', [])
+        if messages:
+            self.process_messages(messages)
+        return len(messages)
+
+    def process_messages(self, messages):
+        """Process received messages and delete the ones that succeeded."""
+        start_invocation()
+        records = as_records(messages)
+        failures = process_sqs_records(records, self.module.process_record, max_workers=self.record_workers,
+                                       metrics=getattr(self.module, 'metrics', None))
+        failed_ids = {failure['itemIdentifier'] for failure in failures} | self._flush_results(records)
+
+        succeeded = [record for record in records if record['messageId'] not in failed_ids]
+        if succeeded:
+            self._delete(succeeded)
+        with self._stats_lock:
+            self.processed += len(succeeded)
+            self.failed += len(records) - len(succeeded)
+
+    def _flush_results(self, records):
+        """Write the buffered results and return the ids of these records whose writes failed."""
+        mongo_writes = getattr(self.module, 'mongo_writes', None)
+        processed_frames = getattr(self.module, 'processed_frames', None)
+        if mongo_writes is None:
+            if processed_frames is not None:
+                processed_frames.commit()
+            return set()
+        message_ids = {record['messageId'] for record in records}
+        # Another poller's flush can include writes of this batch, so failures are shared
+        with self._flush_lock:
+            if processed_frames is not None:
+                self._write_failures.update(processed_frames.commit_after(mongo_writes.flush))
+            else:
+                self._write_failures.update(mongo_writes.flush())
+            failed = self._write_failures & message_ids
+            self._write_failures -= failed
+        return failed
+
+    def _delete(self, records):
+        response = get_sqs_client().delete_message_batch(
+            QueueUrl=self.queue_url,
+            Entries=[{"Id": str(index), "ReceiptHandle": record['receiptHandle']} for index, record in enumerate(records)]
+        )
+        for failure in response.get('Failed', []):
+            # The message is received again after its visibility timeout
+            logger.error("Failed to delete SQS message %s - %s", records[int(failure['Id'])]['messageId'],
+                         failure.get('Message', failure.get('Code')))
+
+    def _poll(self):
+        while not self.stopping:
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.error("Error polling %s - %s", self.queue_url, e)
+                self._stopping.wait(1)
+            finally:
+                metrics = getattr(self.module, 'metrics', None)
+                if metrics is not None:
+                    metrics.flush()
+
+    def run(self):
+        """Poll until :meth:`stop` is called, then flush what is left."""
+        logger.info("Polling %s with %d pollers", self.queue_url, self.concurrency)
+        pollers = [threading.Thread(target=self._poll, name=f"poller-{index}") for index in range(self.concurrency)]
+        for poller in pollers:
+            poller.start()
+        for poller in pollers:
+            poller.join()
+
+        if getattr(self.module, 'mongo_writes', None) is not None:
+            self.module.mongo_writes.flush()
+        logger.info("Stopped after %d messages (%d failed)", self.processed, self.failed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a detector function as a long-running SQS worker.")
+    parser.add_argument("function", help="Function directory, e.g. stateless/fire-detection-nht")
+    parser.add_argument("--queue-url", default=WORKER_QUEUE_URL)
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY)
+    parser.add_argument("--batch-size", type=int, default=WORKER_BATCH_SIZE)
+    parser.add_argument("--wait-seconds", type=int, default=WORKER_WAIT_SECONDS)
+    parser.add_argument("--record-workers", type=int, default=WORKER_RECORD_WORKERS)
+    parser.add_argument("--endpoint-url", help="SQS-compatible endpoint, e.g. http://localhost:9324")
+    args = parser.parse_args(argv)
+    if not args.queue_url:
+        parser.error("--queue-url or WORKER_QUEUE_URL is required")
+
+    import boto3
+    from botocore.config import Config
+
+    # One pooled connection per record processed at the same time
+    config = Config(max_pool_connections=max(10, args.concurrency * args.record_workers))
+    clients.set_client("sqs", boto3.client("sqs", endpoint_url=args.endpoint_url, config=config))
+    clients.set_client("s3", boto3.client("s3", config=config))
+
+    worker = Worker(load_function(args.function), args.queue_url, args.concurrency, args.batch_size,
+                    args.wait_seconds, args.record_workers)
+
+    def shut_down(signum, frame):
+        logger.info("Received signal %d, finishing the current batches", signum)
+        worker.stop()
+
+    signal.signal(signal.SIGTERM, shut_down)
+    signal.signal(signal.SIGINT, shut_down)
+    worker.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
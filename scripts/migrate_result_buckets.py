@@ -0,0 +1,89 @@
+"""
+Migrate legacy per-stream result documents into the bucketed layout.
+
+Legacy documents are keyed by ``stream_Id`` only and hold every frame of the
+stream under ``<detection_type>.<frame_id>``. Each of them is split into bucket
+documents (see ``shared/result_buckets.py``); with ``--delete-legacy`` the
+legacy document is removed once all of its frames were written. The migration
+only uses upserts with ``$set``, so it can be interrupted and run again.
+
+Usage:
+    MONGO_URI=mongodb://localhost:27017/ python scripts/migrate_result_buckets.py --dry-run
+"""
+import argparse
+import os
+import sys
+
+import pymongo
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lambdas"))
+
+from shared.mongo_writer import WriteBehindBuffer
+from shared.result_buckets import BUCKET_SIZE, bucket_update, ensure_bucket_index
+
+DEFAULT_COLLECTIONS = ["combined_output", "vehicle_detection_output", "human_detection_output"]
+
+# Fields of a legacy document that do not hold per-frame statuses
+METADATA_FIELDS = {"_id", "stream_Id", "updated_at", "created_at"}
+
+
+def migrate_collection(collection, bucket_size, delete_legacy, dry_run):
+    """Split every legacy document of the collection into bucket documents."""
+    if not dry_run:
+        ensure_bucket_index(collection)
+
+    migrated_documents = 0
+    migrated_frames = 0
+    for document in collection.find({"bucket": {"$exists": False}}):
+        stream_id = document["stream_Id"]
+        timestamp = document.get("updated_at")
+        buffer = WriteBehindBuffer(flush_threshold=1000)
+        frames = 0
+
+        for detection_type, statuses in document.items():
+            if detection_type in METADATA_FIELDS or not isinstance(statuses, dict):
+                continue
+            for frame_id, detection_status in statuses.items():
+                query, update = bucket_update(stream_id, detection_type, frame_id, detection_status, timestamp, bucket_size)
+                if not dry_run:
+                    buffer.update_one(collection, query, update, tag=document["_id"])
+                frames += 1
+
+        if dry_run:
+            print(f"{collection.name}: stream {stream_id} has {frames} frames to migrate")
+        else:
+            failed = buffer.flush()
+            if failed:
+                print(f"{collection.name}: stream {stream_id} failed to migrate, keeping the legacy document")
+                continue
+            if delete_legacy:
+                collection.delete_one({"_id": document["_id"]})
+            print(f"{collection.name}: migrated stream {stream_id} ({frames} frames)")
+
+        migrated_documents += 1
+        migrated_frames += frames
+
+    return migrated_documents, migrated_frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split legacy per-stream result documents into frame-range buckets.")
+    parser.add_argument('--mongo-uri', default=os.environ.get('MONGO_URI'), help="MongoDB connection string (default: $MONGO_URI)")
+    parser.add_argument('--db', default=os.environ.get('MONGO_DB_NAME', 'lambda_outputs'))
+    parser.add_argument('--collections', nargs='+', default=DEFAULT_COLLECTIONS)
+    parser.add_argument('--bucket-size', type=int, default=BUCKET_SIZE)
+    parser.add_argument('--delete-legacy', action='store_true', help="Delete legacy documents after a successful migration")
+    parser.add_argument('--dry-run', action='store_true', help="Only report what would be migrated")
+    args = parser.parse_args()
+
+    if not args.mongo_uri:
+        parser.error("--mongo-uri or MONGO_URI is required")
+
+    db = pymongo.MongoClient(args.mongo_uri)[args.db]
+    for name in args.collections:
+        documents, frames = migrate_collection(db[name], args.bucket_size, args.delete_legacy, args.dry_run)
+        print(f"{name}: {documents} legacy documents, {frames} frames")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Lambda functions import the shared helpers from the root of their deployment package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../lambdas"))
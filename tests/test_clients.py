@@ -0,0 +1,53 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from shared import clients
+
+LAMBDAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lambdas")
+FUNCTIONS = [
+    "common/dispatcher-lambda-nht",
+    "common/extract-frame-nht",
+    "stateful/car-detection-nht",
+    "stateful/person-detection-nht",
+    "stateful/person_detection_nht",
+    "stateless/fall-detection-nht",
+    "stateless/fire-detection-nht",
+]
+HEAVY_MODULES = ["boto3", "cv2", "numpy", "pymongo", "requests"]
+
+
+@pytest.mark.parametrize("function", FUNCTIONS)
+def test_handlers_import_without_heavy_modules_or_credentials(function):
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(LAMBDAS_DIR))
+    env.pop("MONGO_URI", None)
+    code = f"import sys, json, lambda_function; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    process = subprocess.run([sys.executable, "-c", code], cwd=os.path.join(LAMBDAS_DIR, function),
+                             env=env, capture_output=True, text=True)
+
+    assert process.returncode == 0, process.stderr
+    assert json.loads(process.stdout.strip().splitlines()[-1]) == []
+
+
+def test_lazy_module_imports_on_first_attribute_access():
+    module = clients.lazy_import("json")
+    assert module.dumps({"a": 1}) == '{"a": 1}'
+
+
+def test_clients_are_memoised_and_can_be_replaced():
+    stand_in = object()
+    clients.set_client("sqs", stand_in)
+    try:
+        assert clients.get_sqs_client() is stand_in
+        assert clients.get_boto3_client("sqs") is stand_in
+    finally:
+        clients._clients.pop("sqs", None)
+
+
+def test_mongo_client_requires_uri(monkeypatch):
+    monkeypatch.delenv("MONGO_URI", raising=False)
+    with pytest.raises(Exception, match="MONGO_URI"):
+        clients.get_mongo_client()
@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from shared.detector_client import CircuitBreaker, DetectorClient, DetectorUnavailable
+
+
+class StandInDetector:
+    """Local stand-in for the Modal endpoint whose latency and status can be scripted per request."""
+
+    def __init__(self):
+        self.delays = []
+        self.default_delay = 0
+        self.status = 200
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                with stand_in.lock:
+                    stand_in.requests += 1
+                    delay = stand_in.delays.pop(0) if stand_in.delays else stand_in.default_delay
+                time.sleep(delay)
+                body = json.dumps([{"bbox": [1, 2, 3, 4], "confidence": 0.9, "class": "car"}]).encode()
+                self.send_response(stand_in.status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+@pytest.fixture
+def stand_in():
+    server = StandInDetector()
+    yield server
+    server.server.shutdown()
+
+
+def test_fast_endpoint_returns_results_and_records_latency(stand_in):
+    client = DetectorClient(stand_in.url, latency_budget=2)
+    assert client.detect(b"jpeg")[0]["class"] == "car"
+    assert client.stats()["ewma_ms"] is not None
+    assert client.stats()["circuit"] == CircuitBreaker.CLOSED
+
+
+def test_slow_request_is_hedged(stand_in):
+    # Only the first request is slow; the hedged one answers quickly
+    stand_in.delays = [1.5]
+    client = DetectorClient(stand_in.url, latency_budget=1.0)
+
+    start = time.monotonic()
+    results = client.detect(b"jpeg")
+    assert results[0]["class"] == "car"
+    assert time.monotonic() - start < 1.0
+    assert stand_in.requests == 2
+
+
+def test_falls_back_past_latency_budget(stand_in):
+    stand_in.default_delay = 1.0
+    client = DetectorClient(stand_in.url, latency_budget=0.3, fallback=lambda image_data: [{"class": "car", "source": "local"}])
+
+    start = time.monotonic()
+    assert client.detect(b"jpeg") == [{"class": "car", "source": "local", "fallback": True}]
+    assert time.monotonic() - start < 0.9
+
+
+def test_raises_without_fallback(stand_in):
+    stand_in.status = 500
+    client = DetectorClient(stand_in.url, latency_budget=1, hedging=False)
+    with pytest.raises(DetectorUnavailable):
+        client.detect(b"jpeg")
+
+
+def test_circuit_opens_on_sustained_errors_and_recovers(stand_in):
+    stand_in.status = 500
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10, clock=lambda: now[0])
+    client = DetectorClient(stand_in.url, latency_budget=1, hedging=False, fallback=lambda image_data: [], circuit_breaker=breaker)
+
+    for _ in range(3):
+        client.detect(b"jpeg")
+    assert breaker.state == CircuitBreaker.OPEN
+    requests_when_opened = stand_in.requests
+
+    # While open the endpoint is not called at all
+    assert client.detect(b"jpeg") == []
+    assert stand_in.requests == requests_when_opened
+
+    # After the reset timeout a single trial request closes the circuit again
+    stand_in.status = 200
+    now[0] = 11
+    assert client.detect(b"jpeg")[0]["class"] == "car"
+    assert breaker.state == CircuitBreaker.CLOSED
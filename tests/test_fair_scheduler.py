@@ -0,0 +1,101 @@
+import json
+
+import pytest
+
+from shared import fair_scheduler
+from shared.fair_scheduler import parse_weights, schedule_records, shed_backlog
+from shared.instrumentation import Metrics
+from shared.sqs_batch import expand_records, process_sqs_records
+
+
+def frame_record(key, message_id=None):
+    body = json.dumps({"Records": [{"s3": {"bucket": {"name": "frames-nht"}, "object": {"key": key}}}]})
+    return {"messageId": message_id or key, "body": body}
+
+
+def manifest_record(stream_id, numbers, message_id):
+    frames = [{"key": f"{stream_id}/frame_{number:04d}.jpg", "frame_id": f"frame_{number:04d}", "frame_number": number}
+              for number in numbers]
+    body = json.dumps({"type": "frame_manifest", "version": 1, "bucket": "frames-nht", "stream_id": stream_id,
+                       "frames": frames})
+    return {"messageId": message_id, "body": body}
+
+
+def keys(records):
+    return [json.loads(record["body"])["Records"][0]["s3"]["object"]["key"] for record in records]
+
+
+def test_streams_are_served_round_robin():
+    records = [frame_record(f"busy/frame_{number:04d}.jpg") for number in range(4)]
+    records += [frame_record("quiet/frame_0007.jpg"), frame_record("lobby/frame_0001.jpg")]
+
+    ordered, shed = schedule_records(records, weights={}, backlog_limit=0)
+
+    assert keys(ordered) == ["busy/frame_0000.jpg", "quiet/frame_0007.jpg", "lobby/frame_0001.jpg",
+                             "busy/frame_0001.jpg", "busy/frame_0002.jpg", "busy/frame_0003.jpg"]
+    assert shed == []
+
+
+def test_weighted_streams_get_more_turns():
+    records = [frame_record(f"a/frame_{number:04d}.jpg") for number in range(4)]
+    records += [frame_record(f"b/frame_{number:04d}.jpg") for number in range(4)]
+
+    ordered, _ = schedule_records(records, weights={"b": 3}, backlog_limit=0)
+
+    assert [key.split("/")[0] for key in keys(ordered)] == ["a", "b", "b", "b", "a", "b", "a", "a"]
+
+
+def test_frames_are_ordered_within_their_stream():
+    records = [frame_record("cam/frame_0009.jpg"), frame_record("cam/frame_0002.jpg"), frame_record("cam/frame_0005.jpg")]
+
+    ordered, _ = schedule_records(records, weights={}, backlog_limit=0)
+
+    assert keys(ordered) == ["cam/frame_0002.jpg", "cam/frame_0005.jpg", "cam/frame_0009.jpg"]
+
+
+def test_backlog_is_dropped_or_downsampled_oldest_first():
+    frames = list(range(10))
+
+    assert shed_backlog(frames, 3, "drop") == ([7, 8, 9], [0, 1, 2, 3, 4, 5, 6])
+    assert shed_backlog(frames, 3, "downsample")[0] == [0, 5, 9]
+    assert shed_backlog(frames, 1, "downsample")[0] == [9]
+    assert shed_backlog(frames, 0, "drop") == (frames, [])
+    with pytest.raises(ValueError):
+        shed_backlog(frames, 3, "newest")
+
+
+def test_busy_stream_is_shed_in_the_batch_path(monkeypatch):
+    records = [manifest_record("busy", range(0, 10), "m-0"), manifest_record("busy", range(10, 20), "m-1"),
+               manifest_record("quiet", [3], "m-2")]
+    monkeypatch.setattr(fair_scheduler, "STREAM_BACKLOG_LIMIT", 4)
+    processed = []
+
+    def process_record(record):
+        processed.append((record["s3"]["frame"]["stream_id"], record["s3"]["frame"]["frame_number"]))
+
+    metrics = Metrics(enabled=False)
+
+    ordered, shed = schedule_records(expand_records(records))
+    failures = process_sqs_records(records, process_record, max_workers=1, metrics=metrics)
+
+    assert len(shed) == 16
+    assert metrics.flush()[0]["frames_shed"] == 16
+    assert [record["s3"]["frame"]["frame_number"] for record in ordered] == [16, 3, 17, 18, 19]
+    assert failures == []
+    assert processed == [("busy", 16), ("quiet", 3), ("busy", 17), ("busy", 18), ("busy", 19)]
+
+
+def test_unparseable_records_keep_their_place():
+    records = [{"messageId": "bad", "body": "not json"}, frame_record("cam/frame_0001.jpg")]
+
+    ordered, shed = schedule_records(records, weights={}, backlog_limit=1)
+
+    assert [record["messageId"] for record in ordered] == ["bad", "cam/frame_0001.jpg"]
+    assert shed == []
+
+
+def test_weights_are_parsed():
+    assert parse_weights("cam-12=3, lobby=2") == {"cam-12": 3, "lobby": 2}
+    assert parse_weights("") == {}
+    with pytest.raises(ValueError):
+        parse_weights("cam-12=0")
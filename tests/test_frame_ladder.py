@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from shared import clients
+from shared.frame_ladder import download_frame, is_ladder_key, ladder_frames, ladder_key, parse_ladder, source_key
+
+LADDER = parse_ladder("medium=640x360, thumb=320")
+
+
+class FakeS3:
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self.downloads = []
+
+    def download_file(self, bucket, key, path):
+        self.downloads.append(key)
+        if key not in self.keys:
+            error = Exception("Not Found")
+            error.response = {"Error": {"Code": "404"}}
+            raise error
+
+
+@pytest.fixture
+def fake_s3():
+    s3 = FakeS3({"cam/frame_0001.jpg", "resized/medium/cam/frame_0001.jpg"})
+    clients.set_client("s3", s3)
+    yield s3
+    clients._clients.pop("s3", None)
+
+
+def test_ladder_is_sorted_smallest_first():
+    assert LADDER == {"thumb": (320, None), "medium": (640, 360)}
+
+
+@pytest.mark.parametrize("spec", ["thumb", "full=320", "a/b=320", "thumb=wide", "thumb=320xtall"])
+def test_invalid_rungs_are_rejected(spec):
+    with pytest.raises(ValueError):
+        parse_ladder(spec)
+
+
+def test_keys_of_the_rungs():
+    assert ladder_key("cam/frame_0001.jpg", "thumb") == "resized/thumb/cam/frame_0001.jpg"
+    assert ladder_key("cam/frame_0001.jpg", "full") == "cam/frame_0001.jpg"
+    assert is_ladder_key("resized/thumb/cam/frame_0001.jpg")
+    assert not is_ladder_key("cam/frame_0001.jpg")
+    assert source_key("cam/frame_0001.jpg", "medium", LADDER) == "resized/medium/cam/frame_0001.jpg"
+    assert source_key("cam/frame_0001.jpg", "large", LADDER) == "cam/frame_0001.jpg"
+
+
+def test_rungs_are_resized_from_one_frame():
+    frame = np.zeros((720, 1280, 3), dtype=np.uint8)
+
+    rungs = [(rung, resized.shape) for rung, resized in ladder_frames(frame, LADDER)]
+
+    assert rungs == [("thumb", (180, 320, 3)), ("medium", (360, 640, 3))]
+
+
+def test_rungs_not_smaller_than_the_frame_are_skipped():
+    frame = np.zeros((360, 480, 3), dtype=np.uint8)
+
+    assert [rung for rung, _ in ladder_frames(frame, LADDER)] == ["thumb"]
+
+
+def test_download_reads_the_declared_rung(fake_s3, tmp_path):
+    key = download_frame("frames", "cam/frame_0001.jpg", str(tmp_path / "frame"), "medium", LADDER)
+
+    assert key == "resized/medium/cam/frame_0001.jpg"
+    assert fake_s3.downloads == [key]
+
+
+def test_download_falls_back_to_the_full_frame(fake_s3, tmp_path):
+    key = download_frame("frames", "cam/frame_0001.jpg", str(tmp_path / "frame"), "thumb", LADDER)
+
+    assert key == "cam/frame_0001.jpg"
+    assert fake_s3.downloads == ["resized/thumb/cam/frame_0001.jpg", "cam/frame_0001.jpg"]
+
+
+def test_rungs_outside_the_ladder_read_the_full_frame(fake_s3, tmp_path):
+    download_frame("frames", "cam/frame_0001.jpg", str(tmp_path / "frame"), "medium", {})
+
+    assert fake_s3.downloads == ["cam/frame_0001.jpg"]
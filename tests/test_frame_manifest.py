@@ -0,0 +1,186 @@
+import json
+import threading
+
+import pytest
+
+from shared import clients
+from shared.frame_manifest import ManifestPublisher, is_manifest, manifest_frames
+from shared.idempotency import ProcessedFrames
+from shared.sqs_batch import expand_records, parse_s3_event, process_sqs_records
+
+
+class FakeSQS:
+    """In-memory SQS stand-in; rejects the entry ids listed in ``reject`` once per send."""
+
+    def __init__(self, reject=()):
+        self.queues = {}
+        self.calls = []
+        self.reject = list(reject)
+
+    def send_message_batch(self, QueueUrl, Entries):
+        assert len(Entries) <= 10
+        self.calls.append((QueueUrl, len(Entries)))
+        rejected = set(self.reject.pop(0)) if self.reject else set()
+        self.queues.setdefault(QueueUrl, []).extend(entry['MessageBody'] for entry in Entries if entry['Id'] not in rejected)
+        return {"Failed": [{"Id": entry['Id'], "Code": "InternalError"} for entry in Entries if entry['Id'] in rejected]}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def fake_sqs():
+    sqs = FakeSQS()
+    clients.set_client("sqs", sqs)
+    yield sqs
+    clients._clients.pop("sqs", None)
+
+
+def publish(publisher, frames):
+    for number in range(frames):
+        publisher.add(f"cam-1/frame_{number:04d}.jpg", number, {"abs_diff": 60.0, "ssim": 0.9, "frame_number": number})
+
+
+def as_records(bodies):
+    return [{"messageId": f"m-{index}", "receiptHandle": f"h-{index}", "body": body} for index, body in enumerate(bodies)]
+
+
+def test_frames_are_sent_as_batched_manifests_to_every_queue(fake_sqs):
+    publisher = ManifestPublisher("frames-nht", "uploads/cam-1.mp4", "cam-1", queue_urls=["q-car", "q-person"],
+                                  frames_per_message=5, max_delay_ms=60000)
+
+    publish(publisher, 120)
+    publisher.flush()
+
+    assert fake_sqs.calls == [("q-car", 10), ("q-person", 10), ("q-car", 10), ("q-person", 10),
+                              ("q-car", 4), ("q-person", 4)]
+    manifest = json.loads(fake_sqs.queues["q-car"][0])
+    assert is_manifest(manifest)
+    assert manifest["stream_id"] == "cam-1"
+    assert manifest["frames"][0] == {"key": "cam-1/frame_0000.jpg", "frame_id": "frame_0000", "frame_number": 0,
+                                     "abs_diff": 60.0, "ssim": 0.9}
+    assert publisher.messages_sent == 24
+
+
+def test_partial_manifest_is_sent_when_its_oldest_frame_is_overdue(fake_sqs):
+    clock = FakeClock()
+    publisher = ManifestPublisher("frames-nht", "cam-1.mp4", "cam-1", queue_urls=["q"], frames_per_message=10,
+                                  max_delay_ms=500, clock=clock)
+
+    publish(publisher, 3)
+    assert fake_sqs.calls == []
+    clock.now = 0.6
+    publisher.add("cam-1/frame_0003.jpg", 3)
+
+    assert len(json.loads(fake_sqs.queues["q"][0])["frames"]) == 4
+
+
+def test_rejected_manifests_are_retried_once(fake_sqs):
+    fake_sqs.reject = [["1"]]
+    publisher = ManifestPublisher("frames-nht", "cam-1.mp4", "cam-1", queue_urls=["q"], frames_per_message=1)
+
+    publish(publisher, 3)
+    publisher.flush()
+
+    assert [json.loads(body)["frames"][0]["frame_number"] for body in fake_sqs.queues["q"]] == [0, 2, 1]
+
+
+def test_manifests_rejected_twice_fail_the_flush(fake_sqs):
+    fake_sqs.reject = [["0"], ["0"]]
+    publisher = ManifestPublisher("frames-nht", "cam-1.mp4", "cam-1", queue_urls=["q"])
+
+    publish(publisher, 1)
+    with pytest.raises(Exception, match="Failed to send 1 frame manifests"):
+        publisher.flush()
+
+
+def test_manifests_expand_to_one_record_per_frame(fake_sqs):
+    publisher = ManifestPublisher("frames-nht", "cam-1.mp4", "cam-1", queue_urls=["q"], frames_per_message=3)
+    publish(publisher, 3)
+    publisher.flush()
+    s3_notification = json.dumps({"Records": [{"s3": {"bucket": {"name": "frames-nht"}, "object": {"key": "cam-2/frame_0001.jpg"}}}]})
+
+    records = expand_records(as_records(fake_sqs.queues["q"] + [s3_notification]))
+
+    assert [record["messageId"] for record in records] == ["m-0", "m-0", "m-0", "m-1"]
+    s3_event = parse_s3_event(records[1])
+    assert s3_event["object"]["key"] == "cam-1/frame_0001.jpg"
+    assert s3_event["frame"]["stream_id"] == "cam-1"
+    assert s3_event["frame"]["frame_id"] == "frame_0001"
+    assert parse_s3_event(records[3])["object"]["key"] == "cam-2/frame_0001.jpg"
+    assert "frame" not in parse_s3_event(records[3])
+
+
+def test_frame_uploaded_again_under_its_key_is_not_a_duplicate(fake_sqs):
+    # The same video uploaded twice numbers its frames from 0 again
+    processed = ProcessedFrames("fire-detection-nht", store="none", enabled=True)
+    for etag in ('"etag-1"', '"etag-2"', '"etag-1"'):
+        publisher = ManifestPublisher("frames-nht", "cam-1.mp4", "cam-1", queue_urls=["q"])
+        publisher.add("cam-1/frame_0000.jpg", 0, etag=etag)
+        publisher.flush()
+    events = [next(manifest_frames(json.loads(body))) for body in fake_sqs.queues["q"]]
+
+    assert [event["object"] for event in events] == [
+        {"key": "cam-1/frame_0000.jpg", "eTag": "etag-1"},
+        {"key": "cam-1/frame_0000.jpg", "eTag": "etag-2"},
+        {"key": "cam-1/frame_0000.jpg", "eTag": "etag-1"}]
+    duplicates = []
+    for event in events:
+        duplicates.append(processed.is_duplicate(event))
+        processed.record(event)
+        processed.commit()
+    assert duplicates == [False, False, True]
+
+
+def test_failed_frames_fail_their_manifest_once(fake_sqs):
+    publisher = ManifestPublisher("frames-nht", "cam-1.mp4", "cam-1", queue_urls=["q"], frames_per_message=5)
+    publish(publisher, 10)
+    publisher.flush()
+    processed = []
+    lock = threading.Lock()
+
+    def process_record(record):
+        s3_event = parse_s3_event(record)
+        with lock:
+            processed.append(s3_event["frame"]["frame_number"])
+        if s3_event["frame"]["frame_number"] in (1, 3):
+            raise Exception("inference failed")
+
+    failures = process_sqs_records(as_records(fake_sqs.queues["q"]), process_record)
+
+    assert sorted(processed) == list(range(10))
+    assert failures == [{"itemIdentifier": "m-0"}]
+
+
+def test_invalid_manifest_fails_its_record():
+    body = json.dumps({"type": "frame_manifest", "version": 99, "bucket": "b", "stream_id": "s", "frames": []})
+
+    failures = process_sqs_records(as_records([body]), lambda record: parse_s3_event(record))
+
+    assert failures == [{"itemIdentifier": "m-0"}]
+
+
+def test_manifests_round_trip_through_a_local_sqs():
+    boto3 = pytest.importorskip("boto3")
+    moto = pytest.importorskip("moto")
+
+    with moto.mock_aws():
+        sqs = boto3.client("sqs", region_name="ap-south-1")
+        queue_url = sqs.create_queue(QueueName="car-detection")["QueueUrl"]
+        clients.set_client("sqs", sqs)
+        try:
+            publisher = ManifestPublisher("frames-nht", "cam-1.mp4", "cam-1", queue_urls=[queue_url])
+            publish(publisher, 25)
+            publisher.flush()
+            messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)["Messages"]
+        finally:
+            clients._clients.pop("sqs", None)
+
+    records = expand_records([{"messageId": message["MessageId"], "body": message["Body"]} for message in messages])
+    assert len(messages) == 3
+    assert sorted(parse_s3_event(record)["frame"]["frame_number"] for record in records) == list(range(25))
@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+from shared.frame_selector import FrameSelector, motion_energy
+
+
+def run(selector, energies):
+    """Push energies for frames 1.. and return the selected frame numbers."""
+    selected = []
+    for frame_number, energy in enumerate(energies, start=1):
+        frame = selector.push(frame_number, energy)
+        if frame is not None:
+            selected.append(frame)
+    last = selector.finish()
+    if last is not None:
+        selected.append(last)
+    return selected
+
+
+def test_energy_of_the_fixed_rule_thresholds_is_one():
+    assert motion_energy({"abs_diff": 50.0, "ssim": 1.0}) == 1.0
+    assert motion_energy({"abs_diff": 0.0, "ssim": 0.95}) == pytest.approx(1.0)
+    assert motion_energy({"abs_diff": 0.0, "ssim": 1.0}) == 0.0
+
+
+def test_selects_local_maxima_of_change():
+    selector = FrameSelector(budget_per_minute=600, fps=10, burst=10)
+
+    assert run(selector, [0.2, 2.0, 0.3, 0.2, 3.0, 0.1]) == [2, 5]
+
+
+def test_budget_caps_selected_frames_of_a_busy_scene():
+    fps = 15
+    selector = FrameSelector(budget_per_minute=30, fps=fps)
+    # Ten minutes of video alternating between strong changes and calm frames
+    energies = [5.0 if index % 2 else 0.5 for index in range(10 * 60 * fps)]
+
+    selected = run(selector, energies)
+
+    assert 290 <= len(selected) <= 30 * 10 + selector.capacity
+    assert selector.over_budget > 0
+    # Selections are spread over the video rather than spent at its start
+    assert selected[-1] > len(energies) * 0.9
+
+
+def test_slow_changes_accumulate_until_a_frame_is_selected():
+    selector = FrameSelector(budget_per_minute=60, fps=10, min_energy=0.1)
+    # Gentle ramps, each too small for the fixed rule
+    energies = [0.05, 0.1, 0.15, 0.1, 0.05] * 40
+
+    selected = run(selector, energies)
+
+    assert selected
+    assert all(energy < 1.0 for energy in energies)
+
+
+def test_static_scene_selects_nothing():
+    selector = FrameSelector(budget_per_minute=60, fps=10)
+
+    assert run(selector, [0.0] * 600) == []
+
+
+def test_first_frame_spends_a_token():
+    selector = FrameSelector(budget_per_minute=6, fps=1, burst=1)
+    selector.take()
+
+    assert run(selector, [3.0, 0.0]) == []
+    assert selector.over_budget == 1
+
+
+def test_budget_must_be_positive():
+    with pytest.raises(ValueError):
+        FrameSelector(budget_per_minute=0)
+
+
+def test_restored_selector_continues_the_same_selection():
+    energies = [0.0, 2.0, 0.5, 0.0, 1.5, 3.0, 0.2, 0.0] * 10
+    whole = FrameSelector(budget_per_minute=60, fps=10)
+    expected = run(whole, energies)
+
+    first = FrameSelector(budget_per_minute=60, fps=10)
+    selected = run(first, energies[:37])
+    second = FrameSelector(budget_per_minute=60, fps=10)
+    second.restore(json.loads(json.dumps(first.state())))
+    for frame_number, energy in enumerate(energies[37:], start=38):
+        frame = second.push(frame_number, energy)
+        if frame is not None:
+            selected.append(frame)
+    frame = second.finish()
+    if frame is not None:
+        selected.append(frame)
+
+    assert selected == expected
@@ -0,0 +1,131 @@
+import os
+import uuid
+
+import pytest
+
+from shared.idempotency import ProcessedFrames, frame_identity
+
+# Point this at a local mongod, e.g. mongodb://localhost:27017/
+MONGO_TEST_URI = os.environ.get('MONGO_TEST_URI')
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def s3_event(key, etag="abc"):
+    return {"bucket": {"name": "frames-nht"}, "object": {"key": key, "eTag": etag}}
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_frames_count_as_processed_once_committed(clock):
+    frames = ProcessedFrames("fire-detection-nht", store="none", clock=clock, enabled=True)
+    event = s3_event("cam-1/frame_0001.jpg")
+
+    assert not frames.is_duplicate(event)
+    frames.record(event, "m-1")
+    assert not frames.is_duplicate(event)
+    assert frames.commit_after(lambda: []) == []
+
+    assert frames.is_duplicate(event)
+    assert frames.duplicates == 1
+
+
+def test_frames_with_failed_writes_are_processed_again(clock):
+    frames = ProcessedFrames("fire-detection-nht", store="none", clock=clock, enabled=True)
+    frames.record(s3_event("cam-1/frame_0001.jpg"), "m-1")
+    frames.record(s3_event("cam-1/frame_0002.jpg"), "m-2")
+
+    assert frames.commit_after(lambda: ["m-1"]) == ["m-1"]
+
+    assert not frames.is_duplicate(s3_event("cam-1/frame_0001.jpg"))
+    assert frames.is_duplicate(s3_event("cam-1/frame_0002.jpg"))
+
+
+def test_identity_covers_detector_and_object_version(clock):
+    fire = ProcessedFrames("fire-detection-nht", store="none", clock=clock, enabled=True)
+    fall = ProcessedFrames("fall-detection-nht", store="none", clock=clock, enabled=True)
+    fire.record(s3_event("cam-1/frame_0001.jpg", etag="v1"))
+    fire.commit()
+
+    assert fire.is_duplicate(s3_event("cam-1/frame_0001.jpg", etag="v1"))
+    assert not fire.is_duplicate(s3_event("cam-1/frame_0001.jpg", etag="v2"))
+    assert not fall.is_duplicate(s3_event("cam-1/frame_0001.jpg", etag="v1"))
+    assert frame_identity(s3_event("cam%201/frame.jpg"), "fire") == frame_identity(s3_event("cam 1/frame.jpg"), "fire")
+
+
+def test_processed_frames_expire_and_are_evicted(clock):
+    frames = ProcessedFrames("fire-detection-nht", capacity=2, store="none", ttl_seconds=60, clock=clock, enabled=True)
+    for number in range(3):
+        frames.record(s3_event(f"cam-1/frame_{number:04d}.jpg"))
+    frames.commit()
+
+    assert not frames.is_duplicate(s3_event("cam-1/frame_0000.jpg"))
+    assert frames.is_duplicate(s3_event("cam-1/frame_0002.jpg"))
+    clock.now += 61
+    assert not frames.is_duplicate(s3_event("cam-1/frame_0002.jpg"))
+
+
+def test_disabled_cache_processes_everything(clock):
+    frames = ProcessedFrames("fire-detection-nht", store="none", clock=clock, enabled=False)
+    frames.record(s3_event("cam-1/frame_0001.jpg"))
+    frames.commit()
+
+    assert not frames.is_duplicate(s3_event("cam-1/frame_0001.jpg"))
+
+
+def test_frames_recorded_during_a_flush_wait_for_the_next_one(clock):
+    frames = ProcessedFrames("fire-detection-nht", store="none", clock=clock, enabled=True)
+
+    def flush():
+        # A record finishing while the results are written
+        frames.record(s3_event("cam-1/frame_0009.jpg"), "m-9")
+        return []
+
+    frames.commit_after(flush)
+    assert not frames.is_duplicate(s3_event("cam-1/frame_0009.jpg"))
+    frames.commit_after(lambda: [])
+    assert frames.is_duplicate(s3_event("cam-1/frame_0009.jpg"))
+
+
+@pytest.mark.skipif(not MONGO_TEST_URI, reason="MONGO_TEST_URI is not set")
+def test_shared_store_catches_duplicates_of_other_containers(clock, monkeypatch):
+    import pymongo
+
+    client = pymongo.MongoClient(MONGO_TEST_URI, serverSelectionTimeoutMS=2000)
+    collection = client["lambda_outputs_test"][f"processed_frames_{uuid.uuid4().hex}"]
+    monkeypatch.setattr("shared.idempotency.get_collection", lambda name: collection)
+    try:
+        first = ProcessedFrames("fire-detection-nht", store="mongo", clock=clock, enabled=True)
+        second = ProcessedFrames("fire-detection-nht", store="mongo", clock=clock, enabled=True)
+        first.record(s3_event("cam-1/frame_0001.jpg"), "m-1")
+        first.commit_after(lambda: [])
+
+        assert second.is_duplicate(s3_event("cam-1/frame_0001.jpg"))
+        assert not second.is_duplicate(s3_event("cam-1/frame_0002.jpg"))
+        assert "expires_at_1" in collection.index_information()
+    finally:
+        collection.drop()
+        client.close()
+
+
+def test_unreachable_store_does_not_block_processing(clock, monkeypatch):
+    def unreachable(name):
+        raise Exception("server selection timeout")
+
+    monkeypatch.setattr("shared.idempotency.get_collection", unreachable)
+    frames = ProcessedFrames("fire-detection-nht", store="mongo", clock=clock, enabled=True)
+
+    assert not frames.is_duplicate(s3_event("cam-1/frame_0001.jpg"))
+    frames.record(s3_event("cam-1/frame_0001.jpg"))
+    frames.commit()
+    # Still remembered in the container
+    assert frames.is_duplicate(s3_event("cam-1/frame_0001.jpg"))
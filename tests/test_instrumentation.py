@@ -0,0 +1,97 @@
+import json
+import logging
+
+import pytest
+
+from shared import instrumentation
+from shared.instrumentation import Metrics, get_logger, start_invocation
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+    def advance_ms(self, ms):
+        self.now += int(ms * 1e6)
+
+
+def test_stages_are_timed_and_emitted_as_emf(capsys):
+    clock = FakeClock()
+    metrics = Metrics(namespace="Test", function_name="car-detection-nht", clock=clock)
+
+    for ms in (12, 30):
+        with metrics.stage('download'):
+            clock.advance_ms(ms)
+    with pytest.raises(ValueError):
+        with metrics.stage('inference'):
+            clock.advance_ms(5)
+            raise ValueError()
+    metrics.count('frames', 2)
+
+    documents = metrics.flush()
+    line = json.loads(capsys.readouterr().out.strip())
+
+    assert documents == [line]
+    assert line["FunctionName"] == "car-detection-nht"
+    assert line["download"] == [12.0, 30.0]
+    assert line["inference"] == 5.0
+    assert line["frames"] == 2
+    definition = line["_aws"]["CloudWatchMetrics"][0]
+    assert definition["Namespace"] == "Test"
+    assert definition["Dimensions"] == [["FunctionName"]]
+    assert {"Name": "frames", "Unit": "Count"} in definition["Metrics"]
+    assert {"Name": "download", "Unit": "Milliseconds"} in definition["Metrics"]
+
+
+def test_flush_resets_and_splits_long_value_lists(capsys):
+    metrics = Metrics(function_name="fn")
+    for value in range(250):
+        metrics.record('upload', value)
+
+    documents = metrics.flush()
+
+    assert [len(document["upload"]) for document in documents] == [100, 100, 50]
+    assert len(capsys.readouterr().out.strip().splitlines()) == 3
+    assert metrics.flush() == []
+
+
+def test_disabled_metrics_write_nothing(capsys):
+    metrics = Metrics(enabled=False)
+    metrics.count('frames')
+
+    assert metrics.flush()
+    assert capsys.readouterr().out == ""
+
+
+def test_timed_decorator_records_every_call():
+    clock = FakeClock()
+    metrics = Metrics(clock=clock)
+
+    @metrics.timed('compare')
+    def compare():
+        clock.advance_ms(3)
+        return "done"
+
+    assert compare() == "done"
+    assert metrics.snapshot() == {'compare': [3.0]}
+
+
+def test_debug_logs_are_sampled_per_invocation(capsys):
+    logger = get_logger('sampling_test')
+    try:
+        start_invocation(sample_rate=0)
+        logger.debug("hidden")
+        logger.info("shown")
+        start_invocation(sample_rate=1)
+        logger.debug("sampled")
+    finally:
+        instrumentation._logger.setLevel(instrumentation.LOG_LEVEL)
+
+    output = capsys.readouterr().out
+    assert "hidden" not in output
+    assert "INFO pipeline.sampling_test: shown" in output
+    assert "DEBUG pipeline.sampling_test: sampled" in output
+    assert logging.getLogger('pipeline').propagate is False
@@ -0,0 +1,58 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from shared.local_detector import PERSON_PARAMS, VEHICLE_PARAMS, LocalDetector
+
+LAMBDAS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../lambdas"))
+CARS_CASCADE = os.path.join(LAMBDAS_DIR, "stateful/car-detection-nht/cars.xml")
+FACE_CASCADE = os.path.join(LAMBDAS_DIR, "stateful/person-detection-nht/face.xml")
+
+
+class FakeClassifier:
+    """Returns a fixed box so coordinate mapping can be checked without a real detection."""
+
+    def __init__(self):
+        self.image_shape = None
+
+    def detectMultiScale3(self, image, **kwargs):
+        self.image_shape = image.shape
+        return np.array([[10, 20, 30, 40]]), np.array([1]), np.array([[2.0]])
+
+
+@pytest.mark.parametrize("cascade_path, label, params", [
+    (CARS_CASCADE, "car", VEHICLE_PARAMS),
+    (FACE_CASCADE, "person", PERSON_PARAMS),
+])
+def test_bundled_cascades_load(cascade_path, label, params):
+    detector = LocalDetector(cascade_path, label, **params)
+    blank = np.zeros((360, 640), dtype=np.uint8)
+    assert detector.detect(blank) == []
+
+
+def test_relative_cascade_path_is_rejected():
+    with pytest.raises(ValueError):
+        LocalDetector("cars.xml", "car")
+
+
+def test_detect_bytes_matches_modal_result_shape():
+    detector = LocalDetector(CARS_CASCADE, "car", **VEHICLE_PARAMS)
+    _, buffer = cv2.imencode('.jpg', np.full((120, 160, 3), 128, dtype=np.uint8))
+    assert detector.detect_bytes(buffer.tobytes()) == []
+
+
+def test_boxes_are_mapped_back_through_roi_and_downscale():
+    detector = LocalDetector(CARS_CASCADE, "car", max_side=500)
+    fake = FakeClassifier()
+    detector._get_classifier = lambda: fake
+
+    image = np.zeros((1200, 1600, 3), dtype=np.uint8)
+    detections = detector.detect(image, roi=(100, 200, 1000, 800))
+
+    # The 1000x800 region is downscaled by half before detection
+    assert fake.image_shape == (400, 500)
+    assert detections[0]["bbox"] == [120, 240, 180, 320]
+    assert detections[0]["class"] == "car"
+    assert 0 < detections[0]["confidence"] < 1
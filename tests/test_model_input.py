@@ -0,0 +1,121 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+import pytest
+
+from shared.detector_client import DetectorClient
+from shared.model_input import prepare_image, rescale_results
+
+# Red box drawn into the test frames, in pixels of the 1920x1080 original
+BOX = (600, 300, 1000, 620)
+
+
+def encoded_frame(width=1920, height=1080, quality=95):
+    frame = np.full((height, width, 3), 90, dtype=np.uint8)
+    scale = width / 1920
+    x1, y1, x2, y2 = (round(value * scale) for value in BOX)
+    cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 0, 255), -1)
+    return cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def find_red_box(image_data):
+    image = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    ys, xs = np.nonzero(cv2.inRange(image, (0, 0, 150), (100, 100, 255)))
+    return [{"bbox": [int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max())], "confidence": 0.9, "class": "car"}]
+
+
+class BoxDetector:
+    """Stand-in endpoint returning the red box in pixels of the image it received."""
+
+    def __init__(self):
+        self.received = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                image_data = self.rfile.read(int(self.headers['Content-Length']))
+                stand_in.received.append(image_data)
+                body = json.dumps(find_red_box(image_data)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+@pytest.fixture
+def detector():
+    server = BoxDetector()
+    yield server
+    server.server.shutdown()
+
+
+def test_large_frames_are_scaled_to_the_model_input():
+    original = encoded_frame()
+
+    payload, scale = prepare_image(original, max_side=640, quality=85)
+    image = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    assert image.shape[:2] == (360, 640)
+    assert len(payload) < len(original)
+    assert scale == pytest.approx((3.0, 3.0))
+
+
+def test_small_or_unreadable_images_are_sent_unchanged():
+    small = encoded_frame(width=480, height=270)
+
+    assert prepare_image(small, max_side=640) == (small, None)
+    assert prepare_image(b"not an image", max_side=640) == (b"not an image", None)
+    assert prepare_image(encoded_frame(), max_side=0)[1] is None
+
+
+def test_boxes_are_scaled_back_to_the_original_frame():
+    results = [{"bbox": [10, 20, 30, 40], "class": "car"}, {"bbox": [1.5, 2.0, 3.0, 4.0]}, {"class": "no box"}]
+
+    rescaled = rescale_results(results, (3.0, 2.0))
+
+    assert rescaled[0] == {"bbox": [30, 40, 90, 80], "class": "car"}
+    assert rescaled[1]["bbox"] == [4.5, 4.0, 9.0, 8.0]
+    assert rescaled[2] == {"class": "no box"}
+    assert results[0]["bbox"] == [10, 20, 30, 40]
+    assert rescale_results("No vehicles detected", (3.0, 2.0)) == "No vehicles detected"
+
+
+def test_client_sends_resized_frames_and_returns_original_coordinates(detector):
+    original = encoded_frame()
+    client = DetectorClient(detector.url, latency_budget=5, hedging=False, input_size=640)
+
+    results = client.detect(original)
+    reference = find_red_box(original)
+
+    assert len(detector.received[0]) < len(original) / 3
+    assert results[0]["bbox"] == pytest.approx(reference[0]["bbox"], abs=4)
+    assert client.stats()["bytes_sent"] == len(detector.received[0])
+    assert client.stats()["bytes_original"] == len(original)
+
+
+def test_fallback_gets_the_original_frame():
+    original = encoded_frame()
+    received = []
+
+    def fallback(image_data):
+        received.append(image_data)
+        return []
+
+    client = DetectorClient("http://127.0.0.1:9/", latency_budget=0.5, hedging=False, fallback=fallback, input_size=640)
+    client.circuit_breaker.record_failure()
+    client.circuit_breaker.state = client.circuit_breaker.OPEN
+    client.circuit_breaker.opened_at = client.circuit_breaker.clock()
+
+    assert client.detect(original) == []
+    assert received == [original]
@@ -0,0 +1,223 @@
+import os
+import uuid
+
+import pytest
+import pymongo
+
+from shared.mongo_writer import WriteBehindBuffer
+
+# Point this at a local mongod, e.g. mongodb://localhost:27017/
+MONGO_TEST_URI = os.environ.get('MONGO_TEST_URI')
+
+live_mongo = pytest.mark.skipif(not MONGO_TEST_URI, reason="MONGO_TEST_URI is not set")
+
+
+class RecordingCollection:
+    """Records bulk writes and fails the operations at ``failing`` indexes, like the server would."""
+
+    full_name = "lambda_outputs.combined_output"
+
+    def __init__(self, failing=(), error=None):
+        self.failing = set(failing)
+        self.error = error
+        self.writes = []
+
+    def bulk_write(self, requests, ordered):
+        self.writes.append([(request._filter, request._doc, request._upsert) for request in requests])
+        if self.error is not None:
+            raise self.error
+        failing = sorted(index for index in self.failing if index < len(requests))
+        if failing:
+            raise pymongo.errors.BulkWriteError({
+                "writeErrors": [{"index": index, "code": 2, "errmsg": "Cannot create field"} for index in failing],
+                "writeConcernErrors": [], "nUpserted": len(requests) - len(failing)
+            })
+
+        class Result:
+            acknowledged = True
+            matched_count = modified_count = 0
+            upserted_count = len(requests)
+
+        return Result()
+
+
+class ReorderingCollection(RecordingCollection):
+    """Applies ``$set`` and ``$unset`` to in-memory documents, unordered bulk writes last operation first."""
+
+    def __init__(self, failing=()):
+        super().__init__(failing)
+        self.documents = {}
+
+    def bulk_write(self, requests, ordered):
+        result = super().bulk_write(requests, ordered)
+        for request in reversed(requests) if not ordered else requests:
+            document = self.documents.setdefault(request._filter["stream_Id"], {})
+            for path, value in request._doc.get("$set", {}).items():
+                *parents, field = path.split(".")
+                target = document
+                for parent in parents:
+                    target = target.setdefault(parent, {})
+                target[field] = value
+            for path in request._doc.get("$unset", {}):
+                *parents, field = path.split(".")
+                target = document
+                for parent in parents:
+                    target = target.get(parent, {})
+                target.pop(field, None)
+        return result
+
+
+@pytest.fixture
+def collection():
+    client = pymongo.MongoClient(MONGO_TEST_URI, serverSelectionTimeoutMS=2000)
+    collection = client["lambda_outputs_test"][f"combined_output_{uuid.uuid4().hex}"]
+    yield collection
+    collection.drop()
+    client.close()
+
+
+def frame_update(detection_type, frame_id, status):
+    return {"$set": {"updated_at": "2025-01-27T10:39:50", f"{detection_type}.{frame_id}": status}}
+
+
+@live_mongo
+def test_updates_to_one_stream_are_merged_into_one_write(collection):
+    buffer = WriteBehindBuffer()
+    for frame_id in range(5):
+        buffer.update_one(collection, {"stream_Id": "1"}, frame_update("vehicle_status", frame_id, "No vehicles detected"), tag=f"m{frame_id}")
+    buffer.update_one(collection, {"stream_Id": "2"}, frame_update("vehicle_status", 0, "No vehicles detected"), tag="m5")
+
+    assert collection.count_documents({}) == 0
+    assert buffer.flush() == []
+
+    document = collection.find_one({"stream_Id": "1"})
+    assert sorted(document["vehicle_status"]) == ["0", "1", "2", "3", "4"]
+    assert collection.count_documents({}) == 2
+
+
+@live_mongo
+def test_threshold_triggers_early_flush(collection):
+    buffer = WriteBehindBuffer(flush_threshold=3)
+    for stream_id in range(4):
+        buffer.update_one(collection, {"stream_Id": str(stream_id)}, frame_update("fire_status", 1, "fire not detected"))
+
+    assert collection.count_documents({}) == 3
+    buffer.flush()
+    assert collection.count_documents({}) == 4
+
+
+@live_mongo
+def test_failed_writes_report_their_tags(collection):
+    collection.create_index("stream_Id", unique=True)
+    collection.insert_one({"stream_Id": "1", "fall_status": "not a document"})
+
+    buffer = WriteBehindBuffer()
+    # Setting a field below a string fails on the server; the other write still goes through
+    buffer.update_one(collection, {"stream_Id": "1"}, frame_update("fall_status", 7, "fall detected"), tag="bad")
+    buffer.update_one(collection, {"stream_Id": "2"}, frame_update("fall_status", 7, "fall detected"), tag="good")
+
+    assert buffer.flush() == ["bad"]
+    assert collection.find_one({"stream_Id": "2"})["fall_status"] == {"7": "fall detected"}
+
+
+def test_updates_of_one_document_are_merged():
+    collection = RecordingCollection()
+    buffer = WriteBehindBuffer()
+    for frame_id in range(3):
+        buffer.update_one(collection, {"stream_Id": "1"}, frame_update("vehicle_status", frame_id, "No vehicles detected"), tag=f"m{frame_id}")
+    buffer.update_one(collection, {"stream_Id": "1"}, {"$inc": {"frames": 1}}, tag="m3")
+    buffer.update_one(collection, {"stream_Id": "1"}, {"$inc": {"frames": 2}}, tag="m4")
+    buffer.update_one(collection, {"stream_Id": "2"}, frame_update("vehicle_status", 0, "No vehicles detected"), tag="m5")
+
+    assert collection.writes == []
+    assert buffer.flush() == []
+
+    [writes] = collection.writes
+    assert writes[0] == ({"stream_Id": "1"}, {"$set": {
+        "updated_at": "2025-01-27T10:39:50", "vehicle_status.0": "No vehicles detected",
+        "vehicle_status.1": "No vehicles detected", "vehicle_status.2": "No vehicles detected"
+    }, "$inc": {"frames": 3}}, True)
+    assert writes[1][0] == {"stream_Id": "2"}
+
+
+def test_conflicting_updates_are_written_separately():
+    collection = RecordingCollection()
+    buffer = WriteBehindBuffer()
+    buffer.update_one(collection, {"stream_Id": "1"}, {"$set": {"fire_status": {"1": "fire detected"}}}, tag="a")
+    # A field below one set before, and the same field with another operator
+    buffer.update_one(collection, {"stream_Id": "1"}, {"$set": {"fire_status.2": "fire not detected"}}, tag="b")
+    buffer.update_one(collection, {"stream_Id": "1"}, {"$unset": {"fire_status.2": ""}}, tag="c")
+
+    buffer.flush()
+
+    # Each one waits for the bulk write of the one before
+    assert [[update for _, update, _ in writes] for writes in collection.writes] == [
+        [{"$set": {"fire_status": {"1": "fire detected"}}}],
+        [{"$set": {"fire_status.2": "fire not detected"}}],
+        [{"$unset": {"fire_status.2": ""}}]
+    ]
+
+
+def test_the_latest_update_of_a_document_wins():
+    collection = ReorderingCollection()
+    buffer = WriteBehindBuffer()
+    buffer.update_one(collection, {"stream_Id": "1"}, {"$set": {"fire_status": {"1": "fire detected"}}}, tag="a")
+    buffer.update_one(collection, {"stream_Id": "2"}, {"$set": {"fire_status.1": "fire not detected"}}, tag="b")
+    buffer.update_one(collection, {"stream_Id": "1"}, {"$set": {"fire_status.2": "fire not detected"}}, tag="c")
+    buffer.update_one(collection, {"stream_Id": "1"}, {"$set": {"fire_status": {"3": "fire detected"}}}, tag="d")
+
+    assert buffer.flush() == []
+    assert collection.documents == {"1": {"fire_status": {"3": "fire detected"}},
+                                    "2": {"fire_status": {"1": "fire not detected"}}}
+    # Updates of other documents still share the first bulk write
+    assert [len(writes) for writes in collection.writes] == [2, 1, 1]
+
+
+def test_later_updates_of_a_document_wait_for_its_failed_update():
+    collection = ReorderingCollection(failing=[0])
+    buffer = WriteBehindBuffer()
+    buffer.update_one(collection, {"stream_Id": "1"}, {"$set": {"fire_status": {"1": "fire detected"}}}, tag="a")
+    buffer.update_one(collection, {"stream_Id": "2"}, {"$set": {"fire_status.1": "fire not detected"}}, tag="b")
+    buffer.update_one(collection, {"stream_Id": "1"}, {"$set": {"fire_status.2": "fire not detected"}}, tag="c")
+
+    # Written without the update before it, the newer one would be overwritten by the retry
+    assert buffer.flush() == ["a", "c"]
+    assert len(collection.writes) == 1
+
+
+def test_threshold_writes_early_and_flush_reports_its_failures():
+    collection = RecordingCollection(failing=[1])
+    buffer = WriteBehindBuffer(flush_threshold=3)
+    for stream_id in range(4):
+        buffer.update_one(collection, {"stream_Id": str(stream_id)}, frame_update("fire_status", 1, "fire not detected"), tag=f"m{stream_id}")
+
+    assert [len(writes) for writes in collection.writes] == [3]
+    assert buffer.flush() == ["m1"]
+    assert [len(writes) for writes in collection.writes] == [3, 1]
+    assert buffer.flush() == []
+
+
+def test_write_errors_are_mapped_to_the_tags_of_their_operations():
+    collection = RecordingCollection(failing=[0, 2])
+    buffer = WriteBehindBuffer()
+    buffer.update_one(collection, {"stream_Id": "1"}, frame_update("fall_status", 7, "fall detected"), tag="a")
+    buffer.update_one(collection, {"stream_Id": "1"}, frame_update("fall_status", 8, "fall detected"), tag="b")
+    buffer.update_one(collection, {"stream_Id": "2"}, frame_update("fall_status", 7, "fall detected"), tag="c")
+    buffer.update_one(collection, {"stream_Id": "3"}, frame_update("fall_status", 7, "fall detected"), tag="d")
+
+    # Merged operations report every message they carry
+    assert buffer.flush() == ["a", "b", "d"]
+
+
+@pytest.mark.parametrize("error", [
+    pymongo.errors.BulkWriteError({"writeErrors": [], "writeConcernErrors": [{"code": 64, "errmsg": "waiting for replication timed out"}]}),
+    pymongo.errors.ServerSelectionTimeoutError("no servers")
+])
+def test_failed_bulk_writes_fail_every_operation(error):
+    collection = RecordingCollection(error=error)
+    buffer = WriteBehindBuffer()
+    buffer.update_one(collection, {"stream_Id": "1"}, frame_update("fall_status", 7, "fall detected"), tag="a")
+    buffer.update_one(collection, {"stream_Id": "2"}, frame_update("fall_status", 7, "fall detected"), tag="b")
+    buffer.update_one(collection, {"stream_Id": "3"}, frame_update("fall_status", 7, "fall detected"))
+
+    assert buffer.flush() == ["a", "b"]
@@ -0,0 +1,121 @@
+import threading
+
+import cv2
+import numpy as np
+import pytest
+
+from shared.mosaic import MosaicBatcher
+
+
+def encoded_frame(box, width=280, height=210):
+    frame = np.full((height, width, 3), 90, dtype=np.uint8)
+    cv2.rectangle(frame, box[:2], box[2:], (0, 0, 255), -1)
+    return cv2.imencode('.png', frame)[1].tobytes()
+
+
+class RedBoxModel:
+    """Returns one detection per red blob of the image it receives."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, image_data):
+        image = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        self.calls.append(image.shape[:2])
+        mask = cv2.inRange(image, (0, 0, 150), (100, 100, 255))
+        count, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+        return [{"bbox": [int(x), int(y), int(x + w - 1), int(y + h - 1)], "class": "car"} for x, y, w, h, _ in stats[1:count]]
+
+
+def detect_together(batcher, frames):
+    results = [None] * len(frames)
+
+    def detect(index):
+        results[index] = batcher.detect(frames[index])
+
+    threads = [threading.Thread(target=detect, args=(index,)) for index in range(len(frames))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_frames_share_one_call_and_keep_their_coordinates():
+    model = RedBoxModel()
+    batcher = MosaicBatcher(model, canvas_size=640, max_tiles=4, max_wait=5, gutter=16, enabled=True)
+    boxes = [(10, 20, 60, 80), (100, 50, 200, 150), (0, 0, 40, 40), (230, 160, 279, 209)]
+
+    results = detect_together(batcher, [encoded_frame(box) for box in boxes])
+
+    assert len(model.calls) == 1
+    assert model.calls[0] == (640, 640)
+    for result, box in zip(results, boxes):
+        # The canvas is a JPEG, which blurs the edges of the boxes a little
+        assert result[0]["bbox"] == pytest.approx(list(box), abs=2)
+    assert (batcher.requests, batcher.frames) == (1, 4)
+
+
+def test_boxes_crossing_tile_borders_are_dropped():
+    def model(image_data):
+        return [
+            {"bbox": [250, 10, 330, 60], "class": "car"},  # spans the first two tiles
+            {"bbox": [300, 300, 310, 310], "class": "car"},  # below the frames, in empty canvas
+            {"bbox": [340, 10, 380, 60], "class": "car"}
+        ]
+
+    batcher = MosaicBatcher(model, canvas_size=640, max_tiles=2, max_wait=5, gutter=16, enabled=True)
+
+    results = detect_together(batcher, [encoded_frame((0, 0, 1, 1)), encoded_frame((0, 0, 1, 1))])
+
+    # The frames take the tiles in the order they reach the batcher
+    assert sorted(results, key=len) == [[], [{"bbox": [12, 10, 52, 60], "class": "car"}]]
+
+
+def test_a_frame_waiting_alone_is_sent_unchanged():
+    sent = []
+    batcher = MosaicBatcher(lambda image_data: sent.append(image_data) or [], max_tiles=4, max_wait=0.01, enabled=True)
+    frame = encoded_frame((10, 10, 20, 20))
+
+    assert batcher.detect(frame) == []
+    assert sent == [frame]
+
+
+def test_large_frames_are_not_tiled():
+    model = RedBoxModel()
+    batcher = MosaicBatcher(model, canvas_size=640, max_tiles=4, max_wait=5, enabled=True)
+
+    results = batcher.detect(encoded_frame((10, 20, 30, 40), width=640, height=480))
+
+    assert model.calls == [(480, 640)]
+    assert results[0]["bbox"] == [10, 20, 30, 40]
+    assert batcher.requests == 0
+
+
+def test_errors_reach_every_frame_of_the_mosaic():
+    def failing(image_data):
+        raise Exception("Modal API request failed with status code 500")
+
+    batcher = MosaicBatcher(failing, max_tiles=2, max_wait=5, enabled=True)
+    errors = []
+
+    def detect():
+        with pytest.raises(Exception, match="status code 500"):
+            batcher.detect(encoded_frame((0, 0, 1, 1)))
+        errors.append(True)
+
+    threads = [threading.Thread(target=detect) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == [True, True]
+
+
+def test_disabled_batcher_sends_every_frame():
+    model = RedBoxModel()
+    batcher = MosaicBatcher(model, max_tiles=4, max_wait=5, enabled=False)
+
+    detect_together(batcher, [encoded_frame((0, 0, 10, 10)) for _ in range(3)])
+
+    assert model.calls == [(210, 280)] * 3
@@ -0,0 +1,110 @@
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from shared.motion_gate import MotionGate
+
+
+def render_frame(box_x=200, box_y=150, noise_seed=0):
+    """Textured background with a bright textured block, encoded as JPEG."""
+    rng = np.random.default_rng(noise_seed)
+    frame = np.full((480, 640, 3), 90, dtype=np.uint8)
+    frame += rng.integers(0, 4, frame.shape, dtype=np.uint8)
+    block = np.random.default_rng(42).integers(120, 255, (80, 120, 3), dtype=np.uint8)
+    frame[box_y:box_y + 80, box_x:box_x + 120] = block
+    _, buffer = cv2.imencode('.jpg', frame)
+    return buffer.tobytes()
+
+
+class CountingDetector:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, image_data):
+        self.calls += 1
+        return [{"bbox": [200, 150, 320, 230], "confidence": 0.9, "class": "car"}]
+
+
+def test_static_scene_propagates_previous_detections():
+    gate = MotionGate(motion_threshold=0.02, max_propagations=10)
+    detector = CountingDetector()
+
+    results, propagated = gate.detect("cam-1", render_frame(noise_seed=0), detector)
+    assert not propagated
+
+    results, propagated = gate.detect("cam-1", render_frame(noise_seed=1), detector)
+    assert propagated
+    assert detector.calls == 1
+    assert results[0]["propagated"] is True
+    assert results[0]["bbox"] == [200, 150, 320, 230]
+
+
+def test_small_motion_shifts_boxes_with_optical_flow():
+    gate = MotionGate(motion_threshold=0.2)
+    detector = CountingDetector()
+
+    gate.detect("cam-1", render_frame(), detector)
+    results, propagated = gate.detect("cam-1", render_frame(box_x=208, box_y=154), detector)
+
+    assert propagated
+    x1, y1, _, _ = results[0]["bbox"]
+    assert abs(x1 - 208) <= 3
+    assert abs(y1 - 154) <= 3
+
+
+def test_large_change_and_other_streams_call_the_model():
+    gate = MotionGate(motion_threshold=0.02)
+    detector = CountingDetector()
+
+    gate.detect("cam-1", render_frame(), detector)
+    gate.detect("cam-2", render_frame(), detector)
+    _, propagated = gate.detect("cam-1", render_frame(box_x=450, box_y=350), detector)
+
+    assert not propagated
+    assert detector.calls == 3
+
+
+def test_inference_is_forced_after_max_propagations():
+    gate = MotionGate(motion_threshold=0.02, max_propagations=2)
+    detector = CountingDetector()
+
+    flags = [gate.detect("cam-1", render_frame(), detector)[1] for _ in range(5)]
+    assert flags == [False, True, True, False, True]
+    assert gate.inferred == 2
+    assert gate.propagated == 3
+
+
+def test_concurrent_frames_of_a_stream_wait_for_each_other():
+    gate = MotionGate(motion_threshold=0.02, max_propagations=10)
+    counting = CountingDetector()
+
+    def detector(image_data):
+        # A remote call, long enough for the other frames to arrive meanwhile
+        time.sleep(0.1)
+        return counting(image_data)
+
+    threads = [threading.Thread(target=gate.detect, args=("cam-1", render_frame(noise_seed=seed), detector))
+               for seed in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert counting.calls == 1
+    assert (gate.inferred, gate.propagated) == (1, 3)
+
+
+def test_late_frames_do_not_replace_the_state_of_newer_frames():
+    gate = MotionGate(motion_threshold=0.02, max_propagations=10)
+    detector = CountingDetector()
+
+    gate.detect("cam-1", render_frame(), detector, frame_number=5)
+    # An older frame from before the object arrived, processed late
+    _, propagated = gate.detect("cam-1", render_frame(box_x=450, box_y=350), detector, frame_number=3)
+    assert not propagated
+
+    _, propagated = gate.detect("cam-1", render_frame(noise_seed=1), detector, frame_number=6)
+    assert propagated
+    assert detector.calls == 2
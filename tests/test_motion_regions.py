@@ -0,0 +1,217 @@
+import importlib.util
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+from shared import motion_regions, sqs_batch
+from shared.frame_manifest import manifest_frames
+from shared.motion_regions import CropReferences, changed_regions, crop_boxes, detect_regions, union
+from shared.roi import RegionOfInterest
+
+LAMBDAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lambdas")
+
+# Lower half of the frame
+LOWER_HALF = [[[0.0, 0.5], [1.0, 0.5], [1.0, 1.0], [0.0, 1.0]]]
+
+
+def scene(*blocks, width=1280, height=720):
+    """An RGB frame with red blocks at ``(x1, y1, x2, y2)``."""
+    frame = np.full((height, width, 3), 30, dtype=np.uint8)
+    for x1, y1, x2, y2 in blocks:
+        frame[y1:y2, x1:x2] = (230, 0, 0)
+    return frame
+
+
+def encoded(frame):
+    return cv2.imencode('.png', cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))[1].tobytes()
+
+
+class RedBoxModel:
+    """Returns one detection per red blob of the image it receives."""
+
+    def __init__(self, latency=0.0):
+        self.shapes = []
+        self.latency = latency
+        self.lock = threading.Lock()
+
+    def __call__(self, image_data):
+        image = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        time.sleep(self.latency)
+        with self.lock:
+            self.shapes.append(image.shape[:2])
+        mask = cv2.inRange(image, (0, 0, 150), (100, 100, 255))
+        count, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+        return [{"bbox": [int(x), int(y), int(x + w), int(y + h)], "class": "car"} for x, y, w, h, _ in stats[1:count]]
+
+
+def test_regions_cover_what_moved():
+    before = scene((100, 100, 200, 200), (900, 500, 1000, 600))
+    after = scene((140, 100, 240, 200), (900, 500, 1000, 600))
+
+    regions = changed_regions(before, after)
+
+    # The leading and trailing edges of a flat block
+    assert all(isinstance(value, float) for region in regions for value in region)
+    x1, y1, x2, y2 = union(regions)
+    assert x1 * 1280 <= 100 and x2 * 1280 >= 240
+    assert y1 * 720 <= 100 and y2 * 720 >= 200
+    assert x2 * 1280 < 400
+
+
+def test_still_frames_have_no_regions():
+    frame = scene((100, 100, 200, 200))
+
+    assert changed_regions(frame, frame.copy()) == []
+
+
+def test_regions_follow_the_uploaded_frame_of_a_region_of_interest():
+    before = scene((100, 100, 200, 200), (600, 500, 700, 600))
+    after = scene((600, 100, 700, 200), (640, 500, 740, 600))
+
+    full = changed_regions(before, after, RegionOfInterest(LOWER_HALF))
+    cropped = changed_regions(before, after, RegionOfInterest(LOWER_HALF, crop=True))
+
+    # The change above the region is ignored
+    assert len(full) == len(cropped) > 0
+    assert union(full)[1] >= 0.5
+    assert union(cropped)[1] == pytest.approx(union(full)[1] * 2 - 1, abs=0.01)
+    assert union(cropped)[0] == pytest.approx(union(full)[0], abs=0.01)
+
+
+def test_crops_are_padded_clipped_and_merged():
+    regions = [[0.1, 0.1, 0.2, 0.2], [0.22, 0.1, 0.3, 0.2], [0.0, 0.9, 0.05, 1.0]]
+
+    assert crop_boxes(regions, 1000, 1000, padding=0.25, min_padding=10, merge=False) == [
+        [75, 75, 225, 225], [200, 75, 320, 225], [0, 875, 63, 1000]]
+    assert crop_boxes(regions, 1000, 1000, padding=0.25, min_padding=10, merge=True) == [
+        [75, 75, 320, 225], [0, 875, 63, 1000]]
+
+
+def test_crops_are_sent_and_boxes_returned_in_frame_coordinates():
+    frame = scene((300, 200, 380, 260), (1000, 500, 1060, 580))
+    model = RedBoxModel()
+    regions = [[300 / 1280, 200 / 720, 380 / 1280, 260 / 720], [1000 / 1280, 500 / 720, 1060 / 1280, 580 / 720]]
+
+    results = detect_regions(encoded(frame), regions, model, reference=[], enabled=True, padding=0.25, min_padding=32)
+
+    assert len(model.shapes) == 2
+    assert all(height * width < 0.05 * 1280 * 720 for height, width in model.shapes)
+    assert sorted(detection["bbox"] for detection in results) == [[300, 200, 380, 260], [1000, 500, 1060, 580]]
+
+
+def test_stationary_objects_are_kept_from_the_reference_frame():
+    parked, moving = (100, 500, 220, 580), (600, 200, 680, 260)
+    before = scene(parked, moving)
+    after = scene(parked, (660, 200, 740, 260))
+    model = RedBoxModel()
+    reference = model(encoded(before))
+
+    results = detect_regions(encoded(after), changed_regions(before, after), model, reference=reference, enabled=True)
+
+    # Only the moving object was sent, the parked one is where the reference frame saw it
+    assert len(model.shapes) == 2 and model.shapes[1][0] < 200
+    assert sorted(detection["bbox"] for detection in results) == [[100, 500, 220, 580], [660, 200, 740, 260]]
+
+
+def test_frames_are_sent_whole_without_useful_regions():
+    frame = encoded(scene((300, 200, 380, 260)))
+    model = RedBoxModel()
+
+    detect_regions(frame, None, model, reference=[], enabled=True)
+    detect_regions(frame, [[0.0, 0.0, 0.9, 0.9]], model, reference=[], enabled=True, max_area=0.6)
+    detect_regions(frame, [[0.2, 0.2, 0.3, 0.3]], model, reference=[], enabled=False)
+    # Without the results of the reference frame the objects outside the crops are unknown
+    detect_regions(frame, [[0.2, 0.2, 0.3, 0.3]], model, reference=None, enabled=True)
+
+    assert model.shapes == [(720, 1280)] * 4
+
+
+def test_references_are_kept_per_stream_and_frame():
+    references = CropReferences(max_frames=2, enabled=True)
+    references.put("cam-1", 5, [{"bbox": [0, 0, 10, 10]}])
+    references.put("cam-2", 5, [])
+    references.put("cam-1", 6, "No vehicles detected")
+    references.put("cam-1", None, [])
+
+    assert references.get("cam-1", 5) == [{"bbox": [0, 0, 10, 10]}]
+    assert references.get("cam-2", 5) == []
+    assert references.get("cam-1", 6) is None
+    assert references.get("cam-1", None) is None
+
+    # The least recently used frame is evicted
+    references.put("cam-1", 7, [])
+    assert references.get("cam-1", 5) is None
+    assert references.get("cam-2", 5) == []
+
+    disabled = CropReferences(enabled=False)
+    disabled.put("cam-1", 5, [])
+    assert disabled.get("cam-1", 5) is None
+
+
+def test_manifest_frames_carry_their_regions():
+    message = {"bucket": "frames-nht", "stream_id": "cam-1",
+               "frames": [{"key": "cam-1/frame_0001.jpg", "frame_id": "frame_0001", "regions": [[0.1, 0.2, 0.3, 0.4]]}]}
+
+    event = next(manifest_frames(message))
+
+    assert event["frame"]["regions"] == [[0.1, 0.2, 0.3, 0.4]]
+
+
+class FakeCollection:
+    def __init__(self, name):
+        self.full_name = f"lambda_outputs.{name}"
+        self.writes = []
+
+    def bulk_write(self, requests, ordered):
+        self.writes.extend(requests)
+        return SimpleNamespace(acknowledged=True, matched_count=0, modified_count=0, upserted_count=len(requests))
+
+
+def load_car_detection(monkeypatch, model):
+    path = os.path.join(LAMBDAS_DIR, "stateful/car-detection-nht/lambda_function.py")
+    spec = importlib.util.spec_from_file_location("car_detection_crops_test", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    collections = {}
+    monkeypatch.setattr(motion_regions, "MOTION_CROPS_ENABLED", True)
+    monkeypatch.setattr(sqs_batch, "MOTION_CROPS_ENABLED", True)
+    monkeypatch.setattr(module, "crop_references", CropReferences(enabled=True))
+    monkeypatch.setattr(module, "MOTION_GATE_ENABLED", False)
+    monkeypatch.setattr(module, "mosaic", SimpleNamespace(detect=model))
+    monkeypatch.setattr(module, "get_collection", lambda name: collections.setdefault(name, FakeCollection(name)))
+    monkeypatch.setattr(module, "get_mongo_db", lambda: None)
+    return module
+
+
+def test_frames_of_a_manifest_are_sent_as_crops(monkeypatch):
+    # A parked car and a car driving across four frames
+    parked = (100, 500, 220, 580)
+    frames = [scene(parked, (400 + 60 * number, 200, 480 + 60 * number, 260)) for number in range(4)]
+    images = {f"cam-1/frame_{number:04d}.jpg": encoded(frame) for number, frame in enumerate(frames)}
+    manifest = {"type": "frame_manifest", "version": 1, "bucket": "frames-nht", "video_key": "uploads/cam-1.mp4",
+                "stream_id": "cam-1", "frames": [{"key": "cam-1/frame_0000.jpg", "frame_id": "frame_0000", "frame_number": 0}]}
+    for number in range(1, 4):
+        manifest["frames"].append({"key": f"cam-1/frame_{number:04d}.jpg", "frame_id": f"frame_{number:04d}",
+                                   "frame_number": number, "reference_frame": number - 1,
+                                   "regions": changed_regions(frames[number - 1], frames[number])})
+    # Slow enough that frames running at the same time would all miss their reference
+    model = RedBoxModel(latency=0.05)
+    module = load_car_detection(monkeypatch, model)
+    monkeypatch.setattr(module, "fetch_image_from_s3", lambda bucket, key, expiration=3600: SimpleNamespace(content=images[key]))
+
+    response = module.lambda_handler({"Records": [{"messageId": "m-0", "receiptHandle": "h-0", "body": json.dumps(manifest)}]}, None)
+
+    assert response["batchItemFailures"] == []
+    # Only the first frame is sent whole, the others as crops of the moving car
+    assert model.shapes[0] == (720, 1280)
+    assert len(model.shapes) == 4
+    assert all(height * width < 0.05 * 1280 * 720 for height, width in model.shapes[1:])
+    # The parked car is carried over from the frame before
+    assert sorted(detection["bbox"] for detection in module.crop_references.get("cam-1", 3)) == [
+        [100, 500, 220, 580], [580, 200, 660, 260]]
@@ -0,0 +1,133 @@
+import os
+import pstats
+import time
+import tracemalloc
+
+import pytest
+
+from shared import clients
+from shared.profiling import StackSampler, profiled
+
+
+class FakeContext:
+    function_name = "car-detection-nht"
+    aws_request_id = "req-1"
+
+
+def busy_handler(event, context):
+    deadline = time.monotonic() + 0.05
+    total = 0
+    while time.monotonic() < deadline:
+        total += sum(range(100))
+    blocks = [bytearray(1024) for _ in range(event.get("blocks", 0))]
+    return {"statusCode": 200, "total": total, "blocks": len(blocks)}
+
+
+def profile_files(directory):
+    return [os.path.join(root, name) for root, _, names in os.walk(directory) for name in names]
+
+
+def test_disabled_profiling_returns_the_handler_itself():
+    assert profiled(busy_handler, mode='') is busy_handler
+
+
+def test_unknown_mode_leaves_the_handler_unprofiled():
+    assert profiled(busy_handler, mode='perf') is busy_handler
+
+
+def test_cprofile_writes_loadable_pstats(tmp_path):
+    handler = profiled(mode='cprofile', output=str(tmp_path))(busy_handler)
+
+    assert handler({}, FakeContext())["statusCode"] == 200
+
+    [path] = profile_files(tmp_path)
+    assert path.endswith("-req-1.pstats")
+    assert os.path.basename(os.path.dirname(path)) == "car-detection-nht"
+    stats = pstats.Stats(path)
+    assert any(function[2] == "busy_handler" for function in stats.stats)
+
+
+def test_tracemalloc_writes_snapshot_and_stops_tracing(tmp_path):
+    handler = profiled(busy_handler, mode='tracemalloc', output=str(tmp_path))
+
+    handler({"blocks": 100}, FakeContext())
+
+    [path] = profile_files(tmp_path)
+    assert path.endswith(".tracemalloc")
+    assert tracemalloc.Snapshot.load(path).statistics('filename')
+    assert not tracemalloc.is_tracing()
+
+
+def test_sampler_writes_collapsed_stacks(tmp_path):
+    handler = profiled(busy_handler, mode='sample', output=str(tmp_path))
+
+    handler({}, FakeContext())
+
+    [path] = profile_files(tmp_path)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert lines
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) > 0
+    assert any("busy_handler" in line for line in lines)
+
+
+def test_sample_rate_zero_never_profiles(tmp_path):
+    handler = profiled(busy_handler, mode='cprofile', sample_rate=0, output=str(tmp_path))
+
+    handler({}, FakeContext())
+
+    assert profile_files(tmp_path) == []
+
+
+def test_handler_errors_propagate_and_profile_is_kept(tmp_path):
+    def failing(event, context):
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        profiled(failing, mode='cprofile', output=str(tmp_path))({}, FakeContext())
+    assert len(profile_files(tmp_path)) == 1
+
+
+def test_profiles_are_uploaded_to_s3(tmp_path):
+    class RecordingS3:
+        uploads = []
+
+        def upload_file(self, path, bucket, key):
+            with open(path, 'rb') as f:
+                self.uploads.append((bucket, key, f.read()))
+
+    s3 = RecordingS3()
+    clients.set_client("s3", s3)
+    try:
+        profiled(busy_handler, mode='sample', output="s3://profiles-bucket/prod")({}, FakeContext())
+    finally:
+        clients._clients.pop("s3", None)
+
+    [(bucket, key, body)] = s3.uploads
+    assert bucket == "profiles-bucket"
+    assert key.startswith("prod/car-detection-nht/") and key.endswith("-req-1.collapsed")
+    assert body
+
+
+def test_storage_failures_do_not_fail_the_invocation():
+    class FailingS3:
+        def upload_file(self, path, bucket, key):
+            raise Exception("access denied")
+
+    clients.set_client("s3", FailingS3())
+    try:
+        result = profiled(busy_handler, mode='cprofile', output="s3://profiles-bucket")({}, FakeContext())
+    finally:
+        clients._clients.pop("s3", None)
+    assert result["statusCode"] == 200
+
+
+def test_stack_sampler_counts_other_threads():
+    sampler = StackSampler(interval_ms=1)
+    sampler.start()
+    busy_handler({}, None)
+    sampler.stop()
+
+    assert sum(sampler.stacks.values()) > 0
+    assert all(not stack.startswith("stack-sampler") for stack in sampler.stacks)
@@ -0,0 +1,56 @@
+from shared.mongo_writer import WriteBehindBuffer
+from shared.result_buckets import bucket_update, get_bucket, get_frame_number
+
+TIMESTAMP = "2025-01-27T10:39:50.206000"
+
+
+class RecordingCollection:
+    full_name = "lambda_outputs.combined_output"
+
+    def __init__(self):
+        self.requests = []
+
+    def bulk_write(self, requests, ordered):
+        self.requests.extend(requests)
+
+        class Result:
+            acknowledged = True
+            matched_count = modified_count = 0
+            upserted_count = len(requests)
+
+        return Result()
+
+
+def test_frames_are_bucketed_by_trailing_frame_number():
+    assert get_frame_number("frame_0012") == 12
+    assert get_frame_number("1234_cam_56_0099") == 99
+    assert get_bucket("frame_0999", TIMESTAMP, bucket_size=1000) == 0
+    assert get_bucket("frame_1000", TIMESTAMP, bucket_size=1000) == 1
+    assert get_bucket("57", TIMESTAMP, bucket_size=10) == 5
+
+
+def test_frames_without_number_are_bucketed_by_hour():
+    assert get_bucket("snapshot", TIMESTAMP) == "t2025-01-27T10"
+
+
+def test_bucket_update_tracks_frame_range():
+    query, update = bucket_update("1234", "fire_status", "frame_2001", "fire not detected", TIMESTAMP, bucket_size=1000)
+    assert query == {"stream_Id": "1234", "bucket": 2}
+    assert update["$set"]["fire_status.frame_2001"] == "fire not detected"
+    assert update["$min"] == {"frame_start": 2001}
+    assert update["$max"] == {"frame_end": 2001}
+    assert update["$setOnInsert"] == {"created_at": TIMESTAMP}
+
+
+def test_frames_of_one_bucket_merge_into_one_write():
+    collection = RecordingCollection()
+    buffer = WriteBehindBuffer()
+    for frame_number in (5, 3, 9, 1005):
+        query, update = bucket_update("1234", "vehicle_status", f"frame_{frame_number:04d}", [], TIMESTAMP, bucket_size=1000)
+        buffer.update_one(collection, query, update)
+    buffer.flush()
+
+    assert len(collection.requests) == 2
+    first_bucket = next(request for request in collection.requests if request._filter["bucket"] == 0)
+    assert first_bucket._doc["$min"] == {"frame_start": 3}
+    assert first_bucket._doc["$max"] == {"frame_end": 9}
@@ -0,0 +1,228 @@
+import os
+import re
+import uuid
+
+import pytest
+import pymongo
+
+from shared.mongo_writer import WriteBehindBuffer
+from shared.result_buckets import bucket_update
+from shared.results_query import ResultsCache, _bucket_filter, ensure_indexes, find_frames
+
+# Point this at a local mongod, e.g. mongodb://localhost:27017/
+MONGO_TEST_URI = os.environ.get('MONGO_TEST_URI')
+
+live_mongo = pytest.mark.skipif(not MONGO_TEST_URI, reason="MONGO_TEST_URI is not set")
+
+
+def evaluate(expression, variables):
+    """Evaluate the aggregation expressions used by find_frames, as the server would."""
+    if isinstance(expression, str) and expression.startswith("$$"):
+        name, _, field = expression[2:].partition(".")
+        value = variables[name]
+        return value[field] if field else value
+    if not isinstance(expression, dict):
+        return expression
+    [(operator, argument)] = expression.items()
+    if operator == "$regexFind":
+        match = re.search(argument["regex"], evaluate(argument["input"], variables))
+        return {"match": match.group(0), "captures": list(match.groups())} if match else None
+    if operator == "$let":
+        scope = dict(variables, **{name: evaluate(value, variables) for name, value in argument["vars"].items()})
+        return evaluate(argument["in"], scope)
+    if operator == "$arrayElemAt":
+        return evaluate(argument[0], variables)[argument[1]]
+    if operator == "$toInt":
+        return int(evaluate(argument, variables))
+    if operator == "$and":
+        return all(evaluate(condition, variables) for condition in argument)
+    if operator in ("$gte", "$lte"):
+        left, right = (evaluate(value, variables) for value in argument)
+        return left >= right if operator == "$gte" else left <= right
+    raise NotImplementedError(operator)
+
+
+def matches(document, query):
+    for field, condition in query.items():
+        value = document.get(field)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+        elif value is None or any((value < bound) if operator == "$gte" else (value > bound) for operator, bound in condition.items()):
+            return False
+    return True
+
+
+class FakeCursor(list):
+    def sort(self, field, direction):
+        self.sorted_by = (field, direction)
+        super().sort(key=lambda document: document[field], reverse=direction < 0)
+        return self
+
+    def batch_size(self, size):
+        self.batch = size
+        return self
+
+
+class FakeCollection:
+    """Bucket documents in memory, queried with the filters and pipelines of find_frames."""
+
+    name = "combined_output"
+    full_name = "lambda_outputs.combined_output"
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.calls = []
+
+    def find(self, query, projection):
+        self.calls.append(("find", query, projection))
+        self.cursor = FakeCursor({field: document[field] for field in projection if field in document and projection[field]}
+                                 for document in self.documents if matches(document, query))
+        return self.cursor
+
+    def aggregate(self, pipeline, batchSize):
+        self.calls.append(("aggregate", pipeline, batchSize))
+        [match], [sort], [project] = ([stage[name] for stage in pipeline if name in stage] for name in ("$match", "$sort", "$project"))
+        documents = sorted((document for document in self.documents if matches(document, match)), key=lambda document: document["bucket"])
+        projected = []
+        for document in documents:
+            row = {"bucket": document["bucket"]}
+            for field, expression in project.items():
+                if isinstance(expression, dict):
+                    trim = expression["$arrayToObject"]["$filter"]
+                    row[field] = {key: value for key, value in document.get(field, {}).items()
+                                  if evaluate(trim["cond"], {trim["as"]: {"k": key, "v": value}})}
+            projected.append(row)
+        return iter(projected)
+
+
+def bucket_documents(stream_id, frames, bucket_size=10, updated_at="2025-01-27T10:00:00"):
+    documents = {}
+    for frame_number in frames:
+        document = documents.setdefault(frame_number // bucket_size, {
+            "stream_Id": stream_id, "bucket": frame_number // bucket_size,
+            "created_at": updated_at, "updated_at": updated_at
+        })
+        document.setdefault("vehicle_status", {})[f"frame_{frame_number:04d}"] = "No vehicles detected"
+        document.setdefault("fire_status", {})[f"frame_{frame_number:04d}"] = "fire not detected"
+    return list(documents.values())
+
+
+@pytest.fixture
+def db():
+    client = pymongo.MongoClient(MONGO_TEST_URI, serverSelectionTimeoutMS=2000)
+    name = f"lambda_outputs_test_{uuid.uuid4().hex[:8]}"
+    yield client[name]
+    client.drop_database(name)
+    client.close()
+
+
+def store_frames(collection, stream_id, frames):
+    buffer = WriteBehindBuffer()
+    for frame_number, timestamp in frames:
+        for detection_type, status in (("vehicle_status", "No vehicles detected"), ("fire_status", "fire not detected")):
+            query, update = bucket_update(stream_id, detection_type, f"frame_{frame_number:04d}", status, timestamp, bucket_size=10)
+            buffer.update_one(collection, query, update)
+    assert buffer.flush() == []
+
+
+@live_mongo
+def test_ensure_indexes(db):
+    ensure_indexes(db)
+    index_names = db["combined_output"].index_information().keys()
+    assert {"stream_bucket", "stream_updated_at", "updated_at"} <= set(index_names)
+
+
+@live_mongo
+def test_frame_range_is_trimmed_on_the_server(db):
+    collection = db["combined_output"]
+    store_frames(collection, "1", [(n, "2025-01-27T10:00:00") for n in range(35)])
+    store_frames(collection, "2", [(n, "2025-01-27T10:00:00") for n in range(35)])
+
+    rows = list(find_frames(collection, "1", ["vehicle_status"], frame_start=8, frame_end=21, bucket_size=10))
+    assert [row["frame_id"] for row in rows] == [f"frame_{n:04d}" for n in range(8, 22)]
+    assert {row["detection_type"] for row in rows} == {"vehicle_status"}
+    assert {row["stream_Id"] for row in rows} == {"1"}
+
+
+@live_mongo
+def test_time_range_selects_buckets(db):
+    collection = db["combined_output"]
+    store_frames(collection, "1", [(n, "2025-01-27T10:00:00") for n in range(10)])
+    store_frames(collection, "1", [(n, "2025-01-27T12:00:00") for n in range(10, 20)])
+
+    rows = list(find_frames(collection, "1", ["fire_status"], since="2025-01-27T11:00:00"))
+    assert [row["frame_id"] for row in rows] == [f"frame_{n:04d}" for n in range(10, 20)]
+
+
+@live_mongo
+def test_cache_serves_repeated_queries(db):
+    collection = db["combined_output"]
+    store_frames(collection, "1", [(n, "2025-01-27T10:00:00") for n in range(5)])
+    cache = ResultsCache(ttl=60)
+
+    first = cache.find_frames(collection, "1", detection_types=["vehicle_status"])
+    store_frames(collection, "1", [(5, "2025-01-27T10:00:00")])
+    second = cache.find_frames(collection, "1", detection_types=["vehicle_status"])
+
+    assert first == second
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_filter_selects_the_buckets_of_a_frame_and_time_range():
+    assert _bucket_filter("1", None, None, None, None, 10) == {"stream_Id": "1"}
+    assert _bucket_filter("1", 8, 21, None, None, 10) == {"stream_Id": "1", "bucket": {"$gte": 0, "$lte": 2}}
+    assert _bucket_filter("1", 25, None, None, None, 10) == {"stream_Id": "1", "bucket": {"$gte": 2}}
+    # Buckets without frame numbers are not numeric and are skipped by an upper bound alone
+    assert _bucket_filter("1", None, 15, None, None, 10) == {"stream_Id": "1", "bucket": {"$lte": 1, "$gte": 0}}
+    assert _bucket_filter("1", None, None, "2025-01-27T11:00:00", "2025-01-27T12:00:00", 10) == {
+        "stream_Id": "1", "updated_at": {"$gte": "2025-01-27T11:00:00"}, "created_at": {"$lte": "2025-01-27T12:00:00"}}
+
+
+def test_whole_buckets_are_read_with_a_projection_in_pages():
+    collection = FakeCollection(bucket_documents("1", range(25)) + bucket_documents("2", range(5)))
+
+    rows = list(find_frames(collection, "1", ["vehicle_status"], batch_size=2, bucket_size=10))
+
+    [(method, query, projection)] = collection.calls
+    assert (method, query, projection) == ("find", {"stream_Id": "1"}, {"_id": 0, "bucket": 1, "vehicle_status": 1})
+    assert (collection.cursor.sorted_by, collection.cursor.batch) == (("bucket", 1), 2)
+    assert [row["frame_id"] for row in rows] == [f"frame_{n:04d}" for n in range(25)]
+    assert {(row["stream_Id"], row["detection_type"]) for row in rows} == {("1", "vehicle_status")}
+
+
+def test_frame_range_is_trimmed_by_the_pipeline():
+    collection = FakeCollection(bucket_documents("1", range(35)))
+
+    rows = list(find_frames(collection, "1", ["vehicle_status", "fire_status"], frame_start=8, frame_end=21,
+                            batch_size=50, bucket_size=10))
+
+    [(method, pipeline, batch_size)] = collection.calls
+    assert (method, batch_size) == ("aggregate", 50)
+    assert pipeline[0] == {"$match": {"stream_Id": "1", "bucket": {"$gte": 0, "$lte": 2}}}
+    assert pipeline[1] == {"$sort": {"bucket": 1}}
+    assert [row["frame_id"] for row in rows] == [f"frame_{n:04d}" for n in range(8, 22) for _ in range(2)]
+    assert [row["detection_type"] for row in rows[:2]] == ["fire_status", "vehicle_status"]
+
+
+def test_open_ended_frame_range_keeps_later_frames():
+    collection = FakeCollection(bucket_documents("1", range(35)))
+
+    rows = list(find_frames(collection, "1", ["fire_status"], frame_start=27, bucket_size=10))
+
+    assert [row["frame_id"] for row in rows] == [f"frame_{n:04d}" for n in range(27, 35)]
+
+
+def test_cache_serves_repeated_queries_offline():
+    collection = FakeCollection(bucket_documents("1", range(5)))
+    clock = [0.0]
+    cache = ResultsCache(ttl=5, clock=lambda: clock[0])
+
+    first = cache.find_frames(collection, "1", detection_types=["vehicle_status"])
+    second = cache.find_frames(collection, "1", detection_types=["vehicle_status"])
+    clock[0] = 6.0
+    cache.find_frames(collection, "1", detection_types=["vehicle_status"])
+
+    assert first == second
+    assert len(collection.calls) == 2
+    assert (cache.hits, cache.misses) == (1, 2)
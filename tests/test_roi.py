@@ -0,0 +1,108 @@
+import importlib.util
+import json
+import os
+
+import numpy as np
+import pytest
+
+from shared import roi
+from shared.roi import RegionOfInterest, region_for
+
+LAMBDAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lambdas")
+
+# Lower half of the frame
+LOWER_HALF = [[[0.0, 0.5], [1.0, 0.5], [1.0, 1.0], [0.0, 1.0]]]
+
+
+def load_extract_frame():
+    path = os.path.join(LAMBDAS_DIR, "common/extract-frame-nht/lambda_function.py")
+    spec = importlib.util.spec_from_file_location("extract_frame_roi_test", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def textured_frame(seed=0):
+    return np.random.default_rng(seed).integers(0, 200, (120, 160, 3), dtype=np.uint8)
+
+
+def test_mask_is_rasterised_once_per_frame_size():
+    region = RegionOfInterest(LOWER_HALF)
+
+    box, box_mask, area_ratio = region.mask((120, 160, 3))
+
+    assert box == (0, 60, 160, 60)
+    assert box_mask.all()
+    assert area_ratio == 1.0
+    assert region.mask((120, 160)) is region.mask((120, 160, 3))
+
+
+def test_pixels_outside_the_polygons_are_blanked():
+    triangle = RegionOfInterest([[[0.0, 0.0], [1.0, 0.0], [0.0, 1.0]]])
+    frame = np.full((100, 100, 3), 255, dtype=np.uint8)
+
+    masked = triangle.apply(frame)
+
+    assert masked[0, 0].tolist() == [255, 255, 255]
+    assert masked[99, 99].tolist() == [0, 0, 0]
+    assert triangle.mask(frame.shape)[2] == pytest.approx(2.0, rel=0.05)
+
+
+def test_changes_outside_the_region_do_not_count():
+    extract_frame = load_extract_frame()
+    region = RegionOfInterest(LOWER_HALF)
+    before = textured_frame()
+    after = before.copy()
+    # A burned-in timestamp changes in the upper half
+    after[:40] = textured_frame(seed=1)[:40]
+
+    unmasked = extract_frame.compare_frames(before, after)
+    masked = extract_frame.compare_frames(before, after, region)
+
+    assert unmasked["abs_diff"] > 0
+    assert masked["abs_diff"] == 0
+    assert masked["ssim"] == pytest.approx(1.0)
+
+
+def test_changes_inside_the_region_are_scaled_to_its_area():
+    extract_frame = load_extract_frame()
+    before = textured_frame()
+    after = before.copy()
+    after[60:] = textured_frame(seed=2)[60:]
+
+    full = extract_frame.compare_frames(before, after)
+    masked = extract_frame.compare_frames(before, after, RegionOfInterest(LOWER_HALF))
+
+    assert masked["abs_diff"] == pytest.approx(2 * full["abs_diff"], rel=0.01)
+
+
+def test_crop_returns_the_bounding_box_and_offset():
+    region = RegionOfInterest([[[0.25, 0.5], [0.75, 0.5], [0.75, 1.0], [0.25, 1.0]]], crop=True)
+
+    cropped, offset = region.crop_frame(textured_frame())
+
+    assert offset == (40, 60)
+    assert cropped.shape[:2] == (60, 80)
+
+
+def test_streams_fall_back_from_video_name_to_default(tmp_path):
+    path = tmp_path / "roi.json"
+    path.write_text(json.dumps({
+        "12_cam_north": {"polygons": LOWER_HALF, "crop": True},
+        "7": LOWER_HALF,
+        "*": [[[0.0, 0.1], [1.0, 0.1], [1.0, 1.0]]]
+    }))
+    try:
+        assert region_for("uploads/12_cam_north.mp4", str(path)).crop
+        assert region_for("7_cam_south.mp4", str(path)) is roi.load_regions(str(path))["7"]
+        assert region_for("other.mp4", str(path)) is roi.load_regions(str(path))["*"]
+        assert region_for("other.mp4", "") is None
+    finally:
+        roi._config = None
+
+
+def test_invalid_config_leaves_streams_unmasked():
+    try:
+        assert region_for("12_cam.mp4", '{"12": [[[0, 0], [1, 1]]]}') is None
+    finally:
+        roi._config = None
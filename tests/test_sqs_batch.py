@@ -0,0 +1,147 @@
+import json
+import threading
+import time
+
+from shared.mongo_writer import WriteBehindBuffer
+from shared.sqs_batch import DeadlineExceeded, parse_s3_event, process_sqs_records
+
+
+class FakeContext:
+    """Minimal stand-in for the Lambda context object."""
+
+    def __init__(self, remaining_ms):
+        self.deadline = time.monotonic() + remaining_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def make_record(message_id, key="stream/frame_0001.jpg"):
+    body = {"Records": [{"s3": {"bucket": {"name": "frames-nht"}, "object": {"key": key}}}]}
+    return {"messageId": message_id, "receiptHandle": f"handle-{message_id}", "body": json.dumps(body)}
+
+
+def test_parse_s3_event():
+    s3_event = parse_s3_event(make_record("1", key="abc/frame_0002.jpg"))
+    assert s3_event["bucket"]["name"] == "frames-nht"
+    assert s3_event["object"]["key"] == "abc/frame_0002.jpg"
+
+
+def test_records_are_processed_concurrently():
+    records = [make_record(str(i)) for i in range(10)]
+    barrier = threading.Barrier(10, timeout=5)
+
+    def process_record(record):
+        # Every record waits for all the others, so this only passes when they run in parallel
+        barrier.wait()
+
+    start = time.monotonic()
+    failures = process_sqs_records(records, process_record, FakeContext(60000), max_workers=10)
+    assert failures == []
+    assert time.monotonic() - start < 5
+
+
+def test_failed_records_are_reported():
+    records = [make_record(str(i)) for i in range(4)]
+
+    def process_record(record):
+        if record["messageId"] in ("1", "3"):
+            raise ValueError("detection failed")
+
+    failures = process_sqs_records(records, process_record, {})
+    assert failures == [{"itemIdentifier": "1"}, {"itemIdentifier": "3"}]
+
+
+def test_no_new_records_started_near_deadline():
+    records = [make_record(str(i)) for i in range(3)]
+    processed = []
+
+    failures = process_sqs_records(records, lambda record: processed.append(record), FakeContext(1000), deadline_margin_ms=5000)
+    assert processed == []
+    assert [failure["itemIdentifier"] for failure in failures] == ["0", "1", "2"]
+
+
+def test_records_running_at_deadline_are_reported():
+    records = [make_record("fast"), make_record("slow")]
+    release = threading.Event()
+
+    def process_record(record):
+        if record["messageId"] == "slow":
+            release.wait(5)
+
+    failures = process_sqs_records(records, process_record, FakeContext(1500), deadline_margin_ms=100)
+    release.set()
+    assert failures == [{"itemIdentifier": "slow"}]
+
+
+def test_records_abandoned_at_deadline_write_nothing():
+    class Collection:
+        full_name = "lambda_outputs.combined_output"
+
+    buffer = WriteBehindBuffer(flush_threshold=1000)
+    records = [make_record("fast"), make_record("slow")]
+    release = threading.Event()
+    outcome = []
+
+    def process_record(record):
+        if record["messageId"] == "slow":
+            release.wait(5)
+        try:
+            buffer.update_one(Collection(), {"stream_Id": record["messageId"]}, {"$set": {"done": True}}, tag=record["messageId"])
+        except DeadlineExceeded:
+            outcome.append(record["messageId"])
+            raise
+
+    failures = process_sqs_records(records, process_record, FakeContext(1500), deadline_margin_ms=100)
+    release.set()
+    time.sleep(0.1)
+
+    assert failures == [{"itemIdentifier": "slow"}]
+    assert outcome == ["slow"]
+    [operations] = buffer._take_pending()["lambda_outputs.combined_output"]
+    assert [operation.tags for operation in operations.values()] == [{"fast"}]
+
+
+def test_records_of_a_stream_run_in_order():
+    records = [make_record(f"{stream}-{number}", key=f"{stream}/frame_{number:04d}.jpg")
+               for number in range(3) for stream in ("cam-1", "cam-2")]
+    barrier = threading.Barrier(2, timeout=5)
+    running, started = set(), []
+    lock = threading.Lock()
+
+    def process_record(record):
+        stream = record["messageId"].rsplit("-", 1)[0]
+        with lock:
+            assert stream not in running
+            running.add(stream)
+            started.append(record["messageId"])
+        # The two streams still run in parallel
+        barrier.wait()
+        time.sleep(0.01)
+        with lock:
+            running.discard(stream)
+
+    failures = process_sqs_records(records, process_record, FakeContext(60000), in_stream_order=True)
+
+    assert failures == []
+    assert [message_id for message_id in started if message_id.startswith("cam-1")] == ["cam-1-0", "cam-1-1", "cam-1-2"]
+    assert [message_id for message_id in started if message_id.startswith("cam-2")] == ["cam-2-0", "cam-2-1", "cam-2-2"]
+
+
+def test_records_waiting_behind_their_stream_at_deadline_are_reported():
+    records = [make_record(str(number), key=f"cam-1/frame_{number:04d}.jpg") for number in range(3)]
+    release = threading.Event()
+    processed = []
+
+    def process_record(record):
+        processed.append(record["messageId"])
+        if record["messageId"] == "0":
+            release.wait(5)
+
+    failures = process_sqs_records(records, process_record, FakeContext(1500), deadline_margin_ms=100, in_stream_order=True)
+    release.set()
+    time.sleep(0.1)
+
+    assert failures == [{"itemIdentifier": "0"}, {"itemIdentifier": "1"}, {"itemIdentifier": "2"}]
+    # The records after the abandoned one are not started any more
+    assert processed == ["0"]
@@ -0,0 +1,113 @@
+import datetime
+import io
+import itertools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from botocore.exceptions import ClientError
+
+from shared import clients
+from shared.status_shards import compact_all, compact_status_shards, find_shard_directories, write_status_shard
+
+BUCKET = "final-output"
+
+
+class FakeS3:
+    """In-memory S3 supporting the calls and conditional puts used by the status shards."""
+
+    def __init__(self):
+        self.objects = {}
+        self.puts = 0
+        self._versions = itertools.count()
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, ContentType=None, IfMatch=None, IfNoneMatch=None):
+        with self._lock:
+            current = self.objects.get(Key)
+            if (IfNoneMatch == '*' and current is not None) or (IfMatch is not None and (current is None or current[1] != IfMatch)):
+                raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+            version = next(self._versions)
+            self.objects[Key] = (Body, f'"{version}"', datetime.datetime(2025, 1, 1) + datetime.timedelta(seconds=version))
+            self.puts += 1
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        body, etag, _ = self.objects[Key]
+        return {"Body": io.BytesIO(body), "ETag": etag}
+
+    def get_paginator(self, name):
+        s3 = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                contents = [{"Key": key, "LastModified": modified} for key, (_, _, modified) in sorted(s3.objects.items()) if key.startswith(Prefix)]
+                yield {"Contents": contents}
+
+        return Paginator()
+
+    def delete_objects(self, Bucket, Delete):
+        with self._lock:
+            for item in Delete['Objects']:
+                self.objects.pop(item['Key'], None)
+
+
+@pytest.fixture
+def s3():
+    fake = FakeS3()
+    clients.set_client("s3", fake)
+    yield fake
+    clients._clients.pop("s3", None)
+
+
+def read_summary(s3, key):
+    return json.loads(s3.objects[key][0])
+
+
+def test_every_frame_writes_its_own_small_shard(s3):
+    for frame in range(50):
+        write_status_shard(BUCKET, f"1234/cam/frame_{frame:04d}.jpg", [{"bbox": [0, 0, 1, 1]}], "human_status")
+
+    assert s3.puts == 50
+    assert len(s3.objects) == 50
+    assert max(len(body) for body, _, _ in s3.objects.values()) < 200
+
+
+def test_compaction_merges_shards_into_summary_in_frame_order(s3):
+    s3.put_object(Bucket=BUCKET, Key="1234/cam/human_status.json", Body=json.dumps({"frame_0001": "old"}).encode())
+    for frame in (10, 2, 1):
+        write_status_shard(BUCKET, f"1234/cam/frame_{frame:04d}.jpg", f"status {frame}", "human_status")
+
+    assert compact_status_shards(BUCKET, "1234/cam", "human_status") == 3
+
+    summary = read_summary(s3, "1234/cam/human_status.json")
+    assert list(summary) == ["frame_0001", "frame_0002", "frame_0010"]
+    assert summary["frame_0001"] == "status 1"
+    assert list(s3.objects) == ["1234/cam/human_status.json"]
+    assert compact_status_shards(BUCKET, "1234/cam", "human_status") == 0
+
+
+def test_concurrent_writers_and_compactions_lose_no_frames(s3):
+    def write(frame):
+        write_status_shard(BUCKET, f"1234/frame_{frame:04d}.jpg", frame, "human_status")
+        if frame % 10 == 0:
+            compact_status_shards(BUCKET, "1234", "human_status")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(write, range(200)))
+    compact_status_shards(BUCKET, "1234", "human_status")
+
+    summary = read_summary(s3, "1234/human_status.json")
+    assert summary == {f"frame_{frame:04d}": frame for frame in range(200)}
+
+
+def test_compact_all_finds_every_directory_with_shards(s3):
+    write_status_shard(BUCKET, "a/frame_0001.jpg", 1, "human_status")
+    write_status_shard(BUCKET, "b/c/frame_0001.jpg", 1, "human_status")
+    write_status_shard(BUCKET, "b/c/frame_0002.jpg", 2, "human_status")
+
+    assert find_shard_directories(BUCKET, "human_status") == ["a", "b/c"]
+    assert compact_all(BUCKET, "human_status", prefix="b/") == {"b/c": 2}
+    assert read_summary(s3, "b/c/human_status.json") == {"frame_0001": 1, "frame_0002": 2}
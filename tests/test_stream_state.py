@@ -0,0 +1,240 @@
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+
+import cv2
+import numpy as np
+import pytest
+
+from shared import clients, frame_manifest
+from shared.stream_state import (StreamStateError, decode_thumbnail, encode_thumbnail, frame_thumbnail,
+                                 load_stream_state, segment_stream_id, stream_state_key)
+from shared.video_checkpoints import checkpoint_bucket, load_checkpoint
+
+LAMBDAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lambdas")
+
+
+class NotFound(Exception):
+    def __init__(self):
+        super().__init__("Not Found")
+        self.response = {"Error": {"Code": "404"}}
+
+
+class AccessDenied(Exception):
+    def __init__(self):
+        super().__init__("Access Denied")
+        self.response = {"Error": {"Code": "AccessDenied"}}
+
+
+class SegmentS3:
+    """In-memory S3 stand-in serving local video files as segments."""
+
+    def __init__(self):
+        self.objects = {}
+        self.videos = {}
+        self.frames = []
+        # Keys whose reads or writes are denied
+        self.denied = set()
+
+    def add_segment(self, key, path):
+        self.videos[key] = path
+        self.objects[("live", key)] = b"segment"
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise NotFound()
+        return {"ETag": f'"{Key}"'}
+
+    def download_file(self, bucket, key, path):
+        shutil.copy(self.videos[key], path)
+
+    def get_object(self, Bucket, Key):
+        if Key in self.denied:
+            raise AccessDenied()
+        if (Bucket, Key) not in self.objects:
+            raise NotFound()
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        if Key in self.denied:
+            raise AccessDenied()
+        self.objects[(Bucket, Key)] = Body
+        if Key.endswith(".jpg"):
+            self.frames.append(Key)
+        return {"ETag": f'"{hashlib.md5(Body).hexdigest()}"'}
+
+
+class ManifestSQS:
+    def __init__(self):
+        self.messages = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.messages.extend(json.loads(entry["MessageBody"]) for entry in Entries)
+        return {}
+
+
+def write_video(path, scenes, frames_per_scene=5):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), 10, (160, 120))
+    for scene in scenes:
+        for _ in range(frames_per_scene):
+            writer.write(scene)
+    writer.release()
+    return str(path)
+
+
+@pytest.fixture
+def scenes():
+    # Large flat blocks survive the video codec without noise between frames
+    rng = np.random.default_rng(0)
+    return [np.kron(rng.integers(0, 255, (3, 4, 3), dtype=np.uint8), np.ones((40, 40, 1), dtype=np.uint8))
+            for _ in range(3)]
+
+
+@pytest.fixture
+def extractor(monkeypatch):
+    path = os.path.join(LAMBDAS_DIR, "common/extract-frame-nht/lambda_function.py")
+    spec = importlib.util.spec_from_file_location("extract_frame_segment_test", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    monkeypatch.setattr(module, "SEGMENT_INGEST", True)
+
+    s3 = SegmentS3()
+    clients.set_client("s3", s3)
+    yield module, s3
+    clients._clients.pop("s3", None)
+
+
+def test_segments_are_grouped_by_their_stream():
+    assert segment_stream_id("live/cam-12/000180.ts") == "cam-12"
+    assert segment_stream_id("cam-12_000180.ts") == "cam-12"
+    assert segment_stream_id("12_cam_north-7.mp4") == "12_cam_north"
+    assert segment_stream_id("lobby.mp4") == "lobby"
+
+
+def test_thumbnails_survive_the_round_trip(scenes):
+    thumbnail = frame_thumbnail(scenes[0])
+
+    assert thumbnail.shape == (48, 64, 3)
+    assert np.array_equal(decode_thumbnail(encode_thumbnail(thumbnail)), thumbnail)
+
+
+def test_unchanged_segment_boundary_uploads_nothing(extractor, scenes, tmp_path):
+    module, s3 = extractor
+    s3.add_segment("live/cam-1/000001.ts", write_video(tmp_path / "1.mp4", [scenes[0]]))
+    s3.add_segment("live/cam-1/000002.ts", write_video(tmp_path / "2.mp4", [scenes[0]]))
+
+    module.process_video("live", "live/cam-1/000001.ts", "frames-nht")
+    metrics_list, complete = module.process_video("live", "live/cam-1/000002.ts", "frames-nht")
+
+    assert complete
+    assert s3.frames == ["cam-1/frame_0000.jpg"]
+    assert [m["frame_number"] for m in metrics_list] == [5, 6, 7, 8, 9]
+    assert load_stream_state("live", "cam-1")["next_frame"] == 10
+
+
+def test_frame_numbers_continue_across_segments(extractor, scenes, tmp_path):
+    module, s3 = extractor
+    s3.add_segment("live/cam-1/000001.ts", write_video(tmp_path / "1.mp4", [scenes[0], scenes[1]]))
+    s3.add_segment("live/cam-1/000002.ts", write_video(tmp_path / "2.mp4", [scenes[2], scenes[0]]))
+
+    module.process_video("live", "live/cam-1/000001.ts", "frames-nht")
+    module.process_video("live", "live/cam-1/000002.ts", "frames-nht")
+
+    assert s3.frames == ["cam-1/frame_0000.jpg", "cam-1/frame_0005.jpg",
+                         "cam-1/frame_0010.jpg", "cam-1/frame_0015.jpg"]
+
+
+def test_streams_keep_separate_state(extractor, scenes, tmp_path):
+    module, s3 = extractor
+    s3.add_segment("live/cam-1/000001.ts", write_video(tmp_path / "1.mp4", [scenes[0]]))
+    s3.add_segment("live/cam-2/000001.ts", write_video(tmp_path / "2.mp4", [scenes[0]]))
+
+    module.process_video("live", "live/cam-1/000001.ts", "frames-nht")
+    module.process_video("live", "live/cam-2/000001.ts", "frames-nht")
+
+    assert s3.frames == ["cam-1/frame_0000.jpg", "cam-2/frame_0000.jpg"]
+
+
+def test_redelivered_segment_does_not_renumber_its_frames(extractor, scenes, tmp_path):
+    module, s3 = extractor
+    s3.add_segment("live/cam-1/000001.ts", write_video(tmp_path / "1.mp4", [scenes[0], scenes[1]]))
+    module.process_video("live", "live/cam-1/000001.ts", "frames-nht")
+    # The invocation died after the stream state but before the done checkpoint was written
+    del s3.objects[(checkpoint_bucket("live"), "checkpoints/live/cam-1/000001.ts.json")]
+
+    metrics_list, complete = module.process_video("live", "live/cam-1/000001.ts", "frames-nht")
+
+    assert complete and metrics_list == []
+    assert s3.frames == ["cam-1/frame_0000.jpg", "cam-1/frame_0005.jpg"]
+    assert load_stream_state("live", "cam-1")["next_frame"] == 10
+
+
+def test_unreadable_stream_state_fails_the_segment(extractor, scenes, tmp_path):
+    module, s3 = extractor
+    s3.add_segment("live/cam-1/000001.ts", write_video(tmp_path / "1.mp4", [scenes[0]]))
+    s3.add_segment("live/cam-1/000002.ts", write_video(tmp_path / "2.mp4", [scenes[1]]))
+    module.process_video("live", "live/cam-1/000001.ts", "frames-nht")
+    s3.denied.add(stream_state_key("cam-1"))
+
+    with pytest.raises(StreamStateError):
+        module.process_video("live", "live/cam-1/000002.ts", "frames-nht")
+
+    # Numbering the segment from 0 would have overwritten the stream's first frame
+    assert s3.frames == ["cam-1/frame_0000.jpg"]
+
+
+def test_handler_raises_when_stream_state_cannot_be_written(extractor, scenes, tmp_path):
+    module, s3 = extractor
+    s3.add_segment("live/cam-1/000001.ts", write_video(tmp_path / "1.mp4", [scenes[0]]))
+    s3.denied.add(stream_state_key("cam-1"))
+    event = {"Records": [{"s3": {"bucket": {"name": "live"}, "object": {"key": "live/cam-1/000001.ts"}}}]}
+
+    # The asynchronous invocation is retried, and the segment is not checkpointed as done
+    with pytest.raises(StreamStateError):
+        module.lambda_handler(event, None)
+    checkpoint = load_checkpoint("live", "live/cam-1/000001.ts", '"live/cam-1/000001.ts"')
+    assert checkpoint is None or not checkpoint["done"]
+
+
+def test_manifests_tell_frames_of_a_restarted_stream_apart(extractor, scenes, tmp_path, monkeypatch):
+    module, s3 = extractor
+    sqs = ManifestSQS()
+    clients.set_client("sqs", sqs)
+    monkeypatch.setattr(module, "DETECTOR_QUEUE_URLS", ["q"])
+    monkeypatch.setattr(frame_manifest, "DETECTOR_QUEUE_URLS", ["q"])
+    s3.add_segment("live/cam-1/000001.ts", write_video(tmp_path / "1.mp4", [scenes[0]]))
+    s3.add_segment("live/cam-1/000002.ts", write_video(tmp_path / "2.mp4", [scenes[1]]))
+
+    module.process_video("live", "live/cam-1/000001.ts", "frames-nht")
+    # The stream starts over, numbering its frames from 0 again
+    del s3.objects[(checkpoint_bucket("live"), stream_state_key("cam-1"))]
+    module.process_video("live", "live/cam-1/000002.ts", "frames-nht")
+    clients._clients.pop("sqs", None)
+
+    first, second = (message["frames"][0] for message in sqs.messages)
+    assert first["key"] == second["key"] == "cam-1/frame_0000.jpg"
+    assert first["etag"] and second["etag"] and first["etag"] != second["etag"]
+    assert '"' not in first["etag"]
+
+
+def test_regions_are_measured_against_the_last_uploaded_frame(extractor, scenes, tmp_path, monkeypatch):
+    module, s3 = extractor
+    sqs = ManifestSQS()
+    clients.set_client("sqs", sqs)
+    monkeypatch.setattr(module, "MOTION_CROPS_ENABLED", True)
+    monkeypatch.setattr(module, "DETECTOR_QUEUE_URLS", ["q"])
+    monkeypatch.setattr(frame_manifest, "DETECTOR_QUEUE_URLS", ["q"])
+    s3.add_segment("live/cam-1/000001.ts", write_video(tmp_path / "1.mp4", [scenes[0], scenes[1], scenes[2]]))
+
+    module.process_video("live", "live/cam-1/000001.ts", "frames-nht")
+    clients._clients.pop("sqs", None)
+
+    frames = [frame for message in sqs.messages for frame in message["frames"]]
+    assert [frame["frame_number"] for frame in frames] == [0, 5, 10]
+    # The first frame has nothing to be cropped against
+    assert "regions" not in frames[0]
+    assert [frame["reference_frame"] for frame in frames[1:]] == [0, 5]
+    assert all(frame["regions"] for frame in frames[1:])
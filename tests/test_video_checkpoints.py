@@ -0,0 +1,209 @@
+import collections
+import importlib.util
+import io
+import json
+import os
+import shutil
+
+import cv2
+import numpy as np
+import pytest
+
+from shared import clients, video_checkpoints
+from shared.video_checkpoints import checkpoint_bucket, checkpoint_key, fingerprints_match, frame_fingerprint
+
+LAMBDAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lambdas")
+VIDEO_KEY = "uploads/checkpoint-test.mp4"
+FRAMES = 40
+
+
+class NotFound(Exception):
+    def __init__(self):
+        super().__init__("Not Found")
+        self.response = {"Error": {"Code": "404"}}
+
+
+class FakeS3:
+    def __init__(self, video_path):
+        self.objects = {("videos", VIDEO_KEY): b"video"}
+        self.video_path = video_path
+        self.puts = collections.Counter()
+        self.fail_after_puts = None
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise NotFound()
+        return {"ETag": '"etag-1"'}
+
+    def download_file(self, bucket, key, path):
+        shutil.copy(self.video_path, path)
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise NotFound()
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        if self.fail_after_puts is not None and Key.endswith(".jpg") and sum(self.puts.values()) >= self.fail_after_puts:
+            raise Exception("container crashed")
+        self.objects[(Bucket, Key)] = Body
+        self.puts[Key] += 1
+
+    def frame_puts(self):
+        return {key: count for key, count in self.puts.items() if key.endswith(".jpg")}
+
+
+class RecordingLambda:
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.invocations.append((FunctionName, json.loads(Payload)))
+        return {"StatusCode": 202}
+
+
+class ExpiringContext:
+    """Lambda context whose remaining time runs out after ``calls`` checks."""
+
+    function_name = "extract-frame-nht"
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def get_remaining_time_in_millis(self):
+        self.calls -= 1
+        return 900000 if self.calls > 0 else 1000
+
+
+@pytest.fixture
+def video_path(tmp_path):
+    path = str(tmp_path / "video.mp4")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), 10, (160, 120))
+    rng = np.random.default_rng(0)
+    background = rng.integers(0, 255, (120, 160, 3), dtype=np.uint8)
+    for index in range(FRAMES):
+        if index % 3 == 0:
+            background = rng.integers(0, 255, (120, 160, 3), dtype=np.uint8)
+        writer.write(background)
+    writer.release()
+    return path
+
+
+@pytest.fixture
+def extractor(video_path):
+    path = os.path.join(LAMBDAS_DIR, "common/extract-frame-nht/lambda_function.py")
+    spec = importlib.util.spec_from_file_location("extract_frame_checkpoint_test", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    s3 = FakeS3(video_path)
+    clients.set_client("s3", s3)
+    clients.set_client("lambda", RecordingLambda())
+    yield module, s3
+    clients._clients.pop("s3", None)
+    clients._clients.pop("lambda", None)
+
+
+def reference_frames(video_path):
+    s3 = FakeS3(video_path)
+    clients.set_client("s3", s3)
+    path = os.path.join(LAMBDAS_DIR, "common/extract-frame-nht/lambda_function.py")
+    spec = importlib.util.spec_from_file_location("extract_frame_reference", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    metrics_list, complete = module.process_video("videos", VIDEO_KEY, "frames")
+    assert complete and len(metrics_list) == FRAMES - 1
+    return s3.frame_puts()
+
+
+def test_fingerprints_tolerate_small_differences():
+    frame = np.random.default_rng(1).integers(0, 255, (120, 160, 3), dtype=np.uint8)
+    noisy = np.clip(frame.astype(int) + 2, 0, 255).astype(np.uint8)
+    other = np.random.default_rng(2).integers(0, 255, (120, 160, 3), dtype=np.uint8)
+
+    assert fingerprints_match(frame_fingerprint(frame), frame_fingerprint(noisy))
+    assert not fingerprints_match(frame_fingerprint(frame), frame_fingerprint(other))
+    assert not fingerprints_match(frame_fingerprint(frame), None)
+
+
+def test_video_is_handed_over_before_the_deadline(extractor, video_path):
+    expected = reference_frames(video_path)
+    module, s3 = extractor
+    clients.set_client("s3", s3)
+
+    metrics_list, complete = module.process_video("videos", VIDEO_KEY, "frames", ExpiringContext(calls=15))
+
+    assert not complete
+    [(function_name, payload)] = clients.get_lambda_client().invocations
+    assert function_name == "extract-frame-nht"
+    assert payload["Records"][0]["s3"]["object"]["key"] == VIDEO_KEY
+    checkpoint = json.loads(s3.objects[(checkpoint_bucket("videos"), checkpoint_key(VIDEO_KEY))])
+    assert checkpoint["clean"] and not checkpoint["done"]
+    assert checkpoint["next_frame"] == len(metrics_list) + 1
+
+    rest, complete = module.process_video("videos", VIDEO_KEY, "frames", ExpiringContext(calls=10 ** 6))
+
+    assert complete
+    assert len(metrics_list) + len(rest) == FRAMES - 1
+    assert s3.frame_puts() == expected
+
+
+def test_crashed_invocation_resumes_without_duplicate_uploads(extractor, video_path, monkeypatch):
+    expected = reference_frames(video_path)
+    module, s3 = extractor
+    clients.set_client("s3", s3)
+    monkeypatch.setattr(module, "CHECKPOINT_EVERY_FRAMES", 10)
+    s3.fail_after_puts = 12
+
+    with pytest.raises(Exception, match="container crashed"):
+        module.process_video("videos", VIDEO_KEY, "frames")
+    checkpoint = json.loads(s3.objects[(checkpoint_bucket("videos"), checkpoint_key(VIDEO_KEY))])
+    assert not checkpoint["clean"] and checkpoint["next_frame"] > 0
+
+    s3.fail_after_puts = None
+    _, complete = module.process_video("videos", VIDEO_KEY, "frames")
+
+    assert complete
+    assert s3.frame_puts() == expected
+    assert set(s3.frame_puts().values()) == {1}
+
+
+def test_finished_video_is_not_processed_again(extractor):
+    module, s3 = extractor
+
+    module.process_video("videos", VIDEO_KEY, "frames")
+    uploads = sum(s3.frame_puts().values())
+    metrics_list, complete = module.process_video("videos", VIDEO_KEY, "frames")
+
+    assert complete and metrics_list == []
+    assert sum(s3.frame_puts().values()) == uploads
+
+
+def test_checkpoint_of_another_object_version_is_ignored(extractor):
+    module, s3 = extractor
+    s3.objects[(checkpoint_bucket("videos"), checkpoint_key(VIDEO_KEY))] = json.dumps({"etag": '"old"', "done": True}).encode()
+
+    metrics_list, complete = module.process_video("videos", VIDEO_KEY, "frames")
+
+    assert complete and len(metrics_list) == FRAMES - 1
+
+
+def test_checkpoints_next_to_the_video_do_not_start_an_extraction(extractor):
+    module, s3 = extractor
+    module.process_video("videos", VIDEO_KEY, "frames")
+    assert ("videos", checkpoint_key(VIDEO_KEY)) in s3.objects
+    event = {"Records": [{"s3": {"bucket": {"name": "videos"}, "object": {"key": checkpoint_key(VIDEO_KEY)}}}]}
+
+    response = module.lambda_handler(event, None)
+
+    assert json.loads(response["body"])["message"] == "Not a video"
+
+
+def test_checkpoints_go_to_the_configured_bucket(extractor, monkeypatch):
+    module, s3 = extractor
+    monkeypatch.setattr(video_checkpoints, "CHECKPOINT_BUCKET", "checkpoints")
+
+    module.process_video("videos", VIDEO_KEY, "frames")
+
+    assert [key for bucket, key in s3.objects if bucket == "videos"] == [VIDEO_KEY]
+    assert json.loads(s3.objects[("checkpoints", checkpoint_key(VIDEO_KEY))])["done"]
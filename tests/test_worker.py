@@ -0,0 +1,153 @@
+import json
+import threading
+import types
+
+import pytest
+
+from shared import clients
+from shared.instrumentation import Metrics
+from shared.sqs_batch import parse_s3_event
+from shared.worker import Worker
+
+
+class FakeSQS:
+    """In-memory SQS stand-in; received messages stay in flight until deleted."""
+
+    def __init__(self, bodies=()):
+        self.available = [(f"m-{index}", body) for index, body in enumerate(bodies)]
+        self.in_flight = {}
+        self.deleted = []
+        self.receives = 0
+        self.lock = threading.Lock()
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, WaitTimeSeconds, AttributeNames=()):
+        with self.lock:
+            self.receives += 1
+            batch, self.available = self.available[:MaxNumberOfMessages], self.available[MaxNumberOfMessages:]
+            for message_id, body in batch:
+                self.in_flight[f"r-{message_id}"] = (message_id, body)
+        return {"Messages": [{"MessageId": message_id, "ReceiptHandle": f"r-{message_id}", "Body": body}
+                             for message_id, body in batch]}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        assert len(Entries) <= 10
+        with self.lock:
+            for entry in Entries:
+                self.deleted.append(self.in_flight.pop(entry['ReceiptHandle'])[0])
+        return {"Successful": [{"Id": entry['Id']} for entry in Entries]}
+
+
+class FakeWrites:
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+        failed, self.failing = list(self.failing), set()
+        return failed
+
+
+def frame_body(key):
+    return json.dumps({"Records": [{"s3": {"bucket": {"name": "frames-nht"}, "object": {"key": key}}}]})
+
+
+def detector(process_s3_event, failing_writes=()):
+    """A function module with the shape of the detectors."""
+    def process_record(record):
+        process_s3_event(parse_s3_event(record))
+
+    return types.SimpleNamespace(process_record=process_record, mongo_writes=FakeWrites(failing_writes),
+                                 metrics=Metrics(enabled=False))
+
+
+@pytest.fixture
+def fake_sqs():
+    sqs = FakeSQS([frame_body(f"cam-1/frame_{number:04d}.jpg") for number in range(25)])
+    clients.set_client("sqs", sqs)
+    yield sqs
+    clients._clients.pop("sqs", None)
+
+
+def test_processed_messages_are_deleted_in_batches(fake_sqs):
+    keys = []
+    worker = Worker(detector(lambda s3_event: keys.append(s3_event["object"]["key"])), "q", batch_size=10)
+
+    while worker.poll_once():
+        pass
+
+    assert len(keys) == 25
+    assert sorted(fake_sqs.deleted) == sorted(f"m-{index}" for index in range(25))
+    assert fake_sqs.receives == 4
+    assert worker.processed == 25
+
+
+def test_failed_messages_stay_on_the_queue(fake_sqs):
+    def process_s3_event(s3_event):
+        if s3_event["object"]["key"].endswith("0003.jpg"):
+            raise Exception("inference failed")
+
+    module = detector(process_s3_event, failing_writes=["m-5"])
+    worker = Worker(module, "q", batch_size=10)
+
+    worker.poll_once()
+
+    assert sorted(message_id for message_id, _ in fake_sqs.in_flight.values()) == ["m-3", "m-5"]
+    assert (worker.processed, worker.failed) == (8, 2)
+
+
+def test_stop_finishes_the_batches_in_hand(fake_sqs):
+    worker = None
+    keys = []
+
+    def process_s3_event(s3_event):
+        keys.append(s3_event["object"]["key"])
+        if len(keys) == 3:
+            worker.stop()
+
+    module = detector(process_s3_event)
+    worker = Worker(module, "q", concurrency=2, batch_size=5, wait_seconds=0)
+
+    worker.run()
+
+    assert len(keys) in (5, 10)
+    assert sorted(fake_sqs.deleted) == sorted(f"m-{number}" for number in range(len(keys)))
+    assert fake_sqs.in_flight == {}
+    assert module.mongo_writes.flushes >= 2
+
+
+def test_write_failures_flushed_by_another_poller_fail_their_message(fake_sqs):
+    module = detector(lambda s3_event: None)
+    worker = Worker(module, "q", batch_size=5)
+    # A flush made by another poller picked up the failed write of m-0
+    worker._write_failures.add("m-0")
+
+    worker.poll_once()
+
+    assert [message_id for message_id, _ in fake_sqs.in_flight.values()] == ["m-0"]
+    assert worker._write_failures == set()
+
+
+def test_worker_runs_against_a_local_sqs():
+    boto3 = pytest.importorskip("boto3")
+    moto = pytest.importorskip("moto")
+
+    with moto.mock_aws():
+        sqs = boto3.client("sqs", region_name="ap-south-1")
+        queue_url = sqs.create_queue(QueueName="fire-detection")["QueueUrl"]
+        for number in range(12):
+            sqs.send_message(QueueUrl=queue_url, MessageBody=frame_body(f"cam-1/frame_{number:04d}.jpg"))
+        clients.set_client("sqs", sqs)
+        try:
+            keys = []
+            worker = Worker(detector(lambda s3_event: keys.append(s3_event["object"]["key"])), queue_url,
+                            concurrency=1, wait_seconds=0)
+            while worker.poll_once():
+                pass
+            attributes = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=["All"])["Attributes"]
+        finally:
+            clients._clients.pop("sqs", None)
+
+    assert sorted(keys) == [f"cam-1/frame_{number:04d}.jpg" for number in range(12)]
+    assert attributes["ApproximateNumberOfMessages"] == "0"
+    assert attributes["ApproximateNumberOfMessagesNotVisible"] == "0"